@@ -0,0 +1,121 @@
+# backend_parity.py
+# Compare inference backends (see inference_backends.py) on the eval set: BLEU/ROUGE against
+# the references, agreement with the eager model, per-token latency and weight memory.
+# With SPECULATIVE_TOKENS > 0 every backend is also run with prompt-lookup speculative decoding
+# (see speculative.py), which must agree with greedy exactly.
+import json
+import random
+import time
+from typing import List
+
+from eval import DOCS_DIR, INDEX_DIR, compute_bleu, compute_rouge, load_test_data
+from inference_backends import BACKENDS
+from model_infer import AutocompleteModel
+from rag_utils import RAGHelper
+
+# ======================
+# CONFIG
+# ======================
+
+TEST_FILE = "../data/processed/bbc_context_pairs_eval"
+MODEL_PATH = "gpt2"      # or fine-tuned model, e.g., "./finetuned_model"
+BACKENDS_TO_COMPARE = list(BACKENDS)
+USE_RAG = True
+TOP_K_DOCS = 3
+NUM_SAMPLES = 50
+MAX_GEN_LEN = 50
+SPECULATIVE_TOKENS = 8   # draft length for the speculative runs; 0 skips them
+REPORT_FILE = None       # e.g. "backend_parity.json"
+
+
+def run_backend(backend: str, samples: List[dict], retrieved: List[list], speculative_tokens: int = 0) -> dict:
+    """Greedy completions for every sample with one backend, plus timing and metrics."""
+    print(f"Loading model {MODEL_PATH} with the {backend} backend")
+    model = AutocompleteModel(MODEL_PATH, backend=backend, speculative_tokens=speculative_tokens)
+
+    # One warm-up call so one-off setup cost is not counted as latency
+    model.generate_text(samples[0]["context"], retrieved[0], max_length=2, do_sample=False)
+
+    predictions = []
+    total_s = 0.0
+    total_tokens = 0
+    for sample, docs in zip(samples, retrieved):
+        started = time.perf_counter()
+        # Greedy decoding, so differences come from the backend and not from sampling
+        predicted = model.generate_text(
+            prompt=sample["context"],
+            retrieved_docs=docs,
+            max_length=MAX_GEN_LEN,
+            do_sample=False
+        )
+        total_s += time.perf_counter() - started
+        total_tokens += max(1, len(model.tokenizer.encode(predicted)))
+        predictions.append(predicted)
+
+    n = len(samples)
+    rouge = [compute_rouge(s["continuation"], p) for s, p in zip(samples, predictions)]
+    speculative = model.speculative_stats.stats()
+    return {
+        "backend": backend + ("+speculative" if speculative_tokens else ""),
+        "bleu": sum(compute_bleu(s["continuation"], p) for s, p in zip(samples, predictions)) / n,
+        "rouge1": sum(r["rouge1"] for r in rouge) / n,
+        "rougeL": sum(r["rougeL"] for r in rouge) / n,
+        "ms_per_token": total_s * 1000.0 / total_tokens,
+        "ms_per_completion": total_s * 1000.0 / n,
+        "weights_mb": model.backend.nbytes() / (1024 * 1024),
+        # Only meaningful for the speculative runs (the warm-up call is included)
+        "acceptance_rate": speculative["acceptance_rate"] if speculative_tokens else None,
+        "tokens_per_forward": speculative["tokens_per_forward"] if speculative_tokens else None,
+        "predictions": predictions,
+    }
+
+
+def main():
+    # Same subset for every backend
+    random.seed(0)
+    samples = load_test_data(TEST_FILE, NUM_SAMPLES)
+    if not samples:
+        print("No test samples found. Exiting...")
+        return
+    print(f"Loaded {len(samples)} test samples from {TEST_FILE}.")
+
+    # Retrieve once; every backend gets the same docs (as token ids, like the server)
+    retrieved = [None] * len(samples)
+    if USE_RAG:
+        rag_helper = RAGHelper(docs_dir=DOCS_DIR, index_dir=INDEX_DIR)
+        retrieved = [
+            [doc.metadata.get("token_ids", doc.page_content)
+             for doc in rag_helper.search(s["context"], top_k=TOP_K_DOCS)]
+            for s in samples
+        ]
+
+    results = []
+    for backend in BACKENDS_TO_COMPARE:
+        results.append(run_backend(backend, samples, retrieved))
+        if SPECULATIVE_TOKENS > 0:
+            results.append(run_backend(backend, samples, retrieved, speculative_tokens=SPECULATIVE_TOKENS))
+
+    # Agreement with the first (reference) backend
+    reference = results[0]
+    for result in results:
+        same = sum(p == q for p, q in zip(result["predictions"], reference["predictions"]))
+        result["same_as_" + reference["backend"]] = same / len(samples)
+
+    print("============ BACKEND PARITY ============")
+    columns = ["backend", "bleu", "rouge1", "rougeL", "same_as_" + reference["backend"],
+               "ms_per_token", "ms_per_completion", "weights_mb", "acceptance_rate", "tokens_per_forward"]
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(
+            f"{result[c]:.4f}" if isinstance(result[c], float) else str(result[c] if result[c] is not None else "-")
+            for c in columns
+        ))
+    print("========================================")
+
+    if REPORT_FILE:
+        with open(REPORT_FILE, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# batching.py
+# Dynamic micro-batching in front of AutocompleteModel: requests that arrive within a short
+# window are merged into one left-padded `generate` call.
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from concurrency import CancelEvent, DeadlineExceeded, Overloaded, Superseded
+from metrics import PREFIX_CACHE_SKIPPED, STAGE_SECONDS
+from model_infer import AutocompleteModel
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    retrieved_docs: Optional[List[str]]
+    max_length: int
+    temperature: float
+    top_p: float
+    session_id: Optional[str] = None
+    do_sample: bool = True
+    deadline: Optional[float] = None  # time.monotonic() value after which the result is useless
+    stop_at: Optional[str] = None     # boundary granularity, see stopping.py
+    min_prob: Optional[float] = None
+    n_candidates: int = 1
+    # Set when a newer request of the session supersedes this one, or the caller's deadline passed
+    cancel: Optional[CancelEvent] = None
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    queue_wait_ms: float = 0.0
+
+    @property
+    def batch_key(self):
+        # Only requests with the same sampling settings can share a `generate` call
+        return (self.temperature, self.top_p, self.do_sample)
+
+
+class BatchScheduler:
+    """
+    Collects generation requests for up to `batch_window_ms` after the first one arrives
+    (or until `max_batch_size` are waiting) and runs them as one batch on a worker thread.
+    Each caller gets a Future for its own completion.
+
+    At most `max_queue_size` requests may wait; beyond that `submit` raises Overloaded.
+    Requests that were cancelled, superseded or whose deadline passed while queued are dropped;
+    a request superseded while decoding stops at its next token.
+
+    Requests with a session id share the padded batch like any other; the session's prefix KV
+    cache is only used when a request ends up alone in its batch. `prefer_prefix_cache` decodes
+    every session request on its own instead (one after another), trading batching for prefix reuse.
+    """
+    def __init__(
+        self,
+        model: AutocompleteModel,
+        max_batch_size: int = 8,
+        batch_window_ms: float = 10.0,
+        max_queue_size: int = 64,
+        stats_window: int = 1000,
+        prefer_prefix_cache: bool = False
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.batch_window_ms = batch_window_ms
+        self.max_queue_size = max_queue_size
+        self.prefer_prefix_cache = prefer_prefix_cache
+
+        self._queue: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._num_requests = 0
+        self._num_batches = 0
+        self._num_rejected = 0
+        self._num_expired = 0
+        self._num_superseded = 0
+        # Session requests decoded in a padded batch (prefix cache skipped) / alone with their prefix cache
+        self._num_session_batched = 0
+        self._num_session_alone = 0
+        self._recent_waits_ms = deque(maxlen=stats_window)
+        self._recent_batch_sizes = deque(maxlen=stats_window)
+
+        # Started by the first submit, so a process forked after construction (prefork.py)
+        # starts its own worker instead of inheriting a dead one
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._worker.start()
+
+    def submit(
+        self,
+        prompt: str,
+        retrieved_docs: List[str] = None,
+        max_length: int = 50,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        session_id: Optional[str] = None,
+        deadline: Optional[float] = None,
+        do_sample: bool = True,
+        stop_at: Optional[str] = None,
+        min_prob: Optional[float] = None,
+        n_candidates: int = 1,
+        cancel: Optional[CancelEvent] = None
+    ) -> Future:
+        """
+        Queue a request; the returned Future resolves to a list of model_infer.Completion,
+        best first (a single one unless n_candidates > 1).
+        """
+        if self._queue.qsize() >= self.max_queue_size:
+            with self._stats_lock:
+                self._num_rejected += 1
+            raise Overloaded("generation queue is full")
+        request = GenerationRequest(
+            prompt, retrieved_docs, max_length, temperature, top_p, session_id, do_sample, deadline,
+            stop_at=stop_at, min_prob=min_prob, n_candidates=n_candidates, cancel=cancel
+        )
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def generate_text(self, *args, **kwargs) -> str:
+        """Blocking drop-in for AutocompleteModel.generate_text."""
+        return self.submit(*args, **kwargs).result()[0].text
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _collect_batch(self) -> List[GenerationRequest]:
+        """Block for the first request, then gather more until the window closes or the batch is full."""
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.batch_window_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.batch_key, []).append(request)
+
+            for (temperature, top_p, do_sample), group in groups.items():
+                self._run_group(group, temperature, top_p, do_sample)
+
+    def _run_group(
+        self,
+        group: List[GenerationRequest],
+        temperature: float,
+        top_p: float,
+        do_sample: bool
+    ):
+        started = time.perf_counter()
+        for request in group:
+            request.queue_wait_ms = (started - request.enqueued_at) * 1000.0
+        self._record(group)
+
+        # Drop requests nobody is waiting for any more
+        live = []
+        now = time.monotonic()
+        for request in group:
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if request.deadline is not None and now > request.deadline:
+                with self._stats_lock:
+                    self._num_expired += 1
+                request.future.set_exception(DeadlineExceeded())
+                continue
+            if self._drop_superseded(request):
+                continue
+            live.append(request)
+        group = live
+        if not group:
+            return
+
+        # Speculative greedy decoding verifies one prompt's draft at a time and multi-candidate
+        # requests share one prompt's prefill across their own rows, so those are decoded on their
+        # own instead of in the padded batch; so are session requests with prefer_prefix_cache,
+        # since a session's prefix KV cache is per-prompt
+        def alone(r: GenerationRequest) -> bool:
+            session_id = r.session_id if self.prefer_prefix_cache else None
+            return self.model.decodes_alone(session_id, do_sample, r.n_candidates)
+
+        for request in [r for r in group if alone(r)]:
+            # Earlier requests of the group may have decoded long enough for this one to be replaced
+            if not self._drop_superseded(request):
+                self._complete_alone(request, temperature, top_p, do_sample)
+        group = [r for r in group if not alone(r)]
+        if not group:
+            return
+
+        if len(group) == 1:
+            # A single row gains nothing from padding, but can re-use its session's prefix cache
+            self._complete_alone(group[0], temperature, top_p, do_sample)
+            return
+
+        for request in group:
+            self._count_session(request, alone=False)
+        try:
+            # Every row stops at its own boundary; the batch ends when the last one is done
+            completions = self.model.complete_batch(
+                [r.prompt for r in group],
+                [r.retrieved_docs for r in group],
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=do_sample,
+                stoppers=[self.model.new_stopper(r.stop_at, r.min_prob, r.max_length, r.cancel) for r in group]
+            )
+        except Exception as e:
+            for request in group:
+                request.future.set_exception(e)
+            return
+
+        for request, completion in zip(group, completions):
+            request.future.set_result([completion])
+
+    def _complete_alone(self, request: GenerationRequest, temperature: float, top_p: float, do_sample: bool):
+        """Decode one request by itself (with its session's prefix cache, if any) and resolve its future."""
+        kwargs = dict(
+            max_length=request.max_length,
+            temperature=temperature,
+            top_p=top_p,
+            session_id=request.session_id,
+            do_sample=do_sample,
+            stop_at=request.stop_at,
+            min_prob=request.min_prob,
+            cancel=request.cancel
+        )
+        try:
+            if request.n_candidates > 1:
+                completions = self.model.complete_candidates(
+                    request.prompt, request.retrieved_docs, n_candidates=request.n_candidates, **kwargs
+                )
+            else:
+                completions = [self.model.complete(request.prompt, request.retrieved_docs, **kwargs)]
+            request.future.set_result(completions)
+        except Exception as e:
+            request.future.set_exception(e)
+        self._count_session(request, alone=True)
+
+    def _count_session(self, request: GenerationRequest, alone: bool):
+        if request.session_id is None:
+            return
+        with self._stats_lock:
+            if alone:
+                self._num_session_alone += 1
+            else:
+                self._num_session_batched += 1
+        # A padded batch neither reads nor updates the session's prefix cache, so its next
+        # request prefills the whole prompt again
+        if not alone and self.model.prefix_cache is not None:
+            self.model.prefix_cache.record_skip()
+            PREFIX_CACHE_SKIPPED.inc()
+
+    def _drop_superseded(self, request: GenerationRequest) -> bool:
+        """Drop a request whose cancel event was set: superseded, or its caller's deadline passed."""
+        if request.cancel is None or not request.cancel.is_set():
+            return False
+        with self._stats_lock:
+            if request.cancel.superseded:
+                self._num_superseded += 1
+            else:
+                self._num_expired += 1
+        request.future.set_exception(
+            Superseded("generation") if request.cancel.superseded else DeadlineExceeded()
+        )
+        return True
+
+    def _record(self, group: List[GenerationRequest]):
+        with self._stats_lock:
+            self._num_requests += len(group)
+            self._num_batches += 1
+            self._recent_batch_sizes.append(len(group))
+            self._recent_waits_ms.extend(r.queue_wait_ms for r in group)
+        for request in group:
+            STAGE_SECONDS.observe(request.queue_wait_ms / 1000.0, stage="queue_wait")
+
+    def stats(self) -> dict:
+        """Queue-wait and batch-size statistics over the most recent requests."""
+        with self._stats_lock:
+            waits = sorted(self._recent_waits_ms)
+            sizes = list(self._recent_batch_sizes)
+            num_requests, num_batches = self._num_requests, self._num_batches
+            num_rejected, num_expired = self._num_rejected, self._num_expired
+            num_superseded = self._num_superseded
+            num_session_batched, num_session_alone = self._num_session_batched, self._num_session_alone
+
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+        return {
+            "max_batch_size": self.max_batch_size,
+            "batch_window_ms": self.batch_window_ms,
+            "max_queue_size": self.max_queue_size,
+            "queue_depth": self.queue_depth(),
+            "requests": num_requests,
+            "rejected": num_rejected,
+            "expired": num_expired,
+            "superseded": num_superseded,
+            "prefer_prefix_cache": self.prefer_prefix_cache,
+            "session_requests_batched": num_session_batched,
+            "session_requests_alone": num_session_alone,
+            "batches": num_batches,
+            "avg_batch_size": sum(sizes) / len(sizes) if sizes else 0.0,
+            "queue_wait_ms_avg": sum(waits) / len(waits) if waits else 0.0,
+            "queue_wait_ms_p50": percentile(0.50),
+            "queue_wait_ms_p95": percentile(0.95),
+            "queue_wait_ms_max": waits[-1] if waits else 0.0,
+        }
@@ -0,0 +1,225 @@
+# concurrency.py
+# Size-limited executors with bounded wait queues and per-request deadlines, so the server
+# sheds load quickly instead of letting every request slow down under a burst. Requests of one
+# editor session also cancel the one before them (InFlightRequests), whose answer is obsolete.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Dict, Optional
+
+
+class Overloaded(Exception):
+    """All workers are busy and the wait queue is full; the request should be rejected."""
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before its work finished."""
+
+
+class Superseded(Exception):
+    """A newer request of the same session arrived; `stage` is the work that was skipped."""
+    def __init__(self, stage: str):
+        super().__init__(f"superseded by a newer request (during {stage})")
+        self.stage = stage
+
+
+class CancelEvent(threading.Event):
+    """A stop event that also records whether it was set because a newer request arrived."""
+    def __init__(self):
+        super().__init__()
+        self.superseded = False
+
+    def supersede(self):
+        self.superseded = True
+        self.set()
+
+
+def deadline_after(timeout_ms: float) -> float:
+    """An absolute deadline on the time.monotonic() clock."""
+    return time.monotonic() + timeout_ms / 1000.0
+
+
+async def wait_with_deadline(
+    awaitable: Awaitable, deadline: Optional[float], cancel: Optional[threading.Event] = None
+):
+    """
+    Await `awaitable`, cancelling it and raising DeadlineExceeded once `deadline` passes.
+    Cancelling the asyncio wrapper cannot stop work already running on another thread, so
+    `cancel` is set too: queued work is then dropped and a decode stops at its next token.
+    """
+    if deadline is None:
+        return await awaitable
+    # wait_for with a zero timeout still cancels the awaitable cleanly
+    timeout = max(0.0, deadline - time.monotonic())
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        if cancel is not None:
+            cancel.set()
+        raise DeadlineExceeded() from None
+
+
+class BoundedExecutor:
+    """
+    A thread pool that accepts at most `max_workers + max_queue` outstanding tasks.
+    `submit` raises Overloaded immediately when that is exceeded, and tasks whose deadline
+    passed while they were waiting in the queue are dropped without running.
+    """
+    def __init__(self, max_workers: int, max_queue: int, name: str = "pool"):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self.outstanding = 0
+        self.rejected = 0
+        self.expired = 0
+        self.superseded = 0
+
+    def submit(
+        self, fn, *args, deadline: Optional[float] = None, cancel: Optional[CancelEvent] = None, **kwargs
+    ) -> Future:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f"{self.name} is at capacity")
+
+        def run():
+            if deadline is not None and time.monotonic() > deadline:
+                with self._lock:
+                    self.expired += 1
+                raise DeadlineExceeded()
+            if cancel is not None and cancel.superseded:
+                with self._lock:
+                    self.superseded += 1
+                raise Superseded(self.name)
+            return fn(*args, **kwargs)
+
+        with self._lock:
+            self.outstanding += 1
+        try:
+            future = self._pool.submit(run)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, *_):
+        with self._lock:
+            self.outstanding -= 1
+        self._slots.release()
+
+    async def run(self, fn, *args, deadline: Optional[float] = None, cancel: Optional[CancelEvent] = None, **kwargs):
+        """Run `fn` on the pool from async code, honouring the deadline while waiting."""
+        future = self.submit(fn, *args, deadline=deadline, cancel=cancel, **kwargs)
+        return await wait_with_deadline(asyncio.wrap_future(future), deadline, cancel)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "outstanding": self.outstanding,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "superseded": self.superseded,
+            }
+
+
+class Slot:
+    """A held SlotLimiter slot. `release` is idempotent so every exit path can call it."""
+    def __init__(self, limiter: "SlotLimiter"):
+        self._limiter = limiter
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._limiter._release()
+
+
+class SlotLimiter:
+    """Caps how many long-running jobs (e.g. streams with their own decode thread) run at once."""
+    def __init__(self, max_active: int, name: str = "limiter"):
+        self.name = name
+        self.max_active = max_active
+        self._sem = threading.BoundedSemaphore(max_active)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.rejected = 0
+
+    def acquire(self) -> Slot:
+        if not self._sem.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f"{self.name} is at capacity")
+        with self._lock:
+            self.active += 1
+        return Slot(self)
+
+    def _release(self):
+        with self._lock:
+            self.active -= 1
+        self._sem.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"max_active": self.max_active, "active": self.active, "rejected": self.rejected}
+
+
+class InFlightRequests:
+    """
+    The newest request of every editor session. Starting a request supersedes the previous one
+    of its session, if still running: its CancelEvent is set, and it stops at the next check,
+    i.e. before retrieval, before generation or at the next decoded token (see SuggestionStopper).
+    Counts how much superseded work was skipped, by the stage it stopped in.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active: Dict[str, CancelEvent] = {}
+        self.started = 0
+        self.superseded = 0
+        self.cancelled: Dict[str, int] = {}
+        # max_length minus the tokens decoded, over completions stopped mid-decode
+        self.decode_tokens_skipped = 0
+
+    def start(self, session_id: Optional[str], cancel: Optional[CancelEvent] = None) -> CancelEvent:
+        """Register a request and supersede the session's previous one; pass `cancel` to reuse a stop event."""
+        cancel = cancel or CancelEvent()
+        if session_id is None:
+            return cancel
+        with self._lock:
+            self.started += 1
+            previous = self._active.get(session_id)
+            self._active[session_id] = cancel
+            if previous is not None and not previous.is_set():
+                self.superseded += 1
+                previous.supersede()
+        return cancel
+
+    def finish(self, session_id: Optional[str], cancel: CancelEvent):
+        with self._lock:
+            if session_id is not None and self._active.get(session_id) is cancel:
+                del self._active[session_id]
+
+    def record_cancelled(self, stage: str, tokens_skipped: int = 0):
+        with self._lock:
+            self.cancelled[stage] = self.cancelled.get(stage, 0) + 1
+            self.decode_tokens_skipped += tokens_skipped
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._active),
+                "started": self.started,
+                "superseded": self.superseded,
+                "cancelled": dict(self.cancelled),
+                "decode_tokens_skipped": self.decode_tokens_skipped,
+            }
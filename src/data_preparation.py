@@ -1,101 +1,252 @@
-from datasets import load_dataset, concatenate_datasets
-import random
+# data_preparation.py
+# Build (context, continuation) train/eval splits from BBC news. Articles are streamed month by
+# month and sampled with a seeded reservoir, so memory does not grow with the number of months;
+# split points are drawn in a worker pool from per-article seeds, and each split is written as
+# sharded (optionally gzip-compressed) JSONL plus an index.json. The same seed and settings
+# always produce byte-identical output.
+#
+#   python data_preparation.py --months 2024-01 2024-06 2024-12 --seed 0 --compress
+
+import argparse
+import gzip
+import hashlib
+import io
 import json
 import os
+import random
+from multiprocessing import Pool
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+DATASET_NAME = "RealTimeData/bbc_news_alltime"
+DEFAULT_MONTHS = ["2024-01", "2024-06", "2024-12"]
+INDEX_FILE = "index.json"
+# Positions closer than this to either end of an article are never used as split points
+MIN_SPLIT_MARGIN = 20
+MIN_ARTICLE_CHARS = 50
+
+
+def stream_articles(months: List[str], dataset_name: str = DATASET_NAME) -> Iterator[str]:
+    """Article texts of every month in turn, streamed instead of downloaded into memory."""
+    # Only needed for downloading; reading prepared splits (read_records) works without it
+    from datasets import load_dataset
+
+    for month in months:
+        print(f"Streaming {dataset_name} {month}")
+        for sample in load_dataset(dataset_name, month, split="train", streaming=True):
+            text = sample.get("content") or ""
+            if len(text) > MIN_ARTICLE_CHARS:
+                yield text
+
+
+def reservoir_sample(items: Iterable[str], k: int, seed: int) -> List[str]:
+    """
+    A uniform sample of k items from a stream of unknown length, holding only k in memory
+    (Algorithm R). Returned in stream order; depends only on the stream and the seed.
+    """
+    rng = random.Random(seed)
+    reservoir: List[Tuple[int, str]] = []
+    for i, item in enumerate(items):
+        if i < k:
+            reservoir.append((i, item))
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                reservoir[j] = (i, item)
+    reservoir.sort(key=lambda pair: pair[0])
+    return [item for _, item in reservoir]
+
+
+def article_seed(seed: int, text: str) -> int:
+    """Seed for one article's split points: the same whichever worker or order handles it."""
+    digest = hashlib.sha256(f"{seed}:{text}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
 
-def download_data():
+def split_article(args: Tuple[str, int, int]) -> List[dict]:
+    """Up to `splits` distinct (context, continuation) pairs from one article; runs in the pool."""
+    text, splits, seed = args
+    low, high = MIN_SPLIT_MARGIN, len(text) - MIN_SPLIT_MARGIN
+    if high < low:
+        return []
+    rng = random.Random(article_seed(seed, text))
+    points = sorted(rng.sample(range(low, high + 1), min(splits, high - low + 1)))
+    return [{"context": text[:p], "continuation": text[p:]} for p in points]
+
+
+class ShardWriter:
+    """
+    Writes records as JSONL shards of `shard_size` records (shard-00000.jsonl[.gz], ...) and,
+    on close, an index.json listing each shard's file, record count and sha256.
+    """
+    def __init__(self, out_dir: str, shard_size: int = 10000, compress: bool = False, metadata: dict = None):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.compress = compress
+        self.metadata = metadata or {}
+        self.shards: List[dict] = []
+        self._buffer: List[str] = []
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, record: dict):
+        self._buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(self._buffer) >= self.shard_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        name = f"shard-{len(self.shards):05d}.jsonl" + (".gz" if self.compress else "")
+        data = "".join(self._buffer).encode("utf-8")
+        if self.compress:
+            # Fixed mtime and no file name in the header, so the bytes depend only on the content
+            out = io.BytesIO()
+            with gzip.GzipFile(filename="", mode="wb", fileobj=out, mtime=0) as f:
+                f.write(data)
+            data = out.getvalue()
+        with open(os.path.join(self.out_dir, name), "wb") as f:
+            f.write(data)
+        self.shards.append({
+            "file": name,
+            "records": len(self._buffer),
+            "bytes": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+        })
+        self._buffer = []
+
+    def close(self) -> dict:
+        self._flush()
+        # Remove shards left over from an earlier, larger run
+        current = {shard["file"] for shard in self.shards}
+        for name in os.listdir(self.out_dir):
+            if name.startswith("shard-") and name not in current:
+                os.remove(os.path.join(self.out_dir, name))
+        index = {
+            **self.metadata,
+            "records": sum(shard["records"] for shard in self.shards),
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.out_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        return index
+
+
+def split_files(path: str) -> List[str]:
     """
-    Using BBC news data from January, June and December 2024.
-    Loads and combines data from all three months.
+    Files of a prepared split: the shards of a directory (via its index.json) or a single
+    JSONL(.gz) file. A split directory that does not exist falls back to `<path>.jsonl` or
+    `<path>.jsonl.gz`, e.g. the single-file splits shipped under data/processed.
     """
-    # Load datasets for all months
-    dataset_jan = load_dataset("RealTimeData/bbc_news_alltime", "2024-01")
-    dataset_jun = load_dataset("RealTimeData/bbc_news_alltime", "2024-06")
-    dataset_dec = load_dataset("RealTimeData/bbc_news_alltime", "2024-12")
-    
-    # Select only the content column from each dataset
-    dataset_jan = dataset_jan["train"].select_columns(['content'])
-    dataset_jun = dataset_jun["train"].select_columns(['content'])
-    dataset_dec = dataset_dec["train"].select_columns(['content'])
-    
-    # Combine the datasets
-    combined_dataset = concatenate_datasets([dataset_jan, dataset_jun, dataset_dec])
-    return combined_dataset
+    if os.path.isdir(path):
+        with open(os.path.join(path, INDEX_FILE), "r", encoding="utf-8") as f:
+            return [os.path.join(path, shard["file"]) for shard in json.load(f)["shards"]]
+    if not os.path.exists(path):
+        for candidate in (path + ".jsonl", path + ".jsonl.gz"):
+            if os.path.exists(candidate):
+                return [candidate]
+    return [path]
+
+
+def read_records(path: str) -> Iterator[dict]:
+    """Records of a prepared split, see `split_files`."""
+    for file_path in split_files(path):
+        opener = gzip.open if file_path.endswith(".gz") else open
+        with opener(file_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
 
 def build_context_continuation_splits(
-    dataset, 
-    train_output_path, 
-    eval_output_path, 
-    train_samples=200, 
-    eval_samples=50
-):
+    articles: Iterable[str],
+    train_output_dir: str,
+    eval_output_dir: str,
+    train_samples: int = 200,
+    eval_samples: int = 50,
+    splits_per_article: int = 3,
+    seed: int = 0,
+    workers: int = 0,
+    shard_size: int = 10000,
+    compress: bool = False,
+    metadata: Optional[dict] = None
+) -> Tuple[dict, dict]:
     """
-    Creates two files:
-      - train_output_path: up to train_samples (context, continuation) pairs
-      - eval_output_path: up to eval_samples (context, continuation) pairs
+    Sample enough articles for `train_samples` + `eval_samples` pairs, split each at up to
+    `splits_per_article` points, and write the train and eval splits as sharded JSONL.
+    Train and eval never share an article. Returns the two index dicts.
     """
+    # 1) Seeded reservoir over the article stream, then a seeded shuffle of the sample
+    train_articles = -(-train_samples // splits_per_article)
+    eval_articles = -(-eval_samples // splits_per_article)
+    sample = reservoir_sample(articles, train_articles + eval_articles, seed)
+    random.Random(seed).shuffle(sample)
+    print(f"Sampled {len(sample)} articles")
+
+    # 2) Split points per article in a worker pool; imap keeps the output in article order
+    tasks = [(text, splits_per_article, seed) for text in sample]
+    settings = {
+        "seed": seed,
+        "splits_per_article": splits_per_article,
+        "min_split_margin": MIN_SPLIT_MARGIN,
+        **(metadata or {}),
+    }
+    writers = [
+        (ShardWriter(train_output_dir, shard_size, compress, {**settings, "split": "train"}), train_samples),
+        (ShardWriter(eval_output_dir, shard_size, compress, {**settings, "split": "eval"}), eval_samples),
+    ]
+    pool = Pool(workers) if workers > 0 else None
+    try:
+        results = pool.imap(split_article, tasks, chunksize=64) if pool else map(split_article, tasks)
+        written = [0, 0]
+        for i, pairs in enumerate(results):
+            # The first train_articles articles go to train, the rest to eval
+            split = 0 if i < train_articles else 1
+            writer, limit = writers[split]
+            for pair in pairs[:limit - written[split]]:
+                writer.write(pair)
+                written[split] += 1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-    # Create output directories if they don't exist
-    os.makedirs(os.path.dirname(train_output_path), exist_ok=True)
-    os.makedirs(os.path.dirname(eval_output_path), exist_ok=True)
-
-    # Convert HuggingFace Dataset to a list so we can shuffle or iterate easily
-    data_list = list(dataset)
-
-    # Shuffle data to avoid picking only the earliest or latest articles
-    random.shuffle(data_list)
-
-    train_records = []
-    eval_records = []
-
-    # Build (context, continuation) pairs
-    for sample in data_list:
-        text = sample.get("content", "")  # or "text" depending on dataset columns
-        if text and len(text) > 50:
-            # Pick a random point in the text
-            p = random.randint(20, len(text) - 20)
-            context = text[:p]
-            continuation = text[p:]
-
-            # If train_records still needs more samples, go there first
-            if len(train_records) < train_samples:
-                train_records.append({
-                    "context": context,
-                    "continuation": continuation
-                })
-            # Else if we still need eval samples, go there next
-            elif len(eval_records) < eval_samples:
-                eval_records.append({
-                    "context": context,
-                    "continuation": continuation
-                })
-            
-            # If we've reached both limits, we can break early
-            if len(train_records) >= train_samples and len(eval_records) >= eval_samples:
-                break
-
-    # Save train samples
-    with open(train_output_path, 'w', encoding='utf-8') as f:
-        for item in train_records:
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
-
-    # Save eval samples
-    with open(eval_output_path, 'w', encoding='utf-8') as f:
-        for item in eval_records:
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    train_index, eval_index = (writer.close() for writer, _ in writers)
+    print(f"Wrote {train_index['records']} train pairs to {train_output_dir} "
+          f"and {eval_index['records']} eval pairs to {eval_output_dir}")
+    return train_index, eval_index
 
 
 def main():
-    # 1. Download or load your BBC dataset
-    dataset = download_data()
+    parser = argparse.ArgumentParser(description="Build sharded context/continuation splits from BBC news.")
+    parser.add_argument("--months", nargs="+", default=DEFAULT_MONTHS, help="dataset configs, e.g. 2024-01")
+    parser.add_argument("--train-output", default="../data/processed/bbc_context_pairs_train")
+    parser.add_argument("--eval-output", default="../data/processed/bbc_context_pairs_eval")
+    parser.add_argument("--train-samples", type=int, default=5000)
+    parser.add_argument("--eval-samples", type=int, default=1000)
+    parser.add_argument("--splits-per-article", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="split-point processes (0 splits in the main process)")
+    parser.add_argument("--shard-size", type=int, default=10000, help="records per shard")
+    parser.add_argument("--compress", action="store_true", help="gzip the shards")
+    args = parser.parse_args()
+
+    # 1. Stream the BBC dataset month by month
+    articles = stream_articles(args.months)
 
     # 2. Build the train & eval splits
     build_context_continuation_splits(
-        dataset,
-        train_output_path="data/processed/bbc_context_pairs_train.jsonl",
-        eval_output_path="data/processed/bbc_context_pairs_eval.jsonl",
-        train_samples=5000,
-        eval_samples=1000
+        articles,
+        train_output_dir=args.train_output,
+        eval_output_dir=args.eval_output,
+        train_samples=args.train_samples,
+        eval_samples=args.eval_samples,
+        splits_per_article=args.splits_per_article,
+        seed=args.seed,
+        workers=args.workers,
+        shard_size=args.shard_size,
+        compress=args.compress,
+        metadata={"dataset": DATASET_NAME, "months": args.months}
     )
 
 if __name__ == "__main__":
@@ -1,28 +1,47 @@
 # eval.py
+# Evaluate the autocomplete model on the eval split: retrieval and generation run in batches,
+# BLEU/ROUGE are scored in a process pool, and predictions are checkpointed so an interrupted
+# run resumes where it stopped and metrics can be recomputed without regenerating.
 import json
+import multiprocessing
 import os
 import random
-from typing import List
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
 
 import nltk
+import torch
 from nltk.translate.bleu_score import sentence_bleu
 
 from rouge_score import rouge_scorer
 
 # Local imports: your model and possibly RAG helper
+from data_preparation import read_records, split_files
 from model_infer import AutocompleteModel
-from rag_utils import RAGHelper
+from rag_utils import RAGHelper, text_sha256
 
 # ======================
 # CONFIG
 # ======================
 
-TEST_FILE = "../data/processed/bbc_context_pairs_eval.jsonl"
+TEST_FILE = "../data/processed/bbc_context_pairs_eval"  # data_preparation.py --eval-output (directory or JSONL file)
 MODEL_PATH = "gpt2"      # or fine-tuned model, e.g., "./finetuned_model"
+MODEL_BACKEND = "eager"  # "eager", "int8" or "torchscript" (see inference_backends.py)
 USE_RAG = True           # set True if you want to retrieve docs before generating
 TOP_K_DOCS = 3           # how many docs to retrieve
+DOCS_DIR = "data/docs"
+# Saved RAG index (rag_utils.py build / server.py); loaded instead of re-embedding DOCS_DIR
+INDEX_DIR = "data/index"
 NUM_SAMPLES = 50         # how many samples to evaluate (subset of your test set)
 MAX_GEN_LEN = 50         # how many tokens/words to generate
+SEED = 0                 # fixes the sample subset and the sampling, so runs are comparable
+BATCH_SIZE = 16          # prompts per retrieval / generate batch
+METRIC_WORKERS = 4       # processes scoring BLEU/ROUGE; 0 scores in this process
+# Predictions are appended here as they are generated; a rerun skips samples already in it
+CHECKPOINT_FILE = "eval_predictions.jsonl"
+METRICS_ONLY = False     # recompute metrics from CHECKPOINT_FILE without loading the model
+REPORT_FILE = None       # e.g. "eval_report.json"
 
 # ======================
 # METRIC UTILS
@@ -40,130 +59,226 @@ def compute_bleu(reference: str, hypothesis: str) -> float:
     bleu_score = sentence_bleu([ref_tokens], hyp_tokens)
     return bleu_score
 
+_rouge_scorer = None
+
 def compute_rouge(reference: str, hypothesis: str) -> dict:
     """
     Compute ROUGE-L (and possibly others) using the rouge_score library.
     Returns a dict of scores.
     """
-    scorer = rouge_scorer.RougeScorer(["rouge1", "rougeL"], use_stemmer=True)
-    scores = scorer.score(reference, hypothesis)
+    # Building the scorer (and its stemmer) is slow, so each process does it once
+    global _rouge_scorer
+    if _rouge_scorer is None:
+        _rouge_scorer = rouge_scorer.RougeScorer(["rouge1", "rougeL"], use_stemmer=True)
+    scores = _rouge_scorer.score(reference, hypothesis)
     return {
         "rouge1": scores["rouge1"].fmeasure,
         "rougeL": scores["rougeL"].fmeasure
     }
 
+def score_prediction(pair) -> dict:
+    """BLEU and ROUGE of one (reference, prediction) pair; runs in the metric pool."""
+    reference, predicted = pair
+    return {"bleu": compute_bleu(reference, predicted), **compute_rouge(reference, predicted)}
+
+def compute_metrics(records: List[dict], workers: Optional[int] = None) -> List[dict]:
+    """Per-sample metrics for checkpoint records, in order (METRIC_WORKERS processes by default)."""
+    workers = METRIC_WORKERS if workers is None else workers
+    pairs = [(r["reference"], r["prediction"]) for r in records]
+    if workers <= 0 or len(pairs) < 2:
+        return [score_prediction(pair) for pair in pairs]
+    # Forking a process that already runs torch threads can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(pool.map(score_prediction, pairs, chunksize=max(1, len(pairs) // (4 * workers))))
+
 # ======================
 # MAIN EVAL ROUTINE
 # ======================
 
 def load_test_data(file_path: str, num_samples: int = 50) -> List[dict]:
     """
-    Load up to `num_samples` lines from the JSONL test file,
-    each containing {"context": ..., "continuation": ...}.
+    Load up to `num_samples` records from the JSONL test file (or a sharded split directory
+    written by data_preparation.py), each containing {"context": ..., "continuation": ...}.
     """
     samples = []
-    if not os.path.exists(file_path):
+    if not all(os.path.exists(path) for path in split_files(file_path)):
         print(f"Test file {file_path} not found!")
         return samples
 
-    with open(file_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            obj = json.loads(line)
-            if "context" in obj and "continuation" in obj:
-                samples.append(obj)
+    for obj in read_records(file_path):
+        if "context" in obj and "continuation" in obj:
+            samples.append(obj)
     
     # Shuffle and take subset
     random.shuffle(samples)
     return samples[:num_samples]
 
+def sample_id(sample: dict) -> str:
+    """Stable id of a test sample, so checkpoints survive reshuffling and file edits."""
+    return text_sha256(sample["context"] + "\x00" + sample["continuation"])
+
+def run_settings() -> dict:
+    """Everything a prediction depends on; checkpointed predictions made with other settings are ignored."""
+    return {
+        "model_path": MODEL_PATH, "backend": MODEL_BACKEND, "use_rag": USE_RAG,
+        "top_k_docs": TOP_K_DOCS, "max_gen_len": MAX_GEN_LEN, "seed": SEED,
+    }
+
+def load_checkpoint(file_path: Optional[str]) -> Dict[str, dict]:
+    """Records already generated with the current settings, by sample id; a torn last line from a crash is ignored."""
+    records = {}
+    settings = run_settings()
+    if not file_path or not os.path.exists(file_path):
+        return records
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("settings") == settings:
+                records[record["id"]] = record
+    return records
+
+def generate_predictions(samples: List[dict], done: Dict[str, dict], timings: Dict[str, float]) -> int:
+    """
+    Retrieve and generate in batches of BATCH_SIZE for every sample not in `done`, appending
+    each finished batch to CHECKPOINT_FILE (and to `done`). Returns the number generated.
+    """
+    todo = [s for s in samples if sample_id(s) not in done]
+    if not todo:
+        return 0
+    print(f"Generating {len(todo)} predictions ({len(samples) - len(todo)} already in {CHECKPOINT_FILE})")
+
+    # 1. Initialize model
+    started = time.perf_counter()
+    print(f"Loading model: {MODEL_PATH} ({MODEL_BACKEND})")
+    model = AutocompleteModel(MODEL_PATH, backend=MODEL_BACKEND)
+
+    # 2. (Optional) Initialize RAG
+    rag_helper = RAGHelper(docs_dir=DOCS_DIR, index_dir=INDEX_DIR) if USE_RAG else None
+    timings["load_s"] += time.perf_counter() - started
+
+    checkpoint = open(CHECKPOINT_FILE, "a", encoding="utf-8") if CHECKPOINT_FILE else None
+    try:
+        for start in range(0, len(todo), BATCH_SIZE):
+            batch = todo[start:start + BATCH_SIZE]
+            contexts = [s["context"] for s in batch]
+
+            # 3. Retrieve docs for the whole batch (as token ids when the index stores them)
+            started = time.perf_counter()
+            retrieved = [None] * len(batch)
+            if rag_helper:
+                retrieved = [
+                    [doc.metadata.get("token_ids", doc.page_content) for doc in docs]
+                    for docs in rag_helper.search_batch(contexts, top_k=TOP_K_DOCS)
+                ]
+            timings["retrieval_s"] += time.perf_counter() - started
+
+            # 4. One padded generate call per batch
+            started = time.perf_counter()
+            predictions = model.generate_batch(
+                contexts,
+                retrieved,
+                max_lengths=[MAX_GEN_LEN] * len(batch),
+                temperature=0.7,
+                top_p=0.9
+            )
+            timings["generation_s"] += time.perf_counter() - started
+
+            for sample, predicted in zip(batch, predictions):
+                record = {
+                    "id": sample_id(sample),
+                    "context": sample["context"],
+                    "reference": sample["continuation"],
+                    "prediction": predicted,
+                    "settings": run_settings(),
+                }
+                done[record["id"]] = record
+                if checkpoint:
+                    checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if checkpoint:
+                checkpoint.flush()
+            print(f"  {min(start + BATCH_SIZE, len(todo))}/{len(todo)}")
+    finally:
+        if checkpoint:
+            checkpoint.close()
+    return len(todo)
+
 def main():
+    started_run = time.perf_counter()
+    timings = {"load_s": 0.0, "retrieval_s": 0.0, "generation_s": 0.0, "metrics_s": 0.0}
+    random.seed(SEED)
+    torch.manual_seed(SEED)
+
     # 1. Load the test data
     test_samples = load_test_data(TEST_FILE, NUM_SAMPLES)
     if not test_samples:
         print("No test samples found. Exiting...")
         return
-    
     print(f"Loaded {len(test_samples)} test samples from {TEST_FILE}.")
 
-    # 2. Initialize model
-    print(f"Loading model: {MODEL_PATH}")
-    model = AutocompleteModel(MODEL_PATH)
-
-    # 3. (Optional) Initialize RAG
-    if USE_RAG:
-        rag_helper = RAGHelper(docs_dir="data/docs")
+    # 2. Generate whatever the checkpoint does not have yet
+    done = load_checkpoint(CHECKPOINT_FILE)
+    generated = 0
+    if METRICS_ONLY:
+        test_samples = [s for s in test_samples if sample_id(s) in done]
+        print(f"Recomputing metrics for {len(test_samples)} checkpointed predictions.")
     else:
-        rag_helper = None
-
-    # 4. Metrics accumulators
-    total_bleu = 0.0
-    total_rouge1 = 0.0
-    total_rougeL = 0.0
-
-    # Keep track of (context, ref, pred) for a few examples
-    examples_to_show = []
-
-    # 5. Inference + metric calculation
-    for i, sample in enumerate(test_samples):
-        context = sample["context"]
-        reference = sample["continuation"]
-
-        # (Optional) retrieve docs
-        retrieved_docs_str = []
-        if rag_helper:
-            retrieved_docs = rag_helper.search(context, top_k=TOP_K_DOCS)
-            # doc.page_content is the actual text
-            retrieved_docs_str = [doc.page_content for doc in retrieved_docs]
-
-        # Generate text from the model
-        predicted = model.generate_text(
-            prompt=context,
-            retrieved_docs=retrieved_docs_str,
-            max_length=MAX_GEN_LEN,
-            temperature=0.7,
-            top_p=0.9
-        )
-
-        # Compute metrics
-        bleu_score = compute_bleu(reference, predicted)
-        rouge_scores = compute_rouge(reference, predicted)
-
-        total_bleu += bleu_score
-        total_rouge1 += rouge_scores["rouge1"]
-        total_rougeL += rouge_scores["rougeL"]
-
-        # Optionally store some random examples to print later
-        if i < 3:  # just store first 3 examples, or pick randomly
-            examples_to_show.append({
-                "context": context[:100] + "...",  # truncated for display
-                "reference": reference[:100] + "...",
-                "prediction": predicted[:100] + "..."
-            })
-
-    # 6. Compute average metric
-    n = len(test_samples)
-    avg_bleu = total_bleu / n
-    avg_rouge1 = total_rouge1 / n
-    avg_rougeL = total_rougeL / n
-
-    # 7. Print results
+        generated = generate_predictions(test_samples, done, timings)
+    records = [done[sample_id(s)] for s in test_samples]
+    if not records:
+        print("No predictions to score. Exiting...")
+        return
+
+    # 3. Metrics in a process pool
+    started = time.perf_counter()
+    metrics = compute_metrics(records)
+    timings["metrics_s"] = time.perf_counter() - started
+    timings["total_s"] = time.perf_counter() - started_run
+
+    # 4. Compute average metric
+    n = len(records)
+    avg_bleu = sum(m["bleu"] for m in metrics) / n
+    avg_rouge1 = sum(m["rouge1"] for m in metrics) / n
+    avg_rougeL = sum(m["rougeL"] for m in metrics) / n
+    inference_s = timings["retrieval_s"] + timings["generation_s"]
+
+    # 5. Print results
     print("============ EVALUATION RESULTS ============")
-    print(f"Number of samples evaluated: {n}")
+    print(f"Number of samples evaluated: {n} ({generated} generated this run)")
     print(f"Average BLEU:    {avg_bleu:.4f}")
     print(f"Average ROUGE-1: {avg_rouge1:.4f}")
     print(f"Average ROUGE-L: {avg_rougeL:.4f}")
+    print("---------------- THROUGHPUT ----------------")
+    if generated:
+        print(f"Samples/sec (retrieval + generation): {generated / inference_s:.2f}")
+    for stage, seconds in timings.items():
+        print(f"{stage:<13} {seconds:8.2f}")
     print("============================================\n")
 
     print("Sample predictions:")
-    for idx, ex in enumerate(examples_to_show):
+    for idx, record in enumerate(records[:3]):
         print(f"\n--- Example {idx+1} ---")
-        print(f"Context:    {ex['context']}")
-        print(f"Reference:  {ex['reference']}")
-        print(f"Prediction: {ex['prediction']}")
+        print(f"Context:    {record['context'][:100]}...")  # truncated for display
+        print(f"Reference:  {record['reference'][:100]}...")
+        print(f"Prediction: {record['prediction'][:100]}...")
     print("============================================")
 
+    if REPORT_FILE:
+        report = {
+            "samples": n,
+            "generated": generated,
+            "bleu": avg_bleu,
+            "rouge1": avg_rouge1,
+            "rougeL": avg_rougeL,
+            "samples_per_s": generated / inference_s if generated else None,
+            "timings": timings,
+            "settings": run_settings(),
+            "batch_size": BATCH_SIZE,
+        }
+        with open(REPORT_FILE, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,180 @@
+# faiss_index.py
+# Index types for the RAG vector store: exact (flat) search, or approximate / compressed
+# indexes (IVF, IVF-PQ, HNSW) for corpora too large to scan and keep as float32.
+
+import math
+import time
+from dataclasses import asdict, dataclass
+from typing import List, Optional
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw")
+
+
+class IndexRebuildRequired(Exception):
+    """The index type cannot apply this change in place (e.g. removing vectors from HNSW)."""
+
+
+@dataclass
+class IndexSpec:
+    """
+    How to build the FAISS index, and how to search it.
+
+    Build settings (index_type, nlist, pq_m, hnsw_m) are recorded in the index manifest and a
+    change triggers a rebuild; search settings (nprobe, ef_search) only apply at query time.
+    """
+    index_type: str = "flat"
+    # IVF: number of k-means centroids (clamped for small corpora)
+    nlist: int = 1024
+    # PQ: bytes per vector (clamped to a divisor of the embedding dimension)
+    pq_m: int = 64
+    # HNSW: graph neighbours per node
+    hnsw_m: int = 32
+    # Vectors collected before training IVF centroids / PQ codebooks
+    train_size: int = 50000
+    # Search time: IVF lists probed, HNSW candidate list size
+    nprobe: int = 16
+    ef_search: int = 64
+
+    def __post_init__(self):
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {self.index_type!r}, expected one of {INDEX_TYPES}")
+
+    @property
+    def needs_training(self) -> bool:
+        return self.index_type in ("ivf", "ivfpq")
+
+    @property
+    def supports_remove(self) -> bool:
+        return self.index_type != "hnsw"
+
+    def build_settings(self) -> dict:
+        settings = asdict(self)
+        for key in ("nprobe", "ef_search", "train_size"):
+            settings.pop(key)
+        return settings
+
+    def factory_string(self, dim: int, num_train: Optional[int] = None) -> str:
+        """The faiss.index_factory description for this spec, sized for `num_train` training vectors."""
+        if self.index_type == "flat":
+            return "IDMap2,Flat"
+        if self.index_type == "hnsw":
+            return f"IDMap2,HNSW{self.hnsw_m}"
+
+        nlist = self.nlist
+        if num_train is not None:
+            # k-means wants ~39 points per centroid
+            nlist = max(1, min(nlist, num_train // 39))
+        if self.index_type == "ivf":
+            return f"IVF{nlist},Flat"
+
+        m = max(d for d in range(1, min(self.pq_m, dim) + 1) if dim % d == 0)
+        nbits = 8
+        if num_train is not None:
+            # Each PQ sub-quantizer needs at least 2**nbits training points
+            nbits = max(1, min(8, int(math.log2(max(2, num_train)))))
+        return f"IVF{nlist},PQ{m}x{nbits}"
+
+    def create_index(self, dim: int, num_train: Optional[int] = None) -> faiss.Index:
+        return faiss.index_factory(dim, self.factory_string(dim, num_train), faiss.METRIC_L2)
+
+    def apply_search_params(self, index: faiss.Index):
+        params = faiss.ParameterSpace()
+        if self.needs_training:
+            params.set_index_parameter(index, "nprobe", self.nprobe)
+        elif self.index_type == "hnsw":
+            params.set_index_parameter(index, "efSearch", self.ef_search)
+
+
+def index_nbytes(index: faiss.Index) -> int:
+    return len(faiss.serialize_index(index))
+
+
+def exact_vectors(index: faiss.Index) -> np.ndarray:
+    """All vectors of an IDMap2 index (e.g. the flat one), in id order."""
+    ids = np.sort(faiss.vector_to_array(faiss.downcast_index(index).id_map))
+    return np.vstack([index.reconstruct(int(i)) for i in ids]).astype("float32")
+
+
+def enable_reconstruct(index: faiss.Index):
+    """IVF indexes can only read vectors back by id once they keep an id -> list direct map."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+
+def reconstruct_vectors(index: faiss.Index, ids: List[int]) -> np.ndarray:
+    """Stored vectors of `ids` (approximate for PQ), see `enable_reconstruct`."""
+    return index.reconstruct_batch(np.asarray(ids, dtype="int64")).astype("float32", copy=False)
+
+
+def recall_latency_report(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    specs: List[IndexSpec],
+    top_k: int = 3,
+    sweep: Optional[dict] = None
+) -> List[dict]:
+    """
+    Build each spec over `vectors` and compare its top-k results for `queries` against exact
+    search. Returns one row per (spec, search setting) with recall@k, latency and index size.
+    """
+    sweep = sweep or {"nprobe": [1, 4, 16, 64], "ef_search": [16, 32, 64, 128]}
+    dim = vectors.shape[1]
+    ids = np.arange(len(vectors), dtype="int64")
+
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(vectors)
+    _, truth = exact.search(queries, top_k)
+
+    rows = []
+    for spec in specs:
+        index = spec.create_index(dim, num_train=min(len(vectors), spec.train_size))
+        if spec.needs_training:
+            rng = np.random.default_rng(0)
+            sample = rng.choice(len(vectors), size=min(len(vectors), spec.train_size), replace=False)
+            started = time.perf_counter()
+            index.train(vectors[sample])
+            train_s = time.perf_counter() - started
+        else:
+            train_s = 0.0
+        index.add_with_ids(vectors, ids)
+
+        if spec.needs_training:
+            settings = [("nprobe", v) for v in sweep["nprobe"]]
+        elif spec.index_type == "hnsw":
+            settings = [("ef_search", v) for v in sweep["ef_search"]]
+        else:
+            settings = [(None, None)]
+
+        for name, value in settings:
+            if name is not None:
+                setattr(spec, name, value)
+            spec.apply_search_params(index)
+
+            started = time.perf_counter()
+            _, found = index.search(queries, top_k)
+            elapsed = time.perf_counter() - started
+
+            hits = sum(len(set(f) & set(t)) for f, t in zip(found.tolist(), truth.tolist()))
+            rows.append({
+                "index_type": spec.index_type,
+                "factory": spec.factory_string(dim, min(len(vectors), spec.train_size)),
+                "search_param": f"{name}={value}" if name else "",
+                f"recall@{top_k}": hits / (len(queries) * top_k),
+                "ms_per_query": elapsed * 1000.0 / len(queries),
+                "train_s": train_s,
+                "index_mb": index_nbytes(index) / (1024 * 1024),
+            })
+    return rows
+
+
+def print_report(rows: List[dict]):
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    print(" | ".join(columns))
+    for row in rows:
+        print(" | ".join(f"{row[c]:.4f}" if isinstance(row[c], float) else str(row[c]) for c in columns))
@@ -1,21 +1,54 @@
 # streamlit run frontend_demo.py
 # for running the frontend demo
 
+import uuid
+
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 from streamlit.components.v1 import html
 
+AUTOCOMPLETE_URL = "http://127.0.0.1:8000/autocomplete"
+
 st.title("Text Autocompletion Demo")
 
+@st.cache_resource
+def http_session() -> requests.Session:
+    """One keep-alive connection pool for all reruns, instead of a new TCP connection per request."""
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return session
+
+def fetch_completion(text: str):
+    """The server's suggestion for `text`; None if a newer request of this session replaced it (409)."""
+    payload = {
+        "text_before_cursor": text,
+        "max_length": 50,
+        # Lets the server re-use this editor's KV cache and cancel its obsolete requests
+        "session_id": st.session_state.session_id
+    }
+    response = http_session().post(AUTOCOMPLETE_URL, json=payload, timeout=10)
+    if response.status_code == 409:
+        return None
+    if response.status_code != 200:
+        st.error(f"Error: {response.status_code}")
+        return ''
+    return response.json()["completion"]
+
 # Initialize session state for storing completion
 if 'completion' not in st.session_state:
     st.session_state.completion = ''
 if 'accepted_text' not in st.session_state:
     st.session_state.accepted_text = ''
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if 'edited' not in st.session_state:
+    st.session_state.edited = False
 
 def on_text_change():
     # Clear completion when text changes
     st.session_state.completion = ''
+    st.session_state.edited = True
 
 text_area_container = st.empty()
 user_text = text_area_container.text_area(
@@ -46,18 +79,19 @@ if st.session_state.accepted_text:
     )
     st.session_state.accepted_text = ''
 
-if st.button("Get Suggestion") or st.session_state.completion:
+# st.text_area only reruns the script when the text is committed (blur or Ctrl+Enter), so
+# this requests one suggestion per committed edit, not per keystroke
+live = st.checkbox("Suggest on edit", value=True)
+status = st.empty()
+
+if st.button("Get Suggestion") or st.session_state.completion or (live and st.session_state.edited):
     if not st.session_state.completion:  # Only make API call if no completion exists
-        payload = {
-            "text_before_cursor": user_text,
-            "max_length": 50
-        }
-        response = requests.post("http://127.0.0.1:8000/autocomplete", json=payload)
-        if response.status_code == 200:
-            st.session_state.completion = response.json()["completion"]
-        else:
-            st.error(f"Error: {response.status_code}")
-            st.session_state.completion = ''
+        status.caption("Fetching suggestion...")
+        st.session_state.edited = False
+        completion = fetch_completion(user_text)
+        status.empty()
+        if completion is not None:
+            st.session_state.completion = completion
 
     # Display text with suggestion
     if st.session_state.completion:
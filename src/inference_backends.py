@@ -0,0 +1,278 @@
+# inference_backends.py
+# Ways of running GPT-2 for AutocompleteModel on CPU: eager PyTorch (full precision), int8
+# dynamic-quantized linear layers, or a TorchScript-traced decode step with our own decode loop.
+
+import io
+import os
+from typing import Optional, Tuple
+
+import torch
+from transformers import GPT2LMHeadModel
+from transformers.generation.logits_process import (
+    LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+)
+from transformers.pytorch_utils import Conv1D
+
+from kv_cache import crop_past
+
+BACKENDS = ("eager", "int8", "torchscript")
+
+# Legacy transformers cache layout: one (key, value) pair per layer,
+# each [batch, heads, seq, head_dim]. This is what the prefix cache stores for every backend.
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def module_nbytes(module: torch.nn.Module) -> int:
+    """Serialized size of a module's weights, including packed int8 weights that are not parameters."""
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+class EagerBackend:
+    """Full-precision GPT2LMHeadModel, decoded with transformers' `generate`."""
+    name = "eager"
+
+    def __init__(self, model_path: str):
+        self.model = GPT2LMHeadModel.from_pretrained(model_path)
+        self.model.eval()
+        self.config = self.model.config
+
+    def forward(self, input_ids: torch.Tensor, past=None):
+        """
+        Logits for every position of a single unpadded sequence, and the extended cache in this
+        backend's own layout (see `from_legacy` / `crop`).
+        """
+        with torch.no_grad():
+            out = self.model(input_ids, past_key_values=past, use_cache=True)
+        return out.logits, out.past_key_values
+
+    def from_legacy(self, past_key_values: Optional[PastKeyValues]):
+        return past_key_values
+
+    def crop(self, past, length: int):
+        return crop_past(past, length)
+
+    def prefill(self, input_ids: torch.Tensor, past_key_values: Optional[PastKeyValues] = None) -> PastKeyValues:
+        """Run a single prompt's tokens through the model and return the extended KV cache."""
+        return self.forward(input_ids, past_key_values)[1]
+
+    def generate(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, **kwargs) -> torch.Tensor:
+        """Same arguments and return value (prompt + new token ids) as `GPT2LMHeadModel.generate`."""
+        with torch.no_grad():
+            return self.model.generate(input_ids, attention_mask=attention_mask, **kwargs)
+
+    def nbytes(self) -> int:
+        return module_nbytes(self.model)
+
+
+def conv1d_to_linear(module: torch.nn.Module):
+    """
+    GPT-2 implements its projections as transformers' Conv1D (a transposed Linear), which
+    quantize_dynamic does not recognise. Swap them for equivalent nn.Linear layers in place.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+
+
+class Int8Backend(EagerBackend):
+    """
+    Eager decoding with int8 dynamic quantization of every linear layer (attention, MLP and the
+    LM head): weights are stored as int8 and activations are quantized on the fly per batch.
+    """
+    name = "int8"
+
+    def __init__(self, model_path: str):
+        super().__init__(model_path)
+        conv1d_to_linear(self.model)
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class _DecodeStep(torch.nn.Module):
+    """One forward pass with the KV cache as a single [layers, 2, batch, heads, seq, head_dim] tensor."""
+    def __init__(self, model: GPT2LMHeadModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids, past):
+        past_key_values = tuple((past[i, 0], past[i, 1]) for i in range(past.shape[0]))
+        logits, presents = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True
+        )[:2]
+        return logits, torch.stack([torch.stack(kv) for kv in presents])
+
+
+class TorchScriptBackend:
+    """
+    A TorchScript-traced decode step (prompt prefill and single-token steps share one graph)
+    driven by `decode_loop` below instead of transformers' `generate`. If `export_path` is set,
+    the traced graph is saved there and loaded from it on the next start.
+    """
+    name = "torchscript"
+
+    def __init__(self, model_path: str, export_path: Optional[str] = None):
+        model = GPT2LMHeadModel.from_pretrained(model_path, torchscript=True)
+        model.eval()
+        self.config = model.config
+        self.num_layers = self.config.n_layer
+        self.num_heads = self.config.n_head
+        self.head_dim = self.config.n_embd // self.config.n_head
+        # Defaults of `generate` that the decode loop has to reproduce
+        self.top_k = model.generation_config.top_k
+
+        if export_path is not None and os.path.exists(export_path):
+            print(f"Loading traced model from {export_path}")
+            self.step = torch.jit.load(export_path)
+        else:
+            self.step = self.trace(model)
+            if export_path is not None:
+                torch.jit.save(self.step, export_path)
+        self.step.eval()
+
+    def trace(self, model: GPT2LMHeadModel) -> torch.jit.ScriptModule:
+        # Shapes in the example inputs are arbitrary; the graph works for any batch/prompt/cache length
+        batch, past_len, new_len = 2, 3, 2
+        example = (
+            torch.zeros((batch, new_len), dtype=torch.long),
+            torch.ones((batch, past_len + new_len), dtype=torch.long),
+            torch.arange(past_len, past_len + new_len).expand(batch, new_len),
+            self.empty_past(batch, past_len),
+        )
+        with torch.no_grad():
+            return torch.jit.trace(_DecodeStep(model), example, check_trace=False)
+
+    def empty_past(self, batch: int, length: int = 0) -> torch.Tensor:
+        return torch.zeros((self.num_layers, 2, batch, self.num_heads, length, self.head_dim))
+
+    def to_stacked(self, past_key_values: Optional[PastKeyValues], batch: int) -> torch.Tensor:
+        if past_key_values is None:
+            return self.empty_past(batch)
+        return torch.stack([torch.stack(kv) for kv in past_key_values])
+
+    def forward(self, input_ids: torch.Tensor, past=None):
+        """Like EagerBackend.forward; the cache stays one stacked tensor between calls."""
+        if past is None:
+            past = self.empty_past(input_ids.shape[0])
+        past_len = past.shape[4]
+        attention_mask = torch.ones((input_ids.shape[0], past_len + input_ids.shape[1]), dtype=torch.long)
+        position_ids = torch.arange(past_len, past_len + input_ids.shape[1]).expand_as(input_ids)
+        with torch.no_grad():
+            return self.step(input_ids, attention_mask, position_ids, past)
+
+    def from_legacy(self, past_key_values: Optional[PastKeyValues]):
+        return None if past_key_values is None else self.to_stacked(past_key_values, 1)
+
+    def crop(self, past: torch.Tensor, length: int) -> torch.Tensor:
+        return past[:, :, :, :, :length, :]
+
+    def prefill(self, input_ids: torch.Tensor, past_key_values: Optional[PastKeyValues] = None) -> PastKeyValues:
+        _, past = self.forward(input_ids, self.from_legacy(past_key_values))
+        return tuple((past[i, 0], past[i, 1]) for i in range(past.shape[0]))
+
+    def generate(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, **kwargs) -> torch.Tensor:
+        with torch.no_grad():
+            return decode_loop(self, input_ids, attention_mask, **kwargs)
+
+    def nbytes(self) -> int:
+        return module_nbytes(self.step)
+
+
+def decode_loop(
+    backend: TorchScriptBackend,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    past_key_values: Optional[PastKeyValues] = None,
+    max_new_tokens: int = 50,
+    pad_token_id: Optional[int] = None,
+    temperature: float = 1.0,
+    top_p: float = 1.0,
+    do_sample: bool = True,
+    num_return_sequences: int = 1,
+    streamer=None,
+    logits_processor=None,
+    stopping_criteria=None
+) -> torch.Tensor:
+    """
+    Greedy or top-k/top-p sampling over the traced step, with the same arguments, logits
+    processors/warpers and return value as `generate`. `past_key_values` may cover a prefix of a
+    single prompt (all but its last token, as the prefix cache stores it); the rest is prefilled here.
+    """
+    eos_token_id = backend.config.eos_token_id
+    if pad_token_id is None:
+        pad_token_id = eos_token_id
+    batch = input_ids.shape[0]
+
+    warpers = LogitsProcessorList()
+    if do_sample:
+        if temperature != 1.0:
+            warpers.append(TemperatureLogitsWarper(temperature))
+        if backend.top_k:
+            warpers.append(TopKLogitsWarper(backend.top_k))
+        if top_p < 1.0:
+            warpers.append(TopPLogitsWarper(top_p))
+
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    # 1) Prefill whatever the cache does not cover yet; left padding is masked out and
+    #    positions count only real tokens, as in `generate`
+    past = backend.to_stacked(past_key_values, batch)
+    past_len = past.shape[4]
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    logits, past = backend.step(input_ids[:, past_len:], attention_mask, position_ids[:, past_len:], past)
+    logits = logits[:, -1, :]
+
+    sequences = input_ids
+    finished = torch.zeros(batch, dtype=torch.bool)
+    next_position = position_ids[:, -1:] + 1
+    for _ in range(max_new_tokens):
+        # 2) Pick the next token
+        scores = logits if logits_processor is None else logits_processor(sequences, logits)
+        if do_sample:
+            scores = warpers(sequences, scores)
+            next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(scores, dim=-1)
+        # Sequences that already ended keep emitting padding
+        next_tokens = torch.where(finished, torch.full_like(next_tokens, pad_token_id), next_tokens)
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+        if streamer is not None:
+            streamer.put(next_tokens.cpu())
+
+        finished = finished | (next_tokens == eos_token_id)
+        if stopping_criteria is not None and stopping_criteria(sequences, scores):
+            break
+        if finished.all():
+            break
+
+        # 3) Feed it back through the cached step
+        attention_mask = torch.cat([attention_mask, torch.ones((batch, 1), dtype=attention_mask.dtype)], dim=-1)
+        logits, past = backend.step(next_tokens[:, None], attention_mask, next_position, past)
+        logits = logits[:, -1, :]
+        next_position = next_position + 1
+
+    if streamer is not None:
+        streamer.end()
+    return sequences
+
+
+def load_backend(name: str, model_path: str, export_path: Optional[str] = None):
+    """Create the backend called `name` (one of BACKENDS) for the model at `model_path`."""
+    if name == "eager":
+        return EagerBackend(model_path)
+    if name == "int8":
+        return Int8Backend(model_path)
+    if name == "torchscript":
+        return TorchScriptBackend(model_path, export_path=export_path)
+    raise ValueError(f"Unknown inference backend {name!r}, expected one of {BACKENDS}")
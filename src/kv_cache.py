@@ -0,0 +1,137 @@
+# kv_cache.py
+# Per-session prefix cache of GPT-2 past_key_values, so successive keystrokes from the same
+# editor session only run prefill over the part of the prompt that changed.
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import torch
+
+# Legacy HF cache format: one (key, value) pair per layer, each (batch, heads, seq_len, head_dim)
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def crop_past(past: PastKeyValues, length: int) -> PastKeyValues:
+    """Keep only the first `length` positions of a cache."""
+    return tuple((k[:, :, :length, :], v[:, :, :length, :]) for k, v in past)
+
+
+def expand_past(past: PastKeyValues, batch: int) -> PastKeyValues:
+    """Share a single prompt's cache across `batch` rows (views, no copy)."""
+    return tuple((k.expand(batch, -1, -1, -1), v.expand(batch, -1, -1, -1)) for k, v in past)
+
+
+def past_nbytes(past: PastKeyValues) -> int:
+    return sum(t.numel() * t.element_size() for layer in past for t in layer)
+
+
+@dataclass
+class CacheEntry:
+    token_ids: List[int]   # the full prompt the cache was built for
+    past: PastKeyValues    # covers token_ids[:cached_len]
+    cached_len: int
+    nbytes: int
+
+
+class PrefixCache:
+    """
+    LRU map of session id -> (prompt token ids, past_key_values), bounded by total tensor memory.
+    """
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Session prompts decoded without the cache (in a padded batch), see record_skip
+        self.skipped = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def lookup(self, session_id: str, token_ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        """
+        Return (n, past) where `past` covers the first n tokens of `token_ids`, using the longest
+        prefix shared with the session's previous prompt. n is at most len(token_ids) - 1 so the
+        caller always has at least one token left to feed to `generate`.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                self._entries.move_to_end(session_id)
+
+        if entry is None:
+            reuse = 0
+        else:
+            reuse = min(
+                common_prefix_length(entry.token_ids, token_ids),
+                entry.cached_len,
+                len(token_ids) - 1
+            )
+
+        with self._lock:
+            if reuse > 0:
+                self.hits += 1
+                self.reused_tokens += reuse
+            else:
+                self.misses += 1
+            self.prefilled_tokens += max(0, len(token_ids) - 1 - reuse)
+
+        if reuse <= 0:
+            return 0, None
+        if reuse == entry.cached_len:
+            return reuse, entry.past
+        return reuse, crop_past(entry.past, reuse)
+
+    def store(self, session_id: str, token_ids: List[int], past: PastKeyValues, cached_len: int):
+        nbytes = past_nbytes(past)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            self._entries[session_id] = CacheEntry(list(token_ids), past, cached_len, nbytes)
+            self.total_bytes += nbytes
+
+            # Evict least recently used sessions until we are back under the memory cap
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def record_skip(self):
+        """Count a session prompt that was decoded in a padded batch, bypassing the cache."""
+        with self._lock:
+            self.skipped += 1
+
+    def drop(self, session_id: str):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self.total_bytes -= entry.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+                "prefilled_tokens": self.prefilled_tokens,
+            }
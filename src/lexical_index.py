@@ -0,0 +1,79 @@
+# lexical_index.py
+# BM25 over the RAG chunks: an inverted index from lower-cased word terms to the chunks that
+# contain them. Querying it needs no embedding, and exact names and entities ("Starmer",
+# "Ofcom", "FTSE 100") weigh more than they do in dense similarity.
+
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+_TERM = re.compile(r"\w+")
+# Frequent function words: they barely change BM25 scores but have the longest postings
+STOPWORDS = frozenset(
+    "a about after all also an and are as at be been but by can could did do does for from had has have he "
+    "her his i if in into is it its more my no not of on or our she so than that the their them then there "
+    "these they this to up was we were what when which who will with would you your".split()
+)
+
+
+def terms(text: str) -> List[str]:
+    return [term for term in _TERM.findall(text.lower()) if term not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    Okapi BM25 over (vector id, chunk text) pairs. Each term's postings are two arrays, the
+    chunk rows that contain it and their weight with idf, tf saturation and length
+    normalisation already applied, so a query only sums precomputed weights per posting.
+    The index is immutable: RAGHelper builds a new one when the chunks change.
+    """
+    def __init__(self, chunks: Iterable[Tuple[int, str]], k1: float = 1.2, b: float = 0.75):
+        ids: List[int] = []
+        lengths: List[int] = []
+        rows_by_term: Dict[str, List[int]] = {}
+        tfs_by_term: Dict[str, List[int]] = {}
+        for row, (vector_id, text) in enumerate(chunks):
+            counts = Counter(terms(text))
+            ids.append(vector_id)
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                rows_by_term.setdefault(term, []).append(row)
+                tfs_by_term.setdefault(term, []).append(tf)
+
+        self.ids = np.asarray(ids, dtype=np.int64)
+        doc_lengths = np.asarray(lengths, dtype=np.float32)
+        avg_length = float(doc_lengths.mean()) if len(doc_lengths) and doc_lengths.mean() > 0 else 1.0
+        n = len(ids)
+
+        # term -> (rows, weights)
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for term, rows in rows_by_term.items():
+            rows = np.asarray(rows, dtype=np.int32)
+            tf = np.asarray(tfs_by_term[term], dtype=np.float32)
+            idf = math.log(1.0 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = k1 * (1.0 - b + b * doc_lengths[rows] / avg_length)
+            self.postings[term] = (rows, (idf * tf * (k1 + 1.0) / (tf + norm)).astype(np.float32))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """(vector id, score) of the best `top_k` chunks sharing at least one term with `query`."""
+        if not len(self.ids):
+            return []
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term, count in Counter(terms(query)).items():
+            posting = self.postings.get(term)
+            if posting is not None:
+                rows, weights = posting
+                # Terms repeated in the query count more, with saturation (k3 = 1.2)
+                scores[rows] += weights * (2.2 * count / (1.2 + count))
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            matched = matched[np.argpartition(-scores[matched], top_k)[:top_k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(int(self.ids[row]), float(scores[row])) for row in matched]
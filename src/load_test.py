@@ -0,0 +1,305 @@
+# load_test.py
+# Load test for the autocomplete service. Contexts from the eval split are "typed" into the
+# service as growing prefixes, either by a fixed number of concurrent typists (closed loop) or
+# at a fixed arrival rate (open loop), and latency, throughput, shed/error rates and
+# time-to-first-token are reported and saved as JSON so runs can be compared across commits.
+#
+#   python load_test.py --in-process --concurrency 8 --duration 60
+#   python load_test.py --url http://localhost:8000 --rate 20 --stream --output results.json
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import socket
+import subprocess
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import httpx
+
+from data_preparation import read_records
+
+
+def load_contexts(file_path: str, num_contexts: int, seed: int = 0) -> List[str]:
+    contexts = [record["context"] for record in read_records(file_path)]
+    random.Random(seed).shuffle(contexts)
+    return contexts[:num_contexts]
+
+
+def typing_prefixes(context: str, step_chars: int, min_chars: int) -> List[str]:
+    """The prefixes a user typing `context` would send, one every `step_chars` characters."""
+    ends = list(range(min(min_chars, len(context)), len(context), step_chars)) + [len(context)]
+    return [context[:end] for end in ends if end > 0]
+
+
+def keystrokes(
+    contexts: List[str], step_chars: int, min_chars: int, name: str = "load"
+) -> Iterator[Tuple[str, str]]:
+    """(session id, prefix) for every context in turn, cycling through the contexts forever."""
+    for n in itertools.count():
+        context = contexts[n % len(contexts)]
+        session_id = f"{name}-{n}"
+        for prefix in typing_prefixes(context, step_chars, min_chars):
+            yield session_id, prefix
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def at(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": at(0.50),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": values[-1],
+    }
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, args: argparse.Namespace):
+        self.client = client
+        self.args = args
+        self.results: List[dict] = []
+
+    def payload(self, session_id: str, prefix: str) -> dict:
+        payload = {"text_before_cursor": prefix, "max_length": self.args.max_length}
+        if self.args.sessions:
+            payload["session_id"] = session_id
+        if self.args.greedy:
+            payload["greedy"] = True
+        return payload
+
+    async def send(self, session_id: str, prefix: str):
+        """One request; records its status, latency and (for streams) time to first token."""
+        started = time.perf_counter()
+        result = {
+            "status": None, "latency_ms": None, "ttft_ms": None, "error": None, "source": None, "superseded": False
+        }
+        try:
+            if self.args.stream:
+                await self.send_stream(self.payload(session_id, prefix), started, result)
+            else:
+                response = await self.client.post("/autocomplete", json=self.payload(session_id, prefix))
+                result["status"] = response.status_code
+                body = response.json()
+                if "error" in body:
+                    result["error"] = body["error"]
+                result["source"] = body.get("source")
+                result["superseded"] = body.get("superseded", False)
+        except httpx.HTTPError as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        except ValueError as e:
+            # Not JSON, e.g. a proxy's 502 page or a plain-text 500; the status is already recorded
+            result["error"] = f"invalid response body: {e}"
+        result["latency_ms"] = (time.perf_counter() - started) * 1000.0
+        self.results.append(result)
+
+    async def send_stream(self, payload: dict, started: float, result: dict):
+        async with self.client.stream("POST", "/autocomplete/stream", json=payload) as response:
+            result["status"] = response.status_code
+            if response.status_code != 200:
+                result["error"] = (await response.aread()).decode("utf-8", "replace")
+                return
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    if event == "token" and result["ttft_ms"] is None:
+                        result["ttft_ms"] = (time.perf_counter() - started) * 1000.0
+                elif line.startswith("data: ") and event == "error":
+                    data = json.loads(line[len("data: "):])
+                    result["error"] = data.get("error")
+                    result["superseded"] = data.get("superseded", False)
+                elif line.startswith("data: ") and event == "done":
+                    data = json.loads(line[len("data: "):])
+                    result["source"] = data.get("source")
+                    result["superseded"] = data.get("superseded", False)
+
+    async def closed_loop(self, contexts: List[str]):
+        """
+        `concurrency` typists, each typing its own contexts (dealt round-robin) in its own
+        sessions and sending its next prefix once the previous answer arrived.
+        """
+        deadline = time.perf_counter() + self.args.duration
+
+        async def typist(n: int):
+            own = contexts[n::self.args.concurrency] or [contexts[n % len(contexts)]]
+            strokes = keystrokes(own, self.args.step_chars, self.args.min_chars, name=f"load-{n}")
+            while time.perf_counter() < deadline:
+                session_id, prefix = next(strokes)
+                await self.send(session_id, prefix)
+                if self.args.think_ms > 0:
+                    await asyncio.sleep(self.args.think_ms / 1000.0)
+
+        await asyncio.gather(*(typist(n) for n in range(self.args.concurrency)))
+
+    async def open_loop(self, contexts: List[str]):
+        """
+        Poisson arrivals at `rate` requests/s, whether or not earlier requests have finished.
+        Successive prefixes of one session can therefore overlap, and the newer one supersedes
+        the older (409) when sessions are sent, as with a user typing faster than the service answers.
+        """
+        deadline = time.perf_counter() + self.args.duration
+        strokes = keystrokes(contexts, self.args.step_chars, self.args.min_chars)
+        rng = random.Random(self.args.seed)
+        pending = set()
+        next_at = time.perf_counter()
+        while next_at < deadline:
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            task = asyncio.create_task(self.send(*next(strokes)))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            next_at += rng.expovariate(self.args.rate)
+        if pending:
+            await asyncio.gather(*pending)
+
+    def report(self, elapsed_s: float) -> dict:
+        ok, shed, timed_out, superseded, failed = [], [], [], [], []
+        for r in self.results:
+            if r["superseded"]:
+                superseded.append(r)    # a newer keystroke of the same session replaced it
+            elif r["status"] == 429:
+                shed.append(r)          # rejected by admission control
+            elif r["status"] == 503:
+                timed_out.append(r)     # request deadline exceeded
+            elif r["status"] == 200 and r["error"] is None:
+                ok.append(r)
+            else:
+                failed.append(r)
+        n = len(self.results) or 1
+        # "phrase_index" (fast path), "cache" (result cache) or "model"
+        sources = sorted({r["source"] for r in ok if r["source"] is not None})
+        return {
+            "requests": len(self.results),
+            "elapsed_s": elapsed_s,
+            "throughput_rps": len(self.results) / elapsed_s,
+            "goodput_rps": len(ok) / elapsed_s,
+            "shed_rate": len(shed) / n,
+            "deadline_rate": len(timed_out) / n,
+            "superseded_rate": len(superseded) / n,
+            "error_rate": len(failed) / n,
+            "latency_ms": percentiles([r["latency_ms"] for r in ok]),
+            "ttft_ms": percentiles([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]),
+            "phrase_index_rate": sum(r["source"] == "phrase_index" for r in ok) / (len(ok) or 1),
+            "latency_ms_by_source": {
+                source: percentiles([r["latency_ms"] for r in ok if r["source"] == source]) for source in sources
+            },
+            "errors": sorted({str(r["error"] or r["status"]) for r in failed})[:10],
+        }
+
+
+def start_in_process_server() -> Tuple[str, threading.Thread]:
+    """Import the app and serve it with uvicorn on a free local port, in a background thread."""
+    import uvicorn
+    from server import app
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="load-test-server", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", thread
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace, base_url: str) -> dict:
+    contexts = load_contexts(args.data, args.num_contexts, args.seed)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=max(args.concurrency, 32))
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout_s, limits=limits) as client:
+        test = LoadTest(client, args)
+        # A few requests first so model/index warm-up is not measured
+        for prefix in typing_prefixes(contexts[0], args.step_chars, args.min_chars)[:args.warmup]:
+            await test.send("warmup", prefix)
+        test.results.clear()
+
+        started = time.perf_counter()
+        if args.rate:
+            await test.open_loop(contexts)
+        else:
+            await test.closed_loop(contexts)
+        report = test.report(time.perf_counter() - started)
+
+        try:
+            report["server_stats"] = (await client.get("/scheduler/stats")).json()
+        except (httpx.HTTPError, ValueError):
+            report["server_stats"] = None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay eval contexts as typing against the autocomplete service.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://localhost:8000", help="service to test")
+    target.add_argument("--in-process", action="store_true", help="start server.py's app in this process")
+    parser.add_argument("--data", default="../data/processed/bbc_context_pairs_eval",
+                        help="JSONL file or sharded split directory from data_preparation.py")
+    parser.add_argument("--num-contexts", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8, help="closed loop: concurrent typists")
+    parser.add_argument("--rate", type=float, default=0.0, help="open loop: requests/s (overrides --concurrency)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to send requests for")
+    parser.add_argument("--step-chars", type=int, default=8, help="characters typed between requests")
+    parser.add_argument("--min-chars", type=int, default=20, help="length of the first prefix sent")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="closed loop: pause between keystrokes")
+    parser.add_argument("--max-length", type=int, default=20)
+    parser.add_argument("--stream", action="store_true", help="use /autocomplete/stream and measure TTFT")
+    parser.add_argument("--greedy", action="store_true", help="greedy (cacheable) decoding")
+    parser.add_argument("--no-sessions", dest="sessions", action="store_false",
+                        help="do not send session ids (no prefix cache / retrieval reuse)")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--timeout-s", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    base_url = args.url
+    if args.in_process:
+        base_url, _ = start_in_process_server()
+    print(f"Load testing {base_url} ({'open loop at %.1f req/s' % args.rate if args.rate else '%d typists' % args.concurrency})")
+
+    report = asyncio.run(run(args, base_url))
+    report["config"] = vars(args)
+    report["commit"] = git_commit()
+    report["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    print("============ LOAD TEST ============")
+    print(f"requests: {report['requests']} in {report['elapsed_s']:.1f}s "
+          f"({report['throughput_rps']:.2f} req/s, {report['goodput_rps']:.2f} ok/s)")
+    print(f"shed: {report['shed_rate']:.2%}  deadline: {report['deadline_rate']:.2%}  "
+          f"superseded: {report['superseded_rate']:.2%}  errors: {report['error_rate']:.2%}")
+    for name in ("latency_ms", "ttft_ms"):
+        stats = report[name]
+        if stats["count"]:
+            print(f"{name}: p50 {stats['p50']:.1f}  p95 {stats['p95']:.1f}  p99 {stats['p99']:.1f}  max {stats['max']:.1f}")
+    for source, stats in report["latency_ms_by_source"].items():
+        print(f"  {source}: {stats['count']} requests, p50 {stats['p50']:.1f}  p95 {stats['p95']:.1f}")
+    if report["latency_ms_by_source"]:
+        print(f"answered by the phrase index: {report['phrase_index_rate']:.2%}")
+    for error in report["errors"]:
+        print(f"  error: {error}")
+    print("===================================")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
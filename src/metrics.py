@@ -0,0 +1,226 @@
+# metrics.py
+# In-process counters, gauges and histograms rendered in the Prometheus text format for the
+# server's /metrics endpoint, plus `span` for timing the stages of a request.
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds, from a cache hit to a slow generate
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TOKEN_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+RATE_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """A value read from `callback` at scrape time (queue depth, cache size, ...)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        try:
+            value = float(self.callback())
+        except Exception:
+            return []
+        return [f"{self.name} {value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            # Re-registering (e.g. a module reloaded) replaces the old metric
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, callback: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help_text, callback))
+
+    def histogram(
+        self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "autocomplete_stage_seconds",
+    "Time spent per request stage (retrieve, embed, faiss_search, tokenize, prefill, decode, ...)",
+    labels=("stage",)
+)
+PROMPT_TOKENS = REGISTRY.histogram(
+    "autocomplete_prompt_tokens", "Prompt length in tokens, per completion", buckets=TOKEN_BUCKETS
+)
+GENERATED_TOKENS = REGISTRY.counter("autocomplete_generated_tokens_total", "Tokens decoded, over all completions")
+DECODE_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "autocomplete_decode_tokens_per_second", "Decode throughput of each generate call (tokens/s over all rows)",
+    buckets=RATE_BUCKETS
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "autocomplete_cache_requests_total", "Result cache lookups", labels=("cache", "result")
+)
+PHRASE_INDEX_LOOKUPS = REGISTRY.counter(
+    "autocomplete_phrase_index_lookups_total", "Phrase-index fast path lookups", labels=("result",)
+)
+COMPLETION_SECONDS = REGISTRY.histogram(
+    "autocomplete_completion_seconds", "/autocomplete latency by what answered (phrase_index, cache or model)",
+    labels=("source",)
+)
+SUPERSEDED_REQUESTS = REGISTRY.counter(
+    "autocomplete_superseded_requests_total",
+    "Requests stopped because a newer one of the same session arrived, by the stage they stopped in",
+    labels=("stage",)
+)
+PREFIX_CACHE_SKIPPED = REGISTRY.counter(
+    "autocomplete_prefix_cache_skipped_total",
+    "Session completions decoded in a padded batch, without reading or updating their prefix KV cache"
+)
+SKIPPED_DECODE_TOKENS = REGISTRY.counter(
+    "autocomplete_skipped_decode_tokens_total", "max_length minus tokens decoded, over superseded decodes"
+)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time the enclosed block into autocomplete_stage_seconds{stage=...}."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def record_cache_lookup(cache: str, value) -> Optional[object]:
+    """Count a result cache lookup as a hit or miss and pass the value through."""
+    CACHE_REQUESTS.inc(cache=cache, result="miss" if value is None else "hit")
+    return value
+
+
+def process_memory(pid="self") -> dict:
+    """
+    Resident memory of a process in bytes from /proc/<pid>/smaps_rollup (Linux; {} elsewhere):
+    rss, pss (shared pages divided among the processes mapping them), shared and private.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return {}
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
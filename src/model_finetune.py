@@ -1,65 +1,313 @@
-# train.py
+# model_finetune.py
+# Fine-tune GPT-2 on the context/continuation train split. The split is tokenized once into a
+# memory-mapped token-id file (reused until the data or tokenizer changes), and training reads
+# fixed-length blocks packed from documents separated by EOS, so no compute goes to padding.
+# Inside a block each document only attends to itself and its positions restart at 0.
+#
+#   python model_finetune.py --block-size 512 --batch-size 8 --grad-accum 4
+#   python model_finetune.py --no-packing --group-by-length   # one padded example per document
 
-import os
+import argparse
+import hashlib
 import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
 import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer, Trainer, TrainingArguments, DataCollatorForLanguageModeling
-
-def load_data_for_finetuning(file_path):
-    # Read JSON lines and prepare them for GPT2
-    # Convert (context, continuation) into a single text sample with a special separator, or just "context + continuation"
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            item = json.loads(line.strip())
-            text = item["context"] + "\n" + item["continuation"]
-            data.append(text)
-    return data
+from torch.utils.data import Dataset
+from transformers import GPT2LMHeadModel, GPT2TokenizerFast, Trainer, TrainerCallback, TrainingArguments
+
+from data_preparation import read_records, split_files
+
+TOKENS_FILE = "tokens.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+TOKENIZE_BATCH = 1000
+IGNORE_INDEX = -100
+
+
+def load_data_for_finetuning(file_path: str) -> Iterator[str]:
+    # Convert (context, continuation) into a single text sample with a "\n" separator
+    for item in read_records(file_path):
+        yield item["context"] + "\n" + item["continuation"]
+
+
+def source_fingerprint(path: str) -> str:
+    """sha256 over the bytes of every file of a split, so the token cache follows the data."""
+    digest = hashlib.sha256()
+    for file_path in split_files(path):
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenize_to_memmap(data_path: str, cache_dir: str, tokenizer, force: bool = False) -> dict:
+    """
+    Tokenize every document of `data_path` into `cache_dir`: tokens.bin holds all token ids
+    back to back, each document followed by EOS, and offsets.npy the start of every document
+    (plus the end). Skipped when meta.json shows the same data and tokenizer. Returns the meta.
+    """
+    meta = {
+        "source": os.path.abspath(data_path),
+        "source_sha256": source_fingerprint(data_path),
+        "tokenizer": tokenizer.name_or_path,
+        "vocab_size": len(tokenizer),
+        "eos_token_id": tokenizer.eos_token_id,
+        "dtype": "uint16" if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else "uint32",
+    }
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not force and os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if all(cached.get(key) == value for key, value in meta.items()):
+            print(f"Reusing {cached['num_tokens']} tokens ({cached['num_docs']} docs) from {cache_dir}")
+            return cached
+
+    # 1) Tokenize in batches and append to a temp file; memory holds one batch and the offsets
+    os.makedirs(cache_dir, exist_ok=True)
+    dtype = np.dtype(meta["dtype"])
+    tmp_path = os.path.join(cache_dir, TOKENS_FILE + ".tmp")
+    offsets = [0]
+    started = time.perf_counter()
+
+    def flush(texts: List[str], out):
+        for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]:
+            ids.append(tokenizer.eos_token_id)
+            out.write(np.asarray(ids, dtype=dtype).tobytes())
+            offsets.append(offsets[-1] + len(ids))
+
+    with open(tmp_path, "wb") as out:
+        batch: List[str] = []
+        for text in load_data_for_finetuning(data_path):
+            batch.append(text)
+            if len(batch) >= TOKENIZE_BATCH:
+                flush(batch, out)
+                batch = []
+        if batch:
+            flush(batch, out)
+
+    # 2) Move into place only once complete, then write the meta that marks the cache valid
+    os.replace(tmp_path, os.path.join(cache_dir, TOKENS_FILE))
+    np.save(os.path.join(cache_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    meta.update({"num_docs": len(offsets) - 1, "num_tokens": offsets[-1]})
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+    elapsed = time.perf_counter() - started
+    print(f"Tokenized {meta['num_docs']} docs into {meta['num_tokens']} tokens in {elapsed:.1f}s -> {cache_dir}")
+    return meta
+
+
+def load_tokens(cache_dir: str, meta: dict):
+    tokens = np.memmap(os.path.join(cache_dir, TOKENS_FILE), dtype=np.dtype(meta["dtype"]), mode="r")
+    offsets = np.load(os.path.join(cache_dir, OFFSETS_FILE))
+    return tokens, offsets
+
+
+class PackedDataset(Dataset):
+    """
+    Consecutive `block_size` windows over the token stream. Each example carries the document
+    index of every token (segment_ids), positions restarting at each document, and labels that
+    skip the first token of a document, so nothing is predicted across an EOS boundary.
+    """
+    def __init__(self, tokens: np.ndarray, eos_token_id: int, block_size: int = 512):
+        self.tokens = tokens
+        self.eos_token_id = eos_token_id
+        self.block_size = block_size
+
+    def __len__(self) -> int:
+        return len(self.tokens) // self.block_size
+
+    def __getitem__(self, i: int) -> Dict[str, torch.Tensor]:
+        ids = np.asarray(self.tokens[i * self.block_size:(i + 1) * self.block_size], dtype=np.int64)
+        # A token after an EOS starts the next document
+        segment_ids = np.concatenate([[0], np.cumsum(ids[:-1] == self.eos_token_id)])
+        starts = np.flatnonzero(np.diff(segment_ids, prepend=-1))
+        position_ids = np.arange(len(ids)) - starts[segment_ids]
+        labels = ids.copy()
+        labels[starts[1:]] = IGNORE_INDEX
+        return {
+            "input_ids": torch.from_numpy(ids),
+            "position_ids": torch.from_numpy(position_ids),
+            "segment_ids": torch.from_numpy(segment_ids),
+            "labels": torch.from_numpy(labels),
+        }
+
+
+class DocumentDataset(Dataset):
+    """One example per document (truncated to `max_length`), for unpacked training."""
+    def __init__(self, tokens: np.ndarray, offsets: np.ndarray, max_length: int = 512):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.max_length = max_length
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> Dict[str, torch.Tensor]:
+        start = int(self.offsets[i])
+        end = min(int(self.offsets[i + 1]), start + self.max_length)
+        return {"input_ids": torch.from_numpy(np.asarray(self.tokens[start:end], dtype=np.int64))}
+
+
+class PadCollator:
+    """Right-pads a batch of DocumentDataset examples; padding is masked out of attention and loss."""
+    def __init__(self, pad_token_id: int):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        length = max(len(f["input_ids"]) for f in features)
+        input_ids = torch.full((len(features), length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), length), dtype=torch.long)
+        for row, f in enumerate(features):
+            input_ids[row, :len(f["input_ids"])] = f["input_ids"]
+            attention_mask[row, :len(f["input_ids"])] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, IGNORE_INDEX)
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+class PackedGPT2LMHeadModel(GPT2LMHeadModel):
+    """
+    GPT2LMHeadModel that also takes `segment_ids` and keeps attention within a document.
+    GPT2Model only accepts a 2D padding mask, so every GPT2Block's forward is wrapped to take
+    the block-diagonal mask instead; the causal part is still applied by the attention.
+    Also counts the tokens it has trained on, for the tokens/sec log.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.tokens_seen = 0
+        self._document_mask: Optional[torch.Tensor] = None
+        for block in self.transformer.h:
+            block.forward = self._with_document_mask(block.forward)
+
+    def _with_document_mask(self, block_forward):
+        # A plain wrapper rather than a kwargs pre-hook, which needs torch >= 2.0
+        def forward(hidden_states, *args, **kwargs):
+            if self._document_mask is not None:
+                if len(args) >= 2:
+                    # Positional call (gradient checkpointing): layer_past, attention_mask, ...
+                    args = (args[0], self._document_mask) + args[2:]
+                else:
+                    kwargs["attention_mask"] = self._document_mask
+            return block_forward(hidden_states, *args, **kwargs)
+        return forward
+
+    def forward(self, input_ids=None, attention_mask=None, position_ids=None, labels=None, segment_ids=None, **kwargs):
+        if input_ids is not None and self.training:
+            self.tokens_seen += int(attention_mask.sum()) if attention_mask is not None else input_ids.numel()
+        if segment_ids is not None:
+            # [batch, 1, query, key], added to the attention scores
+            same_document = segment_ids[:, None, :, None] == segment_ids[:, None, None, :]
+            mask = torch.zeros(same_document.shape, dtype=self.dtype, device=segment_ids.device)
+            self._document_mask = mask.masked_fill(~same_document, torch.finfo(self.dtype).min)
+        try:
+            return super().forward(
+                input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, labels=labels, **kwargs
+            )
+        finally:
+            self._document_mask = None
+
+
+class TokensPerSecondCallback(TrainerCallback):
+    """Prints training throughput in tokens/sec at every logging step."""
+    def __init__(self, model: PackedGPT2LMHeadModel):
+        self.model = model
+        self.started = self.last_time = 0.0
+        self.last_tokens = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.started = self.last_time = time.perf_counter()
+        self.last_tokens = self.model.tokens_seen
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        now = time.perf_counter()
+        tokens = self.model.tokens_seen
+        recent = (tokens - self.last_tokens) / max(now - self.last_time, 1e-9)
+        overall = tokens / max(now - self.started, 1e-9)
+        print(f"step {state.global_step}: {recent:.0f} tokens/s (overall {overall:.0f}, {tokens} tokens)")
+        self.last_time, self.last_tokens = now, tokens
+
 
 def main():
-    model_name = "gpt2"  # or "gpt2-medium", "EleutherAI/gpt-neo-1.3B", etc.
-    tokenizer = GPT2Tokenizer.from_pretrained(model_name)
-    tokenizer.pad_token = tokenizer.eos_token
+    parser = argparse.ArgumentParser(description="Fine-tune GPT-2 on the context/continuation train split.")
+    parser.add_argument("--data", default="../data/processed/bbc_context_pairs_train",
+                        help="JSONL file or sharded split directory from data_preparation.py")
+    parser.add_argument("--cache-dir", default="../data/processed/finetune_tokens", help="token-id cache")
+    parser.add_argument("--retokenize", action="store_true", help="rebuild the token cache")
+    parser.add_argument("--model", default="gpt2", help='or "gpt2-medium", a local checkpoint, ...')
+    parser.add_argument("--output-dir", default="./finetuned_model")
+    parser.add_argument("--block-size", type=int, default=512, help="tokens per packed block / max example length")
+    parser.add_argument("--no-packing", dest="packing", action="store_false",
+                        help="one padded example per document instead of packed blocks")
+    parser.add_argument("--group-by-length", action="store_true",
+                        help="unpacked: batch documents of similar length to cut padding")
+    parser.add_argument("--batch-size", type=int, default=8, help="per-device examples per step")
+    parser.add_argument("--grad-accum", type=int, default=4, help="steps per optimizer update")
+    parser.add_argument("--epochs", type=float, default=1.0)
+    parser.add_argument("--learning-rate", type=float, default=5e-5)
+    parser.add_argument("--max-steps", type=int, default=-1, help="stop after this many updates (overrides --epochs)")
+    parser.add_argument("--logging-steps", type=int, default=10)
+    parser.add_argument("--save-steps", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=0, help="dataloader processes")
+    args = parser.parse_args()
 
-    # 1. Load data
-    train_texts = load_data_for_finetuning("data/processed/bbc_context_pairs.jsonl")
+    tokenizer = GPT2TokenizerFast.from_pretrained(args.model)
+    tokenizer.pad_token = tokenizer.eos_token
 
-    # 2. Tokenize
-    def tokenize_fn(examples):
-        return tokenizer(examples["text"], truncation=True)
+    # 1. Tokenize once into the memory-mapped cache
+    meta = tokenize_to_memmap(args.data, args.cache_dir, tokenizer, force=args.retokenize)
+    tokens, offsets = load_tokens(args.cache_dir, meta)
 
-    # Convert to dataset format for Trainer
-    from datasets import Dataset
-    raw_dataset = Dataset.from_dict({"text": train_texts})
-    tokenized_dataset = raw_dataset.map(lambda x: tokenizer(x["text"], truncation=True), batched=True)
-    
-    # 3. Define data collator
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+    # 2. Packed blocks, or one example per document with dynamic padding
+    if args.packing:
+        train_dataset = PackedDataset(tokens, tokenizer.eos_token_id, args.block_size)
+        data_collator = None
+    else:
+        train_dataset = DocumentDataset(tokens, offsets, args.block_size)
+        data_collator = PadCollator(tokenizer.pad_token_id)
+    print(f"{len(train_dataset)} training examples ({'packed' if args.packing else 'unpacked'}, "
+          f"{args.batch_size * args.grad_accum} examples per update)")
 
-    # 4. Load model
-    model = GPT2LMHeadModel.from_pretrained(model_name)
+    # 3. Load model
+    model = PackedGPT2LMHeadModel.from_pretrained(args.model)
 
-    # 5. Trainer config
+    # 4. Trainer config
     training_args = TrainingArguments(
-        output_dir="./finetuned_model",
+        output_dir=args.output_dir,
         overwrite_output_dir=True,
-        num_train_epochs=1,
-        per_device_train_batch_size=2,
-        save_steps=50,
-        logging_steps=50,
+        num_train_epochs=args.epochs,
+        max_steps=args.max_steps,
+        per_device_train_batch_size=args.batch_size,
+        gradient_accumulation_steps=args.grad_accum,
+        learning_rate=args.learning_rate,
+        group_by_length=args.group_by_length and not args.packing,
+        save_steps=args.save_steps,
+        logging_steps=args.logging_steps,
+        dataloader_num_workers=args.workers,
+        remove_unused_columns=False,
     )
 
-    # 6. Trainer
+    # 5. Trainer
     trainer = Trainer(
         model=model,
         args=training_args,
-        train_dataset=tokenized_dataset,
-        data_collator=data_collator
+        train_dataset=train_dataset,
+        data_collator=data_collator,
+        callbacks=[TokensPerSecondCallback(model)],
     )
 
-    # 7. Train
+    # 6. Train
+    started = time.perf_counter()
     trainer.train()
-    trainer.save_model("./finetuned_model")
+    elapsed = time.perf_counter() - started
+    print(f"Trained on {model.tokens_seen} tokens in {elapsed:.1f}s ({model.tokens_seen / elapsed:.0f} tokens/s)")
+    trainer.save_model(args.output_dir)
+    tokenizer.save_pretrained(args.output_dir)
 
 if __name__ == "__main__":
     main()
@@ -1,60 +1,518 @@
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from transformers import (
+    BatchEncoding, GPT2TokenizerFast, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+)
+import queue
+import threading
+import time
 import torch
-from typing import List
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Union
+
+from inference_backends import load_backend
+from kv_cache import PrefixCache, expand_past
+from metrics import DECODE_TOKENS_PER_SECOND, GENERATED_TOKENS, PROMPT_TOKENS, STAGE_SECONDS, span
+from speculative import SpeculativeStats, prompt_lookup_generate
+from stopping import SuggestionStopper, SuggestionStoppingCriteria, TokenProbabilities
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stops `generate` at the next token once the event is set (e.g. the client went away)."""
+    def __init__(self, stop_event: threading.Event):
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.stop_event.is_set()
+
+
+class GreedyRows(LogitsProcessor):
+    """Leaves only the argmax token for the given batch rows, so sampling picks it deterministically."""
+    def __init__(self, rows: List[int]):
+        self.rows = rows
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row in self.rows:
+            best = int(torch.argmax(scores[row]))
+            best_score = scores[row, best].clone()
+            scores[row] = -float("inf")
+            scores[row, best] = best_score
+        return scores
+
+
+@dataclass
+class Completion:
+    text: str
+    # "eos", "length", "low_confidence", "cancelled" or the granularity it stopped at
+    stop_reason: str
+    # Tokens decoded for this completion
+    num_tokens: int
+    # Mean log-probability per token, when it was tracked (see complete_candidates)
+    score: Optional[float] = None
+
+
+# A retrieved doc is either its text or, when the index stores them, its GPT-2 token ids
+RetrievedDoc = Union[str, List[int]]
+
 
 class AutocompleteModel:
-    def __init__(self, model_path: str = "gpt2"):
-        self.tokenizer = GPT2Tokenizer.from_pretrained(model_path)
-        self.model = GPT2LMHeadModel.from_pretrained(model_path)
-        self.model.eval()
+    def __init__(
+        self,
+        model_path: str = "gpt2",
+        prefix_cache: Optional[PrefixCache] = None,
+        max_prompt_tokens: int = 512,
+        max_doc_tokens: int = 128,
+        backend: str = "eager",
+        export_path: Optional[str] = None,
+        speculative_tokens: int = 0
+    ):
+        # Optional per-session cache of prompt past_key_values (see kv_cache.py)
+        self.prefix_cache = prefix_cache
+        # Token budget of the whole prompt, and of the retrieved docs at its start
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_doc_tokens = max_doc_tokens
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(model_path)
+        # How the model is run: "eager", "int8" or "torchscript" (see inference_backends.py)
+        self.backend = load_backend(backend, model_path, export_path=export_path)
+        # Greedy requests draft up to this many tokens per pass from the prompt and retrieved
+        # chunks (prompt-lookup speculative decoding, see speculative.py); 0 disables it
+        self.speculative_tokens = speculative_tokens
+        self.speculative_stats = SpeculativeStats()
 
         # Set up padding token
         self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.model.config.pad_token_id = self.model.config.eos_token_id
+        self.backend.config.pad_token_id = self.backend.config.eos_token_id
+        # Pad on the left so every prompt in a batch ends right where generation starts
+        self.tokenizer.padding_side = "left"
+
+        # Fixed pieces of the prompt, tokenized once
+        self.doc_separator_ids = self.tokenizer.encode(" ")
+        self.context_marker_ids = self.tokenizer.encode("\n\nContext:")
+
+    def context_ids(self, text: str, budget: int) -> List[int]:
+        """
+        Token ids of the last `budget` tokens of `text`. Only a bounded slice of characters is
+        tokenized, so long documents cost no more than short ones.
+        """
+        if budget <= 0:
+            return []
+        # GPT-2 tokens average ~4 characters; 8 per token leaves plenty of slack
+        max_chars = budget * 8
+        if len(text) <= max_chars:
+            return self.tokenizer.encode(text)[-budget:]
+        # The first token of the slice may be a cut-off word, so drop it
+        return self.tokenizer.encode(text[-max_chars:])[1:][-budget:]
+
+    def build_prompt_ids(self, prompt: str, retrieved_docs: List[RetrievedDoc] = None) -> List[int]:
+        """
+        Assemble the prompt directly as token ids within max_prompt_tokens: up to
+        max_doc_tokens of retrieved docs first, then as much of the most recent context as fits.
+        The context is truncated on the left, so the text right before the cursor is always kept.
+        Docs that arrive as token ids (pre-tokenized in the index) are not tokenized again.
+        """
+        doc_ids: List[int] = []
+        for doc in retrieved_docs or []:
+            if len(doc_ids) >= self.max_doc_tokens:
+                break
+            if doc_ids:
+                doc_ids.extend(self.doc_separator_ids)
+            doc_ids.extend(doc if isinstance(doc, list) else self.tokenizer.encode(doc))
+
+        if not doc_ids:
+            ids = self.context_ids(prompt, self.max_prompt_tokens)
+        else:
+            doc_ids = doc_ids[:self.max_doc_tokens] + self.context_marker_ids
+            # Layout: "<docs>\n\nContext: <prompt>"
+            ids = doc_ids + self.context_ids(" " + prompt, self.max_prompt_tokens - len(doc_ids))
+        # generate() needs at least one prompt token
+        return ids or [self.tokenizer.eos_token_id]
+
+    def encode_prompts(self, prompts: List[str], retrieved_docs: List[List[RetrievedDoc]]):
+        """Left-padded input_ids / attention_mask tensors for a batch of prompts."""
+        with span("tokenize"):
+            id_lists = [self.build_prompt_ids(p, docs) for p, docs in zip(prompts, retrieved_docs)]
+        for ids in id_lists:
+            PROMPT_TOKENS.observe(len(ids))
+        width = max(len(ids) for ids in id_lists)
+        input_ids = torch.full((len(id_lists), width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(id_lists), width), dtype=torch.long)
+        for row, ids in enumerate(id_lists):
+            input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, width - len(ids):] = 1
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": attention_mask})
+
+    def new_stopper(
+        self,
+        stop_at: Optional[str] = None,
+        min_prob: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        cancel: Optional[threading.Event] = None
+    ) -> SuggestionStopper:
+        return SuggestionStopper(
+            self.tokenizer, stop_at=stop_at, min_prob=min_prob, max_tokens=max_tokens, cancel=cancel
+        )
 
     def generate_text(
-        self, 
-        prompt: str, 
-        retrieved_docs: List[str] = None, 
-        max_length: int = 50, 
-        temperature: float = 0.7, 
-        top_p: float = 0.9
+        self,
+        prompt: str,
+        retrieved_docs: List[RetrievedDoc] = None,
+        max_length: int = 50,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        session_id: Optional[str] = None,
+        do_sample: bool = True,
+        stop_at: Optional[str] = None,
+        min_prob: Optional[float] = None,
+        n_candidates: int = 1
     ) -> str:
-        # Combine prompt with retrieved docs if available
-        if retrieved_docs:
-            # Limit the length of retrieved docs
-            combined_docs = ' '.join(retrieved_docs)[:500]
-            context = f"{combined_docs}\n\nContext: {prompt}"
+        """
+        Generate a completion for one prompt. With do_sample=False decoding is greedy, so the
+        same prompt always gives the same completion (which is what makes results cacheable).
+        With n_candidates > 1, the best-ranked of that many candidates is returned.
+        """
+        if n_candidates > 1:
+            return self.complete_candidates(
+                prompt, retrieved_docs, n_candidates, max_length, temperature, top_p, session_id, do_sample,
+                stop_at, min_prob
+            )[0].text
+        return self.complete(
+            prompt, retrieved_docs, max_length, temperature, top_p, session_id, do_sample, stop_at, min_prob
+        ).text
+
+    def complete(
+        self,
+        prompt: str,
+        retrieved_docs: List[RetrievedDoc] = None,
+        max_length: int = 50,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        session_id: Optional[str] = None,
+        do_sample: bool = True,
+        stop_at: Optional[str] = None,
+        min_prob: Optional[float] = None,
+        cancel: Optional[threading.Event] = None
+    ) -> Completion:
+        """
+        Like generate_text, but also reports why decoding stopped. `stop_at` ends the suggestion
+        at the first word / phrase / sentence / newline boundary, and `min_prob` ends it before
+        the first token the model gives less than that probability (see stopping.py). Setting
+        `cancel` stops decoding at the next token, with stop_reason "cancelled".
+        """
+        stopper = self.new_stopper(stop_at, min_prob, max_length, cancel)
+        if not do_sample and self.speculative_tokens > 0:
+            self.generate_speculative(prompt, retrieved_docs, stopper, session_id)
+        elif session_id is not None and self.prefix_cache is not None:
+            self.generate_with_prefix_cache(session_id, prompt, retrieved_docs, stopper, temperature, top_p, do_sample)
         else:
-            context = prompt
-
-        # Encode with strict length control
-        inputs = self.tokenizer(
-            context,
-            return_tensors="pt",
-            truncation=True,
-            max_length=512,  # Limit input length
-            padding=True
+            return self.complete_batch(
+                [prompt], [retrieved_docs], temperature=temperature, top_p=top_p, do_sample=do_sample,
+                stoppers=[stopper]
+            )[0]
+        return Completion(stopper.finish(), stopper.reason, stopper.steps)
+
+    def complete_candidates(
+        self,
+        prompt: str,
+        retrieved_docs: List[RetrievedDoc] = None,
+        n_candidates: int = 3,
+        max_length: int = 50,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        session_id: Optional[str] = None,
+        do_sample: bool = True,
+        stop_at: Optional[str] = None,
+        min_prob: Optional[float] = None,
+        cancel: Optional[threading.Event] = None
+    ) -> List[Completion]:
+        """
+        Up to `n_candidates` alternative completions from one prompt prefill, best first.
+        The prompt's KV cache is built once (or taken from the session's prefix cache) and shared
+        by `n_candidates` sampled rows. With do_sample=False the first row is the greedy
+        completion. Candidates with the same text are merged, and they are ranked by mean
+        log-probability per token under the model.
+        """
+        # 1) Prefill all but the last prompt token once, for a single row
+        inputs, past = self.prepare_inputs(prompt, retrieved_docs, session_id)
+        input_ids = inputs.input_ids
+        if past is None and input_ids.shape[1] > 1:
+            with span("prefill"):
+                past = self.backend.prefill(input_ids[:, :-1])
+
+        # 2) Decode n_candidates rows on top of the shared cache
+        inputs = BatchEncoding({
+            "input_ids": input_ids.repeat(n_candidates, 1),
+            "attention_mask": inputs.attention_mask.repeat(n_candidates, 1),
+        })
+        if past is not None:
+            past = expand_past(past, n_candidates)
+        stoppers = [self.new_stopper(stop_at, min_prob, max_length, cancel) for _ in range(n_candidates)]
+        self.run_generate(
+            inputs, stoppers, past, temperature, top_p, do_sample=True, score=True,
+            greedy_rows=[] if do_sample else [0]
         )
-        
-        # Generate
-        with torch.no_grad():
-            outputs = self.model.generate(
-                inputs.input_ids,
-                attention_mask=inputs.attention_mask,  # Add attention mask
-                max_new_tokens=max_length,  # Use max_new_tokens instead of max_length
-                pad_token_id=self.tokenizer.pad_token_id,
-                temperature=temperature,
-                top_p=top_p,
-                do_sample=True,
-                num_return_sequences=1
-            )
-        
-        # Decode only the new tokens
-        original_length = inputs.input_ids.shape[1]
-        generated_text = self.tokenizer.decode(
-            outputs[0][original_length:],
-            skip_special_tokens=True
+
+        # 3) De-duplicate and rank
+        best = {}
+        for stopper in stoppers:
+            completion = Completion(stopper.finish(), stopper.reason, stopper.steps, stopper.score)
+            key = completion.text.strip()
+            if key not in best or (completion.score or 0.0) > (best[key].score or 0.0):
+                best[key] = completion
+        ranked = sorted(best.values(), key=lambda c: c.score if c.score is not None else -float("inf"), reverse=True)
+        # An empty suggestion is only worth returning if there is nothing else
+        return [c for c in ranked if c.text.strip()] or ranked[:1]
+
+    def decodes_alone(self, session_id: Optional[str], do_sample: bool, n_candidates: int = 1) -> bool:
+        """Whether generate_text takes a single-prompt path that cannot share a padded batch."""
+        return (
+            n_candidates > 1
+            or (session_id is not None and self.prefix_cache is not None)
+            or (not do_sample and self.speculative_tokens > 0)
+        )
+
+    def prepare_inputs(self, prompt: str, retrieved_docs: List[RetrievedDoc] = None, session_id: Optional[str] = None):
+        """
+        Tokenize a single prompt. With a session id and a prefix cache, also return the
+        past_key_values covering all but the last prompt token, re-using the session's cache
+        for the longest token prefix shared with its previous prompt and only prefilling the rest.
+        """
+        inputs = self.encode_prompts([prompt], [retrieved_docs])
+        if session_id is None or self.prefix_cache is None:
+            return inputs, None
+
+        input_ids = inputs.input_ids
+        token_ids = input_ids[0].tolist()
+
+        # The cache must cover everything but the last prompt token, which generate() feeds itself
+        reused, past = self.prefix_cache.lookup(session_id, token_ids)
+        target = len(token_ids) - 1
+        if target > reused:
+            with span("prefill"):
+                past = self.backend.prefill(input_ids[:, reused:target], past)
+        if past is not None:
+            self.prefix_cache.store(session_id, token_ids, past, target)
+        return inputs, past
+
+    def run_generate(
+        self,
+        inputs: BatchEncoding,
+        stoppers: List[SuggestionStopper],
+        past=None,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        stop_event: Optional[threading.Event] = None,
+        on_step: Optional[Callable[[], None]] = None,
+        score: bool = False,
+        greedy_rows: Optional[List[int]] = None
+    ):
+        """
+        One backend `generate` call whose rows are followed by `stoppers`; decoding ends as soon
+        as every row's suggestion is done, instead of always running to the longest max_length.
+        `score` tracks each row's log-probability; `greedy_rows` are decoded greedily even when
+        the others are sampled.
+        """
+        logits_processor = LogitsProcessorList()
+        probabilities = None
+        if score or any(stopper.needs_probs for stopper in stoppers):
+            probabilities = TokenProbabilities()
+            logits_processor.append(probabilities)
+        if greedy_rows:
+            logits_processor.append(GreedyRows(greedy_rows))
+        # The first stopping check comes right after the prompt's forward pass, so it splits
+        # the call into prefill and decode time
+        started = time.perf_counter()
+        first_step = None
+
+        def step():
+            nonlocal first_step
+            if first_step is None:
+                first_step = time.perf_counter()
+            if on_step is not None:
+                on_step()
+
+        criteria = [SuggestionStoppingCriteria(stoppers, probabilities, step)]
+        if stop_event is not None:
+            criteria.append(StopOnEvent(stop_event))
+
+        outputs = self.backend.generate(
+            inputs.input_ids,
+            attention_mask=inputs.attention_mask,
+            past_key_values=past,
+            max_new_tokens=max(stopper.max_tokens for stopper in stoppers),
+            pad_token_id=self.tokenizer.pad_token_id,
+            temperature=temperature,
+            top_p=top_p,
+            do_sample=do_sample,
+            num_return_sequences=1,
+            logits_processor=logits_processor,
+            stopping_criteria=StoppingCriteriaList(criteria)
         )
-        return generated_text
 
+        finished = time.perf_counter()
+        first_step = first_step or finished
+        STAGE_SECONDS.observe(first_step - started, stage="prefill")
+        STAGE_SECONDS.observe(finished - first_step, stage="decode")
+
+        # `generate` may skip the stopping criteria on its last step, so feed whatever they missed
+        # (the probabilities still hold that last step's distribution)
+        prompt_length = inputs.input_ids.shape[1]
+        for row, stopper in enumerate(stoppers):
+            missed = outputs[row, prompt_length + stopper.steps:].tolist()
+            for i, token_id in enumerate(missed):
+                last = probabilities is not None and i == len(missed) - 1
+                if stopper.add(token_id, probabilities.prob(row, token_id) if last else None):
+                    break
+        self.record_decode(sum(stopper.steps for stopper in stoppers), finished - started)
+
+    def record_decode(self, num_tokens: int, seconds: float):
+        GENERATED_TOKENS.inc(num_tokens)
+        if seconds > 0:
+            DECODE_TOKENS_PER_SECOND.observe(num_tokens / seconds)
+
+    def generate_with_prefix_cache(
+        self,
+        session_id: str,
+        prompt: str,
+        retrieved_docs: List[RetrievedDoc],
+        stopper: SuggestionStopper,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True
+    ):
+        """Single-prompt generation that only prefills what changed since the session's last prompt."""
+        inputs, past = self.prepare_inputs(prompt, retrieved_docs, session_id)
+        self.run_generate(inputs, [stopper], past, temperature, top_p, do_sample)
+
+    def generate_speculative(
+        self,
+        prompt: str,
+        retrieved_docs: List[RetrievedDoc],
+        stopper: SuggestionStopper,
+        session_id: Optional[str] = None
+    ):
+        """
+        Greedy completion with prompt-lookup drafts from the prompt and the full retrieved chunks.
+        Gives the same text as greedy `generate`, in fewer forward passes when it copies phrases.
+        """
+        inputs, past = self.prepare_inputs(prompt, retrieved_docs, session_id)
+        sources = [doc if isinstance(doc, list) else self.tokenizer.encode(doc) for doc in retrieved_docs or []]
+        started = time.perf_counter()
+        # Speculative decoding interleaves the rest of the prefill with the first draft checks,
+        # so it is all counted as decode
+        with span("decode"):
+            prompt_lookup_generate(
+                self.backend,
+                inputs.input_ids[0].tolist(),
+                past_key_values=past,
+                max_new_tokens=stopper.max_tokens,
+                eos_token_id=self.tokenizer.eos_token_id,
+                sources=sources,
+                num_draft=self.speculative_tokens,
+                stats=self.speculative_stats,
+                stopper=stopper
+            )
+        self.record_decode(stopper.steps, time.perf_counter() - started)
+
+    def stream_text(
+        self,
+        prompt: str,
+        retrieved_docs: List[RetrievedDoc] = None,
+        max_length: int = 50,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        session_id: Optional[str] = None,
+        stop_event: Optional[threading.Event] = None,
+        do_sample: bool = True,
+        stopper: Optional[SuggestionStopper] = None
+    ) -> Iterator[str]:
+        """
+        Yield the completion piece by piece as it is decoded. `generate` runs on its own thread
+        and checks `stop_event` before every token, so setting it (or closing this iterator)
+        stops the decode loop instead of letting it run to max_length.
+        Pass a `stopper` (see new_stopper) to end at a boundary; its `reason` says why it ended.
+        Text is only yielded once no boundary can cut it any more, so it never has to be taken back.
+        """
+        stop_event = stop_event or threading.Event()
+        stopper = stopper or self.new_stopper()
+        if stopper.max_tokens is None:
+            stopper.max_tokens = max_length
+        inputs, past = self.prepare_inputs(prompt, retrieved_docs, session_id)
+        pieces: "queue.Queue[Optional[str]]" = queue.Queue()
+        emitted = 0
+
+        def emit(text: str):
+            nonlocal emitted
+            if len(text) > emitted:
+                pieces.put(text[emitted:])
+                emitted = len(text)
+
+        errors = []
+
+        def run():
+            try:
+                self.run_generate(
+                    inputs, [stopper], past, temperature, top_p, do_sample,
+                    stop_event=stop_event,
+                    on_step=lambda: emit(stopper.safe_text())
+                )
+                emit(stopper.finish("cancelled" if stop_event.is_set() else "length"))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pieces.put(None)
+
+        thread = threading.Thread(target=run, name="stream-generate", daemon=True)
+        thread.start()
+        finished = False
+        try:
+            while True:
+                text = pieces.get()
+                if text is None:
+                    break
+                yield text
+            if errors:
+                raise errors[0]
+            finished = True
+        finally:
+            if not finished:
+                stop_event.set()
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        retrieved_docs: List[List[RetrievedDoc]] = None,
+        max_lengths: List[int] = None,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True
+    ) -> List[str]:
+        """Completion texts for several prompts, see complete_batch."""
+        completions = self.complete_batch(prompts, retrieved_docs, max_lengths, temperature, top_p, do_sample)
+        return [completion.text for completion in completions]
+
+    def complete_batch(
+        self,
+        prompts: List[str],
+        retrieved_docs: List[List[RetrievedDoc]] = None,
+        max_lengths: List[int] = None,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        stoppers: Optional[List[SuggestionStopper]] = None
+    ) -> List[Completion]:
+        """
+        Generate completions for several prompts with a single left-padded `generate` call.
+        Each prompt gets its own retrieved docs, token limit and stopper (from new_stopper; by
+        default each just stops at its max_length). Decoding ends once every row is done, and
+        every output is cut back to its own stopping point.
+        """
+        if retrieved_docs is None:
+            retrieved_docs = [None] * len(prompts)
+        if stoppers is None:
+            if max_lengths is None:
+                max_lengths = [50] * len(prompts)
+            stoppers = [self.new_stopper(max_tokens=limit) for limit in max_lengths]
+
+        # Token-space prompts, each within max_prompt_tokens
+        inputs = self.encode_prompts(prompts, retrieved_docs)
+        self.run_generate(inputs, stoppers, None, temperature, top_p, do_sample)
+        return [Completion(stopper.finish(), stopper.reason, stopper.steps) for stopper in stoppers]
@@ -0,0 +1,324 @@
+# phrase_index.py
+# A fast path for stock phrases ("the Prime Minister said", "according to the Office for
+# National Statistics"). Every 2..4-token context of the data/docs corpus is stored with the
+# token that most often follows it. Extending the cursor's last tokens through that table
+# completes a phrase in microseconds, and the server only calls GPT-2 when it is not confident.
+#
+#   python phrase_index.py build --docs-dir data/docs --index-dir data/phrase_index
+#   python phrase_index.py query "The Prime Minister"
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from transformers import GPT2TokenizerFast
+
+from metrics import PHRASE_INDEX_LOOKUPS
+from rag_utils import extract_text, file_sha256
+from stopping import SuggestionStopper
+
+# Bump this whenever the on-disk layout changes
+PHRASE_INDEX_VERSION = 1
+META_FILE = "meta.json"
+ARRAYS = ("keys", "next_token", "count", "total")
+# Context lengths (in tokens) that are indexed; lookups try the longest first
+ORDERS = (2, 3, 4)
+# Only this much of the text before the cursor is tokenized per lookup
+TAIL_CHARS = 64
+TOKENIZE_BATCH = 256
+
+_MASK = (1 << 64) - 1
+_PRIME = 0x100000001B3
+
+
+def _order_seed(order: int) -> int:
+    return (order * 0x9E3779B97F4A7C15) & _MASK
+
+
+def context_hash(tokens: List[int]) -> int:
+    """64-bit hash of a context; matches `context_hashes` for the same tokens."""
+    h = _order_seed(len(tokens))
+    for token in tokens:
+        h = ((h * _PRIME) & _MASK) ^ int(token)
+    return h
+
+
+def context_hashes(tokens: np.ndarray, order: int) -> np.ndarray:
+    """Hashes of every `order`-token window of `tokens` that has a token after it."""
+    n = len(tokens) - order
+    h = np.full(n, _order_seed(order), dtype=np.uint64)
+    for j in range(order):
+        # uint64 arithmetic wraps around, like the masking in context_hash
+        h = (h * np.uint64(_PRIME)) ^ tokens[j:j + n].astype(np.uint64)
+    return h
+
+
+def count_pairs(keys: np.ndarray, next_tokens: np.ndarray, counts: np.ndarray):
+    """Merge duplicate (key, next token) pairs, summing their counts; returns them sorted by key."""
+    order = np.lexsort((next_tokens, keys))
+    keys, next_tokens, counts = keys[order], next_tokens[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], (keys[1:] != keys[:-1]) | (next_tokens[1:] != next_tokens[:-1])]))
+    return keys[starts], next_tokens[starts], np.add.reduceat(counts, starts)
+
+
+def list_source_files(docs_dir: str) -> List[str]:
+    """The same .jsonl files RAGHelper indexes."""
+    return sorted(glob.glob(os.path.join(docs_dir, "**/*.jsonl"), recursive=True))
+
+
+def sources_fingerprint(docs_dir: str) -> dict:
+    return {os.path.relpath(path, docs_dir): file_sha256(path) for path in list_source_files(docs_dir)}
+
+
+def iter_doc_tokens(file_path: str, tokenizer) -> Iterator[np.ndarray]:
+    """Token ids of every document of a JSONL file, tokenized in batches."""
+    texts = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                content = extract_text(line)
+            except json.JSONDecodeError:
+                continue
+            if content:
+                texts.append(content)
+            if len(texts) >= TOKENIZE_BATCH:
+                for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]:
+                    yield np.asarray(ids, dtype=np.int64)
+                texts = []
+    if texts:
+        for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]:
+            yield np.asarray(ids, dtype=np.int64)
+
+
+def build_phrase_index(
+    docs_dir: str,
+    index_dir: str,
+    tokenizer,
+    min_count: int = 3,
+    min_confidence: float = 0.3
+) -> dict:
+    """
+    Count (context, next token) pairs over every document under docs_dir and save, per context
+    seen at least `min_count` times, its most frequent next token if that token follows it at
+    least `min_confidence` of the time. Counts are merged file by file, so memory follows the
+    number of distinct pairs rather than the corpus size. Returns the meta.
+    """
+    started = time.perf_counter()
+    merged = (np.zeros(0, np.uint64), np.zeros(0, np.uint32), np.zeros(0, np.uint32))
+    num_docs = num_tokens = 0
+    for file_path in list_source_files(docs_dir):
+        keys, nexts = [], []
+        for tokens in iter_doc_tokens(file_path, tokenizer):
+            num_docs += 1
+            num_tokens += len(tokens)
+            for order in ORDERS:
+                if len(tokens) > order:
+                    keys.append(context_hashes(tokens, order))
+                    nexts.append(tokens[order:].astype(np.uint32))
+        if keys:
+            keys, nexts = np.concatenate(keys), np.concatenate(nexts)
+            merged = count_pairs(
+                np.concatenate([merged[0], keys]),
+                np.concatenate([merged[1], nexts]),
+                np.concatenate([merged[2], np.ones(len(keys), np.uint32)])
+            )
+
+    # Per context: its total count and its most frequent next token (first after sorting by -count)
+    keys, nexts, counts = merged
+    order = np.lexsort((-counts.astype(np.int64), keys))
+    keys, nexts, counts = keys[order], nexts[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) else np.zeros(0, np.int64)
+    totals = np.add.reduceat(counts, starts) if len(keys) else np.zeros(0, np.uint32)
+    keys, nexts, counts = keys[starts], nexts[starts], counts[starts]
+    keep = (totals >= min_count) & (counts >= min_confidence * totals)
+
+    os.makedirs(index_dir, exist_ok=True)
+    arrays = {"keys": keys[keep], "next_token": nexts[keep], "count": counts[keep], "total": totals[keep].astype(np.uint32)}
+    for name in ARRAYS:
+        np.save(os.path.join(index_dir, f"{name}.npy"), arrays[name])
+    meta = {
+        "version": PHRASE_INDEX_VERSION,
+        "tokenizer": tokenizer.name_or_path,
+        "orders": list(ORDERS),
+        "min_count": min_count,
+        "min_confidence": min_confidence,
+        "sources": sources_fingerprint(docs_dir),
+        "docs": num_docs,
+        "tokens": num_tokens,
+        "entries": int(keep.sum()),
+    }
+    with open(os.path.join(index_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"Phrase index: {meta['entries']} contexts from {num_docs} docs ({num_tokens} tokens) "
+          f"in {time.perf_counter() - started:.1f}s -> {index_dir}")
+    return meta
+
+
+class PhraseIndexStats:
+    """Fast-path hit rate and lookup time, and recent request latency by who answered."""
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self._lookup_us = deque(maxlen=window)
+        self._latency_ms = {source: deque(maxlen=window) for source in ("phrase_index", "cache", "model")}
+
+    def record_lookup(self, hit: bool, seconds: float):
+        PHRASE_INDEX_LOOKUPS.inc(result="hit" if hit else "miss")
+        with self._lock:
+            self.lookups += 1
+            self.hits += int(hit)
+            self._lookup_us.append(seconds * 1e6)
+
+    def record_latency(self, source: str, ms: float):
+        with self._lock:
+            self._latency_ms[source].append(ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookup_us = sorted(self._lookup_us)
+            latency = {source: sorted(values) for source, values in self._latency_ms.items()}
+            lookups, hits = self.lookups, self.hits
+
+        def percentile(values, p):
+            return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+        return {
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "lookup_us_p50": percentile(lookup_us, 0.50),
+            "lookup_us_p99": percentile(lookup_us, 0.99),
+            # /autocomplete latency of requests answered from the index vs. by GPT-2
+            "latency_ms_p50": {source: percentile(values, 0.50) for source, values in latency.items()},
+        }
+
+
+class PhraseIndex:
+    """
+    The most frequent next token after each indexed context, as four arrays sorted by key:
+      keys        uint64 hash of the context (see context_hash)
+      next_token  uint32 the token seen most often after it
+      count       uint32 how often that token followed it
+      total       uint32 how often the context occurred
+    The .npy files are memory-mapped, so processes forked by prefork.py share one copy.
+    """
+    def __init__(self, index_dir: str, tokenizer):
+        with open(os.path.join(index_dir, META_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.tokenizer = tokenizer
+        self.orders = sorted(self.meta["orders"], reverse=True)
+        # Plain ndarray views of the memory maps: indexing a np.memmap is several times slower
+        arrays = {
+            name: np.asarray(np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")) for name in ARRAYS
+        }
+        self.keys = arrays["keys"]
+        self.next_tokens = arrays["next_token"]
+        self.counts = arrays["count"]
+        self.totals = arrays["total"]
+        self.stats = PhraseIndexStats()
+
+    @classmethod
+    def load_or_build(cls, docs_dir: str, index_dir: str, tokenizer, **build_kwargs) -> "PhraseIndex":
+        """Load the saved index, rebuilding it first if the docs or the tokenizer changed."""
+        meta_path = os.path.join(index_dir, META_FILE)
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        if (
+            meta is None
+            or meta.get("version") != PHRASE_INDEX_VERSION
+            or meta.get("tokenizer") != tokenizer.name_or_path
+            or meta.get("sources") != sources_fingerprint(docs_dir)
+        ):
+            print(f"Phrase index in {index_dir} is missing or stale, rebuilding...")
+            build_phrase_index(docs_dir, index_dir, tokenizer, **build_kwargs)
+        return cls(index_dir, tokenizer)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def tail_tokens(self, text: str) -> List[int]:
+        """Token ids of the end of `text`; the first token of a cut-off tail may be a word fragment, so it is dropped."""
+        tokens = self.tokenizer.encode(text[-TAIL_CHARS:])
+        return tokens[1:] if len(text) > TAIL_CHARS else tokens
+
+    def next_token(self, tokens: List[int]) -> Optional[Tuple[int, int, int]]:
+        """(token, count, total) for the longest indexed context ending `tokens`, or None."""
+        for order in self.orders:
+            if len(tokens) < order:
+                continue
+            key = np.uint64(context_hash(tokens[-order:]))
+            i = int(np.searchsorted(self.keys, key))
+            if i < len(self.keys) and self.keys[i] == key:
+                return int(self.next_tokens[i]), int(self.counts[i]), int(self.totals[i])
+        return None
+
+    def complete(
+        self,
+        text: str,
+        stopper: SuggestionStopper,
+        min_confidence: float = 0.6,
+        min_count: int = 5
+    ) -> Optional[str]:
+        """
+        Extend `text` one most-frequent token at a time while the product of the step
+        frequencies stays above `min_confidence` (and each context was seen `min_count` times).
+        The completion counts only if it ends at the stopper's granularity boundary (or an EOS
+        or its token limit), so a half phrase is never returned; otherwise None (ask the model).
+        """
+        started = time.perf_counter()
+        tokens = self.tail_tokens(text)
+        confidence = 1.0
+        while not stopper.done:
+            found = self.next_token(tokens)
+            if found is None:
+                break
+            token, count, total = found
+            if total < min_count or confidence * count / total < min_confidence:
+                break
+            confidence *= count / total
+            tokens.append(token)
+            stopper.add(token, count / total)
+        if not stopper.done and stopper.ends_at_boundary():
+            stopper.finish(stopper.stop_at)
+        hit = stopper.done and stopper.reason != "low_confidence" and bool(stopper.text.strip())
+        self.stats.record_lookup(hit, time.perf_counter() - started)
+        return stopper.text if hit else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the n-gram phrase index.")
+    parser.add_argument("command", choices=["build", "query"])
+    parser.add_argument("text", nargs="?", help="query: text before the cursor")
+    parser.add_argument("--docs-dir", default="data/docs")
+    parser.add_argument("--index-dir", default="data/phrase_index")
+    parser.add_argument("--tokenizer", default="gpt2")
+    parser.add_argument("--min-count", type=int, default=3, help="build: contexts seen fewer times are dropped")
+    parser.add_argument("--min-confidence", type=float, default=0.3,
+                        help="build: drop contexts whose top next token is rarer than this")
+    parser.add_argument("--stop-at", default="phrase", help="query: suggestion granularity")
+    args = parser.parse_args()
+
+    tokenizer = GPT2TokenizerFast.from_pretrained(args.tokenizer)
+    if args.command == "build":
+        build_phrase_index(args.docs_dir, args.index_dir, tokenizer, args.min_count, args.min_confidence)
+        return
+
+    index = PhraseIndex(args.index_dir, tokenizer)
+    stopper = SuggestionStopper(tokenizer, stop_at=args.stop_at, max_tokens=20)
+    completion = index.complete(args.text or "", stopper)
+    print(f"{completion!r} ({stopper.reason}, {index.stats.stats()['lookup_us_p50']:.0f} us)")
+
+
+if __name__ == "__main__":
+    main()
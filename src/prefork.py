@@ -0,0 +1,149 @@
+# prefork.py
+# Multi-worker serving that loads everything once. `uvicorn --workers N` starts N fresh
+# interpreters, each loading its own GPT-2, embedding model and FAISS store. Here the parent
+# imports server.py (loading all of them), warms it up and then forks the workers, which serve
+# one shared listening socket. Weights and index pages stay shared copy-on-write, so an extra
+# worker only adds its own activations, caches and Python heap. A worker that dies is re-forked
+# from the loaded parent, again without reloading.
+#
+#   python prefork.py --workers 4 --port 8000
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from typing import Dict
+
+import faiss
+import torch
+
+# A forked child deadlocks in its first torch/FAISS op if the parent ever ran a
+# multi-threaded OpenMP region, so the parent stays single-threaded until the fork
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+torch.set_num_threads(1)
+faiss.omp_set_num_threads(1)
+
+import uvicorn  # noqa: E402
+
+import server  # noqa: E402  (loads the model, embeddings and index)
+from metrics import process_memory  # noqa: E402
+
+# A worker that exits sooner than this after its fork is re-forked only after a pause
+MIN_WORKER_LIFETIME_S = 5.0
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket, args: argparse.Namespace):
+    """Body of a forked worker: own thread pools, then uvicorn on the inherited socket."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    torch.set_num_threads(args.threads)
+    faiss.omp_set_num_threads(args.threads)
+    config = uvicorn.Config(server.app, log_level=args.log_level, timeout_keep_alive=args.keep_alive_s)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+    """Forks `workers` children from the loaded parent and keeps that many running until stopped."""
+    def __init__(self, sock: socket.socket, args: argparse.Namespace):
+        self.sock = sock
+        self.args = args
+        self.workers: Dict[int, float] = {}  # pid -> fork time
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.sock, self.args)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                # Never return into the parent's supervision loop
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.args.workers):
+            self.spawn()
+        print(f"Forked {self.args.workers} workers: {sorted(self.workers)}")
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            print(f"Worker {pid} exited with status {status}; forking a replacement")
+            if time.monotonic() - started < MIN_WORKER_LIFETIME_S:
+                time.sleep(MIN_WORKER_LIFETIME_S)
+            if not self.stopping:
+                self.spawn()
+
+
+def report_memory(label: str, pid="self"):
+    memory = process_memory(pid)
+    if memory:
+        print(f"{label}: rss {memory['rss'] / 2**20:.0f} MB, pss {memory['pss'] / 2**20:.0f} MB, "
+              f"private {memory['private'] / 2**20:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve server.py from workers forked after loading the model.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch/FAISS threads per worker (default: cores / workers)")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--keep-alive-s", type=int, default=5)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    # 1. Warm up once in the parent (single-threaded), so lazily built state is shared too
+    started = time.perf_counter()
+    server.warm_up()
+    print(f"Warm-up done in {time.perf_counter() - started:.1f}s")
+    report_memory("Parent after load")
+
+    # 2. Move everything loaded so far out of the garbage collector's reach: collections in
+    #    the workers would otherwise write to these objects and un-share their pages
+    gc.collect()
+    gc.freeze()
+
+    # 3. One listening socket, inherited by every worker
+    sock = bind_socket(args.host, args.port, args.backlog)
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers x {args.threads} threads")
+    Supervisor(sock, args).run()
+    sock.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+# profiling.py
+# A low-overhead sampling profiler that can be switched on at runtime (see the /debug/profile
+# endpoints in server.py): a background thread snapshots every thread's Python stack at a fixed
+# interval, and the result is returned as collapsed stacks ("frame;frame;frame count" lines)
+# that flamegraph.pl or speedscope can render.
+
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+# Innermost frames of threads that are blocked waiting for work (idle pool workers, the event
+# loop's select, condition waits); their samples would otherwise dominate every profile
+IDLE_FRAMES = (
+    "threading.py:wait:",
+    "selectors.py:select:",
+    "thread.py:_worker:",
+    "queue.py:get:",
+)
+
+
+def is_idle(frame) -> bool:
+    code = frame.f_code
+    leaf = f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:"
+    return leaf.startswith(IDLE_FRAMES)
+
+
+def collapse(frame) -> str:
+    """One stack as root-first "file:function:line" frames joined by ';'."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+class SamplingProfiler:
+    """
+    Samples all threads every `interval_ms` until `stop` is called or `max_seconds` have passed,
+    so a forgotten profile cannot keep running in production.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Counter = Counter()
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self.interval_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms: float = 5.0, max_seconds: float = 60.0) -> bool:
+        """Start sampling; returns False if a profile is already running."""
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = Counter()
+            self.samples = 0
+            self.interval_ms = interval_ms
+            self.started_at = time.monotonic()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval_ms / 1000.0, max_seconds), name="sampling-profiler", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self, interval_s: float, max_seconds: float):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + max_seconds
+        while not self._stop.wait(interval_s) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            stacks = [
+                collapse(frame) for thread_id, frame in frames.items()
+                if thread_id != own_id and not is_idle(frame)
+            ]
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+
+    def stop(self) -> str:
+        """Stop sampling (if still running) and return the collapsed stacks, hottest first."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.running,
+                "samples": self.samples,
+                "interval_ms": self.interval_ms,
+                "distinct_stacks": len(self._stacks),
+            }
@@ -1,77 +1,953 @@
 # rag_utils.py
 
+import argparse
 import json
 import glob
+import hashlib
+import itertools
+import multiprocessing
 import os
-from typing import List, Optional
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
 
 # LangChain imports for RAG
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
+from transformers import GPT2TokenizerFast
+
+from data_preparation import read_records
+from faiss_index import (
+    INDEX_TYPES, IndexRebuildRequired, IndexSpec, enable_reconstruct, exact_vectors, print_report,
+    reconstruct_vectors, recall_latency_report
+)
+from lexical_index import BM25Index, terms
+from metrics import span
+
+# Bump this whenever the on-disk layout of a saved index changes
+INDEX_FORMAT_VERSION = 4
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-mpnet-base-v2"
+# Chunks are also stored as token ids of the generation model, so prompts can be built without
+# re-tokenizing retrieved docs (see AutocompleteModel.build_prompt_ids)
+DEFAULT_PROMPT_TOKENIZER = "gpt2"
+
+MANIFEST_FILE = "manifest.json"
+FAISS_INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.jsonl"
+
+# "dense": embed the query and search the FAISS index; "lexical": BM25 over the chunk texts, no
+# embedding; "hybrid": BM25 candidates re-ranked by embedding distance, the two rankings fused
+RETRIEVAL_MODES = ("dense", "lexical", "hybrid")
+# Reciprocal rank fusion constant: a rank r contributes 1 / (RRF_K + r)
+RRF_K = 60
+
+
+def file_sha256(file_path: str) -> str:
+    """Hash a file in fixed-size blocks so large corpora are never read into memory at once."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def extract_text(line: str) -> Optional[str]:
+    """Pull the document text out of one JSONL line, or None if there is nothing usable."""
+    data = json.loads(line)
+    # Check for both 'context' and 'content' fields
+    content = data.get("context") or data.get("content") or data.get("text")
+    if content and isinstance(content, str) and len(content.strip()) > 0:
+        return content.strip()
+    return None
+
+
+def empty_update_stats() -> dict:
+    """Counts reported by `RAGHelper.update_index`, all zero."""
+    return {
+        "files_added": 0, "files_changed": 0, "files_removed": 0,
+        "docs_added": 0, "docs_removed": 0,
+        "chunks_added": 0, "chunks_removed": 0,
+    }
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Yield lists of up to `size` items without materializing the whole iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# Each embedding worker process loads its own copy of the model once
+_worker_embeddings = None
+
+
+def _init_embedding_worker(model_name: str, torch_threads: int):
+    global _worker_embeddings
+    import torch
+    # Split the cores between workers instead of every worker grabbing all of them
+    torch.set_num_threads(torch_threads)
+    _worker_embeddings = HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _embed_in_worker(texts: List[str]) -> np.ndarray:
+    return np.asarray(_worker_embeddings.embed_documents(texts), dtype="float32")
+
 
 class RAGHelper:
     """
     A helper class to load .jsonl documents from a directory, build a FAISS vector store,
     and provide a 'search' method for retrieval-augmented generation.
+
+    Every document (one JSONL line) is tracked by the hash of its text, so `update_index`
+    only embeds new or changed documents and drops the vectors of deleted ones.
+    If `index_dir` is given, the index (vectors, chunk texts and a manifest) is saved there
+    and re-used on the next start; only the docs that changed since are re-processed.
     """
-    def __init__(self, docs_dir: str):
+    def __init__(
+        self,
+        docs_dir: str,
+        index_dir: Optional[str] = None,
+        embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+        chunk_size: int = 500,
+        chunk_overlap: int = 50,
+        force_rebuild: bool = False,
+        embed_workers: int = 0,
+        embed_batch_size: int = 256,
+        index_spec: Optional[IndexSpec] = None,
+        prompt_tokenizer: Optional[str] = DEFAULT_PROMPT_TOKENIZER,
+        retrieval_mode: str = "dense",
+        hybrid_candidates: int = 50
+    ):
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {retrieval_mode!r}, expected one of {RETRIEVAL_MODES}")
         self.docs_dir = docs_dir
-        self.embeddings = HuggingFaceEmbeddings()
-        
+        self.index_dir = index_dir
+        self.embedding_model = embedding_model
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.embeddings = HuggingFaceEmbeddings(model_name=embedding_model)
+        # Index builds embed fixed-size batches of chunks, across `embed_workers` processes
+        # (0 embeds in this process)
+        self.embed_workers = embed_workers
+        self.embed_batch_size = embed_batch_size
+        # Exact (flat) search unless an approximate index type is configured, see faiss_index.py
+        self.index_spec = index_spec or IndexSpec()
+        # Tokenizer of the generation model; None stores chunk texts only
+        self.prompt_tokenizer = prompt_tokenizer
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(prompt_tokenizer) if prompt_tokenizer else None
+        # Vectors held back until there are enough to train an IVF/PQ index: [(vectors, ids)]
+        self._untrained: List[Tuple[np.ndarray, np.ndarray]] = []
+        # Default mode of `search`; hybrid re-ranks this many BM25 candidates
+        self.retrieval_mode = retrieval_mode
+        self.hybrid_candidates = hybrid_candidates
+        # BM25 over the chunks of one vector store: (store, its index, BM25Index), see `lexical_index`
+        self._lexical: Optional[Tuple[FAISS, faiss.Index, BM25Index]] = None
+        self._lexical_lock = threading.Lock()
+
         # Split text into smaller chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,  # Reduced from 1000
-            chunk_overlap=50  # Reduced from 200
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap
         )
-        
+
+        # What is currently indexed:
+        #   sources = {relative file path: {"sha256": ..., "docs": {doc hash: [vector ids]}}}
+        self.sources: Dict[str, dict] = {}
+        self.next_id = 0
+        # Serializes index updates; searches keep using the previous store until it is swapped
+        self._update_lock = threading.Lock()
+
         # Initialize vector store and assign it to self.vectorstore
-        self.vectorstore = self.initialize_vectorstore(docs_dir, text_splitter)
-
-    def initialize_vectorstore(self, docs_dir, text_splitter):
-        """Collects text from .jsonl files, splits into chunks, then builds a FAISS store."""
-        doc_texts = []
-
-        # Find all .jsonl files recursively
-        jsonl_files = glob.glob(os.path.join(docs_dir, "**/*.jsonl"), recursive=True)
-        if not jsonl_files:
-            print(f"No JSONL files found in {docs_dir}. Vector store will be empty.")
-            # Return empty FAISS index instead of None
-            return FAISS.from_texts([""], self.embeddings)
-
-        # Read each file line by line
-        for file_path in jsonl_files:
-            print(f"Processing file: {file_path}")  # Debug print
-            with open(file_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line)
-                        # Check for both 'context' and 'content' fields
-                        content = data.get("context") or data.get("content") or data.get("text")
-                        if content and isinstance(content, str) and len(content.strip()) > 0:
-                            doc_texts.append(content.strip())
-                    except json.JSONDecodeError as e:
-                        print(f"Error parsing line in {file_path}: {e}")
-                        continue
+        if index_dir is None:
+            self.vectorstore = self.initialize_vectorstore()
+        else:
+            self.vectorstore = self.load_or_build_index(index_dir, force_rebuild=force_rebuild)
+        if retrieval_mode != "dense":
+            self.lexical_index()
+
+    def list_source_files(self) -> List[str]:
+        """Find all .jsonl files under docs_dir recursively, in a stable order."""
+        return sorted(glob.glob(os.path.join(self.docs_dir, "**/*.jsonl"), recursive=True))
+
+    def empty_vectorstore(self) -> FAISS:
+        """A FAISS store with no vectors, whose ids are assigned by us so they can be removed later."""
+        dim = len(self.embeddings.embed_query("dimension probe"))
+        index = self.index_spec.create_index(dim)
+        self.index_spec.apply_search_params(index)
+        self._untrained = []
+        return FAISS(self.embeddings, index, InMemoryDocstore({}), {})
 
-        if not doc_texts:
-            print("No valid text found in files. Creating empty vector store.")
-            return FAISS.from_texts([""], self.embeddings)
+    def add_vectors(self, vectorstore: FAISS, vectors: np.ndarray, ids: np.ndarray):
+        """Add to the index, or hold the vectors back until an untrained index can be trained."""
+        if vectorstore.index.is_trained:
+            vectorstore.index.add_with_ids(vectors, ids)
+            return
+        self._untrained.append((vectors, ids))
+        if sum(len(v) for v, _ in self._untrained) >= self.index_spec.train_size:
+            self.train_index(vectorstore)
 
-        print(f"Found {len(doc_texts)} documents to process")  # Debug print
-        
-        # Split text into chunks
-        docs = text_splitter.create_documents(doc_texts)
-        print(f"Created {len(docs)} chunks after splitting")  # Debug print
+    def train_index(self, vectorstore: FAISS):
+        """Train IVF centroids / PQ codebooks on the held-back vectors, then add them."""
+        if not self._untrained:
+            return
+        vectors = np.vstack([v for v, _ in self._untrained])
+        ids = np.concatenate([i for _, i in self._untrained])
+        self._untrained = []
 
-        # Build FAISS store
-        vectorstore = FAISS.from_documents(docs, self.embeddings)
+        # The index is still empty, so it can be re-created sized for the training set
+        index = self.index_spec.create_index(vectors.shape[1], num_train=len(vectors))
+        print(f"Training {self.index_spec.index_type} index on {len(vectors)} vectors")
+        index.train(vectors)
+        index.add_with_ids(vectors, ids)
+        self.index_spec.apply_search_params(index)
+        vectorstore.index = index
+
+    def initialize_vectorstore(self) -> FAISS:
+        """Build a fresh FAISS store over every document under docs_dir."""
+        self.sources = {}
+        self.next_id = 0
+        vectorstore = self.empty_vectorstore()
+        stats = self.apply_updates(vectorstore)
+        print(f"Indexed {stats['docs_added']} documents as {stats['chunks_added']} chunks")
         return vectorstore
 
-    def search(self, query: str, top_k: int = 3) -> List[Document]:
-        """Return the top-k most similar Document objects."""
+    # ======================
+    # INCREMENTAL UPDATES
+    # ======================
+
+    def iter_source_docs(self, file_path: str) -> Iterator[Tuple[str, str]]:
+        """Stream (doc hash, text) for every valid line of a JSONL file."""
+        print(f"Processing file: {file_path}")  # Debug print
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    content = extract_text(line)
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing line in {file_path}: {e}")
+                    continue
+                if content:
+                    yield text_sha256(content), content
+
+    def embed_batches(self, batches: Iterable[List[str]]) -> Iterator[np.ndarray]:
+        """
+        Embed batches of texts, yielding one float32 array per batch in input order.
+        With embed_workers > 0 the batches are spread over a process pool, with only a few
+        batches in flight per worker so memory stays flat however long the input is.
+        """
+        if self.embed_workers <= 0:
+            for texts in batches:
+                yield np.asarray(self.embeddings.embed_documents(texts), dtype="float32")
+            return
+
+        torch_threads = max(1, (os.cpu_count() or 1) // self.embed_workers)
+        with ProcessPoolExecutor(
+            max_workers=self.embed_workers,
+            # Forking a process that already runs torch threads can deadlock
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_embedding_worker,
+            initargs=(self.embedding_model, torch_threads)
+        ) as pool:
+            pending = deque()
+            for texts in batches:
+                pending.append(pool.submit(_embed_in_worker, texts))
+                if len(pending) >= 2 * self.embed_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def add_chunks(
+        self,
+        vectorstore: FAISS,
+        source: str,
+        chunks: Iterable[Tuple[str, str]]
+    ) -> Dict[str, List[int]]:
+        """
+        Embed and add a stream of (doc hash, chunk text) pairs, one fixed-size batch at a time.
+        Returns {doc hash: [vector ids]}.
+        """
+        added: Dict[str, List[int]] = {}
+        # Batches are consumed lazily by embed_batches, so keep their metadata alongside
+        in_flight = deque()
+
+        def texts_of(batches):
+            for batch in batches:
+                in_flight.append(batch)
+                yield [text for _, text in batch]
+
+        batches = batched(chunks, self.embed_batch_size)
+        for vectors in self.embed_batches(texts_of(batches)):
+            batch = in_flight.popleft()
+            ids = np.arange(self.next_id, self.next_id + len(batch), dtype="int64")
+            self.next_id += len(batch)
+            self.add_vectors(vectorstore, vectors, ids)
+
+            texts = [text for _, text in batch]
+            token_ids = self.tokenizer(texts)["input_ids"] if self.tokenizer else [None] * len(batch)
+            new_docs = {}
+            for vector_id, (doc_hash, text), chunk_ids in zip(ids.tolist(), batch, token_ids):
+                doc_id = str(vector_id)
+                metadata = {"source": source, "doc_hash": doc_hash}
+                if chunk_ids is not None:
+                    metadata["token_ids"] = chunk_ids
+                new_docs[doc_id] = Document(page_content=text, metadata=metadata)
+                vectorstore.index_to_docstore_id[vector_id] = doc_id
+                added.setdefault(doc_hash, []).append(vector_id)
+            vectorstore.docstore.add(new_docs)
+        return added
+
+    def remove_vectors(self, vectorstore: FAISS, vector_ids: List[int]):
+        """Drop vectors and their chunk texts from the store."""
+        if not vector_ids:
+            return
+        if not self.index_spec.supports_remove:
+            raise IndexRebuildRequired(
+                f"{self.index_spec.index_type} index cannot remove vectors in place"
+            )
+        vectorstore.index.remove_ids(np.asarray(vector_ids, dtype="int64"))
+        doc_ids = [vectorstore.index_to_docstore_id.pop(vector_id) for vector_id in vector_ids]
+        vectorstore.docstore.delete(doc_ids)
+
+    def apply_updates(self, vectorstore: FAISS) -> dict:
+        """
+        Bring `vectorstore` and `self.sources` in line with the files under docs_dir.
+        Files whose hash did not change are skipped without being parsed; within a changed
+        file only documents whose text hash is new are embedded.
+        """
+        stats = empty_update_stats()
+
+        current_files = {
+            os.path.relpath(path, self.docs_dir): path for path in self.list_source_files()
+        }
+
+        # 1. Files that disappeared: drop everything they contributed
+        for source in sorted(set(self.sources) - set(current_files)):
+            removed = self.sources.pop(source)
+            vector_ids = [i for ids in removed["docs"].values() for i in ids]
+            self.remove_vectors(vectorstore, vector_ids)
+            stats["files_removed"] += 1
+            stats["docs_removed"] += len(removed["docs"])
+            stats["chunks_removed"] += len(vector_ids)
+
+        # 2. New or modified files: diff their documents by content hash
+        for source, path in current_files.items():
+            sha = file_sha256(path)
+            known = self.sources.get(source)
+            if known is not None and known["sha256"] == sha:
+                continue
+
+            stats["files_changed" if known else "files_added"] += 1
+            known_docs = known["docs"] if known else {}
+            # Only the hashes are kept while streaming; texts are split lazily and dropped
+            # once their batch has been embedded
+            current_hashes = set()
+            fresh_hashes = []
+
+            def fresh_chunks():
+                for doc_hash, text in self.iter_source_docs(path):
+                    if doc_hash in current_hashes:
+                        continue
+                    current_hashes.add(doc_hash)
+                    if doc_hash in known_docs:
+                        continue
+                    fresh_hashes.append(doc_hash)
+                    for chunk in self.text_splitter.split_text(text):
+                        yield doc_hash, chunk
+
+            added = self.add_chunks(vectorstore, source, fresh_chunks())
+
+            stale = [h for h in known_docs if h not in current_hashes]
+            stale_ids = [i for h in stale for i in known_docs[h]]
+            self.remove_vectors(vectorstore, stale_ids)
+
+            docs = {h: ids for h, ids in known_docs.items() if h in current_hashes}
+            docs.update({h: added.get(h, []) for h in fresh_hashes})
+            self.sources[source] = {"sha256": sha, "docs": docs}
+
+            stats["docs_removed"] += len(stale)
+            stats["chunks_removed"] += len(stale_ids)
+            stats["docs_added"] += len(fresh_hashes)
+            stats["chunks_added"] += sum(len(ids) for ids in added.values())
+
+        # Corpus smaller than train_size: train on whatever was collected
+        self.train_index(vectorstore)
+        return stats
+
+    def sources_changed(self) -> bool:
+        """Whether any file under docs_dir was added, removed or modified since it was indexed."""
+        current_files = {
+            os.path.relpath(path, self.docs_dir): path for path in self.list_source_files()
+        }
+        if set(current_files) != set(self.sources):
+            return True
+        return any(file_sha256(path) != self.sources[source]["sha256"] for source, path in current_files.items())
+
+    def update_index(self) -> dict:
+        """
+        Re-scan docs_dir and apply only the differences to the live index, then persist it
+        (if index_dir is set). Searches keep running against the previous store until the
+        updated one is swapped in. Returns counts of added/changed/removed files, docs and chunks.
+        """
+        with self._update_lock:
+            # Nothing to apply (the usual case at startup): skip copying the index and docstore
+            if not self.sources_changed():
+                stats = empty_update_stats()
+                print(f"Index update: {stats}")
+                return stats
+
+            old = self.vectorstore
+            # Work on a private copy: the live index was loaded read-only (IVF lists memory-mapped)
+            index_path = os.path.join(self.index_dir or "", FAISS_INDEX_FILE)
+            if self.index_dir is not None and os.path.exists(index_path):
+                index = faiss.read_index(index_path)
+            else:
+                index = faiss.clone_index(old.index)
+            self.index_spec.apply_search_params(index)
+            vectorstore = FAISS(
+                self.embeddings,
+                index,
+                InMemoryDocstore(dict(old.docstore._dict)),
+                dict(old.index_to_docstore_id)
+            )
+            sources = json.loads(json.dumps(self.sources))
+            next_id = self.next_id
+            try:
+                stats = self.apply_updates(vectorstore)
+            except IndexRebuildRequired as e:
+                print(f"{e}, rebuilding the whole index")
+                self.sources, self.next_id = {}, 0
+                vectorstore = self.empty_vectorstore()
+                try:
+                    stats = dict(self.apply_updates(vectorstore), rebuilt=1)
+                except Exception:
+                    self.sources, self.next_id = sources, next_id
+                    raise
+            except Exception:
+                self.sources, self.next_id = sources, next_id
+                raise
+
+            if any(stats.values()):
+                if self.index_dir is not None:
+                    self.save_index(vectorstore, self.index_dir, self.build_manifest())
+                self.vectorstore = vectorstore
+                if self._lexical is not None:
+                    self.lexical_index()
+            print(f"Index update: {stats}")
+            return stats
+
+    # ======================
+    # PERSISTED INDEX
+    # ======================
+
+    def build_manifest(self) -> dict:
+        """Describe what the saved index was built with and which documents it contains."""
+        return {
+            "format_version": INDEX_FORMAT_VERSION,
+            "embedding_model": self.embedding_model,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "prompt_tokenizer": self.prompt_tokenizer,
+            "index": self.index_spec.build_settings(),
+            "next_id": self.next_id,
+            "files": self.sources,
+        }
+
+    def read_manifest(self, index_dir: str) -> Optional[dict]:
+        """Load the saved manifest, or None if the index in index_dir is incomplete."""
+        for name in (MANIFEST_FILE, FAISS_INDEX_FILE, CHUNKS_FILE):
+            if not os.path.exists(os.path.join(index_dir, name)):
+                return None
+        with open(os.path.join(index_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def settings_match(self, manifest: dict) -> bool:
+        """Whether a saved index was built with the same embedding model, chunking and tokenizer as ours."""
+        return (
+            manifest.get("format_version") == INDEX_FORMAT_VERSION
+            and manifest.get("embedding_model") == self.embedding_model
+            and manifest.get("chunk_size") == self.chunk_size
+            and manifest.get("chunk_overlap") == self.chunk_overlap
+            and manifest.get("prompt_tokenizer") == self.prompt_tokenizer
+            and manifest.get("index") == self.index_spec.build_settings()
+        )
+
+    def load_or_build_index(self, index_dir: str, force_rebuild: bool = False) -> FAISS:
+        """
+        Load a saved index from index_dir. It is rebuilt from scratch only if it is missing
+        or was built with different settings; otherwise changed docs are applied incrementally.
+        """
+        manifest = self.read_manifest(index_dir)
+        if force_rebuild or manifest is None or not self.settings_match(manifest):
+            print(f"Index in {index_dir} is missing or stale, rebuilding...")
+            vectorstore = self.initialize_vectorstore()
+            self.save_index(vectorstore, index_dir, self.build_manifest())
+            return vectorstore
+
+        print(f"Loading index from {index_dir}")
+        self.vectorstore = self.load_index(index_dir)
+        self.sources = manifest["files"]
+        self.next_id = manifest["next_id"]
+        self.update_index()
+        return self.vectorstore
+
+    def save_index(self, vectorstore: FAISS, index_dir: str, manifest: dict):
+        """
+        Write the FAISS vectors, the chunk texts (one JSON line per vector id) and the manifest.
+        The manifest is written last, so an interrupted save is seen as missing and rebuilt.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        faiss.write_index(vectorstore.index, os.path.join(index_dir, FAISS_INDEX_FILE))
+
+        with open(os.path.join(index_dir, CHUNKS_FILE), "w", encoding="utf-8") as f:
+            for vector_id, doc_id in sorted(vectorstore.index_to_docstore_id.items()):
+                doc = vectorstore.docstore.search(doc_id)
+                record = {"id": vector_id, "text": doc.page_content, "metadata": doc.metadata}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        manifest = dict(manifest, num_chunks=vectorstore.index.ntotal, dim=vectorstore.index.d)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, manifest_path)
+        print(f"Saved {vectorstore.index.ntotal} chunks to {index_dir}")
+
+    def load_index(self, index_dir: str) -> FAISS:
+        """
+        Load a saved index. The FAISS file is opened with IO_FLAG_MMAP, which in faiss only
+        memory-maps the inverted lists of IVF / IVF-PQ indexes; flat and HNSW vectors are read
+        into RAM, and so are the chunk texts and token ids from chunks.jsonl. Worker processes
+        forked after loading (prefork.py) still share those pages copy-on-write.
+        """
+        index = faiss.read_index(
+            os.path.join(index_dir, FAISS_INDEX_FILE),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+        self.index_spec.apply_search_params(index)
+
+        docs: Dict[str, Document] = {}
+        index_to_docstore_id: Dict[int, str] = {}
+        with open(os.path.join(index_dir, CHUNKS_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                doc_id = str(record["id"])
+                docs[doc_id] = Document(page_content=record["text"], metadata=record["metadata"])
+                index_to_docstore_id[record["id"]] = doc_id
+
+        if len(index_to_docstore_id) != index.ntotal:
+            raise ValueError(
+                f"Index in {index_dir} is corrupt: {index.ntotal} vectors but "
+                f"{len(index_to_docstore_id)} chunks"
+            )
+
+        return FAISS(self.embeddings, index, InMemoryDocstore(docs), index_to_docstore_id)
+
+    @property
+    def version(self) -> str:
+        """Changes whenever vectors are added or removed, so cached search results can be keyed on it."""
+        return f"{self.next_id}-{self.vectorstore.index.ntotal}"
+
+    # ======================
+    # SEARCH
+    # ======================
+
+    def lexical_index(self) -> BM25Index:
+        """
+        BM25 over the chunks of the current vector store. It is built in memory on first use and
+        again whenever `update_index` swaps the store (a few seconds per 100k chunks), not saved.
+        """
+        vectorstore = self.vectorstore
+        lexical = self._lexical
+        if lexical is not None and lexical[0] is vectorstore and lexical[1] is vectorstore.index:
+            return lexical[2]
+        with self._lexical_lock:
+            lexical = self._lexical
+            if lexical is not None and lexical[0] is vectorstore and lexical[1] is vectorstore.index:
+                return lexical[2]
+            with span("bm25_build"):
+                docstore = vectorstore.docstore
+                bm25 = BM25Index(
+                    (vector_id, docstore.search(doc_id).page_content)
+                    for vector_id, doc_id in vectorstore.index_to_docstore_id.items()
+                )
+                # Hybrid re-ranking reads candidate vectors back from the index
+                enable_reconstruct(vectorstore.index)
+            self._lexical = (vectorstore, vectorstore.index, bm25)
+            print(f"Built BM25 index over {len(bm25)} chunks")
+            return bm25
+
+    def search(self, query: str, top_k: int = 3, mode: Optional[str] = None) -> List[Document]:
+        """Return the top-k Document objects for `query`, by `mode` (default: `retrieval_mode`)."""
         if not hasattr(self, 'vectorstore') or self.vectorstore is None:
             print("Warning: Vector store is not initialized")
             return []
-        return self.vectorstore.similarity_search(query, k=top_k)
+        return self.search_chunks(query, top_k=top_k, mode=mode)
+
+    def search_chunks(
+        self,
+        query: str,
+        top_k: int = 3,
+        mode: Optional[str] = None,
+        vector: Optional[np.ndarray] = None
+    ) -> List[Document]:
+        """
+        Top-k chunks for `query` in one of RETRIEVAL_MODES. `vector` is the query's embedding
+        if the caller already has it; "lexical" never embeds.
+        """
+        mode = mode or self.retrieval_mode
+        vectorstore = self.vectorstore
+        if vectorstore is None or vectorstore.index.ntotal == 0:
+            return []
+
+        if mode == "dense":
+            if vector is None:
+                with span("embed"):
+                    vector = self.embeddings.embed_query(query)
+            with span("faiss_search"):
+                return vectorstore.similarity_search_by_vector(list(vector), k=top_k)
+
+        bm25 = self.lexical_index()
+        with span("bm25_search"):
+            hits = bm25.search(query, self.hybrid_candidates if mode == "hybrid" else top_k)
+        if mode == "lexical" or not hits:
+            # Nothing shares a term with the query: hybrid has nothing to re-rank
+            if mode == "hybrid":
+                return self.search_chunks(query, top_k=top_k, mode="dense", vector=vector)
+            return self.documents(vectorstore, [vector_id for vector_id, _ in hits])
+
+        if vector is None:
+            with span("embed"):
+                vector = self.embeddings.embed_query(query)
+        return self.documents(vectorstore, self.rerank(vectorstore, hits, vector)[:top_k])
+
+    def rerank(self, vectorstore: FAISS, hits: List[Tuple[int, float]], vector) -> List[int]:
+        """
+        Hybrid: order BM25 candidates by reciprocal rank fusion of their BM25 rank and their
+        embedding distance to the query, computed on the candidates' stored vectors only.
+        """
+        ids = [vector_id for vector_id, _ in hits]
+        with span("dense_rerank"):
+            vectors = reconstruct_vectors(vectorstore.index, ids)
+            distances = ((vectors - np.asarray(vector, dtype="float32")) ** 2).sum(axis=1)
+            rank_scores = 1.0 / (RRF_K + 1 + np.arange(len(ids)))
+            fused = rank_scores.copy()  # hits are in BM25 order
+            fused[np.argsort(distances, kind="stable")] += rank_scores
+        return [ids[i] for i in np.argsort(-fused, kind="stable")]
+
+    @staticmethod
+    def documents(vectorstore: FAISS, vector_ids: List[int]) -> List[Document]:
+        docstore = vectorstore.docstore
+        id_map = vectorstore.index_to_docstore_id
+        return [docstore.search(id_map[vector_id]) for vector_id in vector_ids]
+
+    def search_batch(self, queries: List[str], top_k: int = 3, mode: Optional[str] = None) -> List[List[Document]]:
+        """`search` for many queries, with one batched embedding call (and one FAISS search for "dense")."""
+        mode = mode or self.retrieval_mode
+        vectorstore = self.vectorstore
+        if vectorstore is None or vectorstore.index.ntotal == 0 or not queries:
+            return [[] for _ in queries]
+        if mode == "lexical":
+            return [self.search_chunks(query, top_k=top_k, mode=mode) for query in queries]
+        with span("embed"):
+            vectors = np.asarray(self.embeddings.embed_documents(queries), dtype="float32")
+        if mode == "hybrid":
+            return [
+                self.search_chunks(query, top_k=top_k, mode=mode, vector=vector)
+                for query, vector in zip(queries, vectors)
+            ]
+        with span("faiss_search"):
+            _, labels = vectorstore.index.search(vectors, top_k)
+        return [self.documents(vectorstore, [int(label) for label in row if label != -1]) for row in labels]
+
+    def benchmark_index_types(self, queries: List[str], specs: List[IndexSpec], top_k: int = 3) -> List[dict]:
+        """
+        Recall@k and latency of each index spec against exact search, over this helper's vectors.
+        Needs the current index to be flat, since that is the only one the exact vectors can be
+        read back from.
+        """
+        if self.index_spec.index_type != "flat":
+            raise ValueError("benchmark needs a flat index to read exact vectors from")
+        vectors = exact_vectors(self.vectorstore.index)
+        query_vectors = np.asarray(self.embeddings.embed_documents(queries), dtype="float32")
+        return recall_latency_report(vectors, query_vectors, specs, top_k=top_k)
+
+    def compare_retrieval_modes(self, records: List[dict], top_k: int = 3, window_chars: int = 1000) -> List[dict]:
+        """
+        Latency and quality of every retrieval mode on eval records (context + continuation),
+        querying with the trailing `window_chars` of each context as RetrievalPolicy does.
+        There are no relevance labels, so quality is measured three ways:
+          dense_overlap  share of the dense top-k also returned (agreement with the default mode)
+          source_hit     share of queries with a chunk containing the continuation's first 64 chars
+          term_recall    share of the continuation's (first 200 chars') terms found in the chunks
+        """
+        queries = [record["context"][-window_chars:] for record in records]
+        started = time.perf_counter()
+        self._lexical = None
+        self.lexical_index()
+        build_ms = (time.perf_counter() - started) * 1000.0
+
+        results: Dict[str, List[List[str]]] = {}
+        rows = []
+        for mode in RETRIEVAL_MODES:
+            self.search_chunks(queries[0], top_k=top_k, mode=mode)  # warm-up
+            latencies, results[mode] = [], []
+            for query in queries:
+                started = time.perf_counter()
+                docs = self.search_chunks(query, top_k=top_k, mode=mode)
+                latencies.append((time.perf_counter() - started) * 1000.0)
+                results[mode].append([doc.page_content for doc in docs])
+
+            overlap, source_hits, term_recall = [], [], []
+            for record, texts, dense in zip(records, results[mode], results["dense"]):
+                overlap.append(len(set(texts) & set(dense)) / max(1, len(dense)))
+                head = record["continuation"].strip()[:64]
+                source_hits.append(bool(head) and any(head in text for text in texts))
+                wanted = set(terms(record["continuation"][:200]))
+                found = set(terms(" ".join(texts)))
+                if wanted:
+                    term_recall.append(len(wanted & found) / len(wanted))
+            latencies.sort()
+            rows.append({
+                "mode": mode,
+                "queries": len(queries),
+                "ms_mean": sum(latencies) / len(latencies),
+                "ms_p50": latencies[len(latencies) // 2],
+                "ms_p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+                "dense_overlap": sum(overlap) / len(overlap),
+                "source_hit": sum(source_hits) / len(source_hits),
+                "term_recall": sum(term_recall) / max(1, len(term_recall)),
+                "bm25_build_ms": 0.0 if mode == "dense" else build_ms,
+            })
+        return rows
+
+
+class RetrievalPolicy:
+    """
+    Decides when a keystroke actually needs embedding + search.
+
+    - contexts shorter than `min_context_chars` skip retrieval altogether;
+    - only the last `window_chars` characters of the context are embedded;
+    - per session, if the user only appended fewer than `recheck_chars` characters since the
+      last check, the previous documents are reused without embedding anything;
+    - otherwise the window is embedded, and if it is still within `similarity_threshold`
+      (cosine) of the query that produced the session's documents, they are reused without
+      searching the index.
+
+    With the helper in "lexical" mode nothing is embedded: the second reuse check is skipped
+    and every search goes to BM25.
+    """
+    def __init__(
+        self,
+        rag_helper: RAGHelper,
+        window_chars: int = 1000,
+        min_context_chars: int = 20,
+        recheck_chars: int = 16,
+        similarity_threshold: float = 0.9,
+        max_sessions: int = 10000
+    ):
+        self.rag_helper = rag_helper
+        self.window_chars = window_chars
+        self.min_context_chars = min_context_chars
+        self.recheck_chars = recheck_chars
+        self.similarity_threshold = similarity_threshold
+        self.max_sessions = max_sessions
+
+        # session id -> {"context_len", "window", "anchor", "version", "texts"}
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.skipped_short = 0
+        self.reused_unchanged = 0
+        self.reused_similar = 0
+        self.searched = 0
+
+    def too_short(self, text: str) -> bool:
+        return len(text.strip()) < self.min_context_chars
+
+    def query_window(self, text: str) -> str:
+        return text[-self.window_chars:]
+
+    def embed(self, window: str) -> np.ndarray:
+        with span("embed"):
+            vector = np.asarray(self.rag_helper.embeddings.embed_query(window), dtype="float32")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def search(self, window: str, vector: Optional[np.ndarray], top_k: int) -> List[Union[str, List[int]]]:
+        """Top-k chunks as their stored token ids, or as text if the index has none."""
+        docs = self.rag_helper.search_chunks(window, top_k=top_k, vector=vector)
+        return [doc.metadata.get("token_ids", doc.page_content) for doc in docs]
+
+    def retrieve(
+        self,
+        text: str,
+        session_id: Optional[str] = None,
+        top_k: int = 3
+    ) -> List[Union[str, List[int]]]:
+        """Chunks for `text` (see `search`), re-using the session's previous result when it cannot have changed."""
+        with self._lock:
+            self.requests += 1
+        if self.too_short(text):
+            with self._lock:
+                self.skipped_short += 1
+            return []
+
+        window = self.query_window(text)
+        version = self.rag_helper.version
+        with self._lock:
+            state = self._sessions.get(session_id) if session_id is not None else None
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+
+        if state is not None and state["version"] == version and state["top_k"] == top_k:
+            # 1) Only a few characters appended since the last check: nothing to recompute
+            previous = state["window"]
+            start = state["context_len"] - len(previous)
+            appended = len(text) - state["context_len"]
+            if 0 <= appended < self.recheck_chars and text[start:state["context_len"]] == previous:
+                with self._lock:
+                    self.reused_unchanged += 1
+                return state["texts"]
+
+        # 2) Embed the trailing window; reuse the documents if the query barely moved
+        vector = None if self.rag_helper.retrieval_mode == "lexical" else self.embed(window)
+        if vector is not None and state is not None and state["version"] == version and state["top_k"] == top_k:
+            if float(np.dot(vector, state["anchor"])) >= self.similarity_threshold:
+                self._remember(session_id, text, window, state["anchor"], version, top_k, state["texts"])
+                with self._lock:
+                    self.reused_similar += 1
+                return state["texts"]
+
+        # 3) Search; this query becomes the session's new anchor
+        texts = self.search(window, vector, top_k)
+        with self._lock:
+            self.searched += 1
+        if session_id is not None:
+            self._remember(session_id, text, window, vector, version, top_k, texts)
+        return texts
+
+    def _remember(self, session_id, text, window, anchor, version, top_k, texts):
+        with self._lock:
+            self._sessions[session_id] = {
+                "context_len": len(text),
+                "window": window,
+                "anchor": anchor,
+                "version": version,
+                "top_k": top_k,
+                "texts": texts,
+            }
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def drop(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.requests or 1
+            return {
+                "mode": self.rag_helper.retrieval_mode,
+                "sessions": len(self._sessions),
+                "requests": self.requests,
+                "skipped_short": self.skipped_short,
+                "reused_unchanged": self.reused_unchanged,
+                "reused_similar": self.reused_similar,
+                "searched": self.searched,
+                "skip_rate": self.skipped_short / total,
+                "reuse_rate": (self.reused_unchanged + self.reused_similar) / total,
+                "search_rate": self.searched / total,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, incrementally update or benchmark the RAG index.")
+    parser.add_argument("command", choices=["build", "update", "benchmark", "compare-modes"],
+                        help="'build' re-embeds everything, 'update' only embeds changed docs, "
+                             "'benchmark' compares approximate index types against exact search, "
+                             "'compare-modes' compares dense, lexical and hybrid retrieval on --queries")
+    parser.add_argument("--docs-dir", default="data/docs")
+    parser.add_argument("--index-dir", default="data/index")
+    parser.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="embedding processes (0 embeds in the main process)")
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks per embedding batch")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat")
+    parser.add_argument("--nlist", type=int, default=1024, help="IVF centroids")
+    parser.add_argument("--pq-m", type=int, default=64, help="PQ bytes per vector")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="HNSW neighbours per node")
+    parser.add_argument("--queries", default="../data/processed/bbc_context_pairs_eval",
+                        help="benchmark / compare-modes: JSONL (or split directory) whose contexts are used as queries")
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--window-chars", type=int, default=1000, help="compare-modes: query with this context tail")
+    parser.add_argument("--hybrid-candidates", type=int, default=50, help="BM25 candidates re-ranked in hybrid mode")
+    parser.add_argument("--report", help="benchmark / compare-modes: also write the rows to this JSON file")
+    args = parser.parse_args()
+
+    spec = IndexSpec(
+        index_type=args.index_type, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m
+    )
+    if args.command == "benchmark":
+        # Exact vectors come from a flat index; the candidates are built from them in memory
+        spec = IndexSpec()
+        manifest_path = os.path.join(args.index_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                saved_type = json.load(f).get("index", {}).get("index_type")
+            if saved_type not in (None, "flat"):
+                parser.error(f"{args.index_dir} holds a {saved_type} index; benchmark needs a flat one "
+                             f"(build it into another --index-dir)")
+
+    # Constructing the helper already loads the saved index and applies pending doc changes
+    helper = RAGHelper(
+        docs_dir=args.docs_dir,
+        index_dir=args.index_dir,
+        embedding_model=args.embedding_model,
+        force_rebuild=args.command == "build",
+        embed_workers=args.workers,
+        embed_batch_size=args.batch_size,
+        index_spec=spec,
+        hybrid_candidates=args.hybrid_candidates
+    )
+
+    rows = None
+    if args.command == "benchmark":
+        queries = [record["context"] for record in itertools.islice(read_records(args.queries), args.num_queries)]
+        candidates = [
+            IndexSpec(index_type=t, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+            for t in INDEX_TYPES
+        ]
+        rows = helper.benchmark_index_types(queries, candidates, top_k=args.top_k)
+    elif args.command == "compare-modes":
+        records = list(itertools.islice(read_records(args.queries), args.num_queries))
+        rows = helper.compare_retrieval_modes(records, top_k=args.top_k, window_chars=args.window_chars)
+    if rows is not None:
+        print_report(rows)
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# result_cache.py
+# In-process LRU/TTL cache for retrieval results and completions, keyed on the normalized tail
+# of the context, with an optional SQLite file shared by several server workers.
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_context(text: str) -> str:
+    """Collapse whitespace runs so retyped text with different spacing maps to the same key."""
+    return _WHITESPACE.sub(" ", text).lstrip()
+
+
+def context_tail(text: str, tokenizer, n_tokens: int = 64) -> List[int]:
+    """
+    Token ids of the last `n_tokens` tokens of the normalized context. Only a bounded slice of
+    characters is tokenized, so the cost does not grow with the length of the document.
+    """
+    normalized = normalize_context(text)
+    # GPT-2 tokens average ~4 characters; 8 per token leaves plenty of slack
+    return tokenizer.encode(normalized[-n_tokens * 8:])[-n_tokens:]
+
+
+def make_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def model_cache_id(model_path: str, *settings: Any) -> str:
+    """
+    Key part naming the model behind cached completions: its path or hub name, the newest file
+    time of a local checkpoint (so retraining into the same directory counts as a new model),
+    and any `settings` that change its output, e.g. the inference backend.
+    """
+    modified = None
+    if os.path.isdir(model_path):
+        modified = max(
+            (os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(model_path) for name in names),
+            default=None
+        )
+    return make_key(model_path, modified, *settings)
+
+
+class ResultCache:
+    """
+    LRU cache with a per-entry TTL, bounded by entry count and by the size of the JSON-encoded
+    values. Values must be JSON-serializable. If `disk_path` is set, misses fall through to a
+    SQLite table in that file, so workers on the same host share each other's results.
+    """
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_s: float = 600.0,
+        disk_path: Optional[str] = None,
+        max_disk_entries: int = 200000
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+
+        # key -> (expires_at, nbytes, value)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._disk_writes = 0
+
+        self._local = threading.local()
+        if disk_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS results ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS results_expiry ON results (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, nor with a forked child
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.disk_path, timeout=1.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self._evict(key)
+
+        if self.disk_path is not None:
+            try:
+                with self._connect() as conn:
+                    row = conn.execute(
+                        "SELECT value, expires_at FROM results WHERE key = ? AND expires_at > ?",
+                        (key, now)
+                    ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Result cache disk lookup failed: {e}")
+                row = None
+            if row is not None:
+                value = json.loads(row[0])
+                self._put_memory(key, value, len(row[0]), row[1])
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Any):
+        encoded = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self.ttl_s
+        self._put_memory(key, value, len(encoded), expires_at)
+
+        if self.disk_path is not None:
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO results (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, encoded, expires_at)
+                    )
+                    # Every so often keep the shared table bounded: drop expired rows,
+                    # then the ones closest to expiring
+                    self._disk_writes += 1
+                    if self._disk_writes % 100 == 0:
+                        conn.execute("DELETE FROM results WHERE expires_at <= ?", (time.time(),))
+                        conn.execute(
+                            "DELETE FROM results WHERE key IN (SELECT key FROM results "
+                            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                            (self.max_disk_entries,)
+                        )
+            except sqlite3.Error as e:
+                print(f"Result cache disk write failed: {e}")
+
+    def _put_memory(self, key: str, value: Any, nbytes: int, expires_at: float):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (expires_at, nbytes, value)
+            self.total_bytes += nbytes
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _evict(self, key: str):
+        # Caller holds self._lock
+        _, nbytes, _ = self._entries.pop(key)
+        self.total_bytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
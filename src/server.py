@@ -1,43 +1,647 @@
 # Run the server with:
 #   python -m uvicorn server:app --host 0.0.0.0 --port 8000
+# or, with several workers sharing one copy of the model and index:
+#   python prefork.py --workers 4 --port 8000
 
-from fastapi import FastAPI
-from pydantic import BaseModel
+import asyncio
+import json
+import os
+import threading
+import time
+import traceback
+from typing import AsyncIterator, Optional
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import iterate_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, validator
+from starlette.background import BackgroundTask
 
 # Local imports
 from model_infer import AutocompleteModel  # You must implement or import this
-from rag_utils import RAGHelper           # See rag_utils.py below
+from rag_utils import RAGHelper, RetrievalPolicy  # See rag_utils.py below
+from batching import BatchScheduler
+from kv_cache import PrefixCache
+from concurrency import (
+    BoundedExecutor, CancelEvent, DeadlineExceeded, InFlightRequests, Overloaded, SlotLimiter, Superseded, deadline_after,
+    wait_with_deadline
+)
+from result_cache import ResultCache, context_tail, make_key, model_cache_id
+from faiss_index import IndexSpec
+from stopping import GRANULARITIES
+from metrics import (
+    COMPLETION_SECONDS, CONTENT_TYPE, REGISTRY, SKIPPED_DECODE_TOKENS, STAGE_SECONDS, SUPERSEDED_REQUESTS, process_memory,
+    record_cache_lookup, span
+)
+from profiling import SamplingProfiler
+from phrase_index import PhraseIndex
+
+# ======================
+# CONFIG
+# ======================
+
+# Requests arriving within BATCH_WINDOW_MS of each other share one generate call
+MAX_BATCH_SIZE = int(os.environ.get("AUTOCOMPLETE_MAX_BATCH_SIZE", 8))
+BATCH_WINDOW_MS = float(os.environ.get("AUTOCOMPLETE_BATCH_WINDOW_MS", 10))
+# Memory cap for the per-session prompt KV caches (LRU-evicted across sessions)
+PREFIX_CACHE_MB = int(os.environ.get("AUTOCOMPLETE_PREFIX_CACHE_MB", 512))
+# Session requests join the padded batch and only re-use their prefix cache when decoded alone;
+# "1" always decodes them alone (serially) with their prefix cache instead
+PREFER_PREFIX_CACHE = os.environ.get("AUTOCOMPLETE_PREFER_PREFIX_CACHE", "0") == "1"
+# Hub name or local checkpoint of the model, e.g. "./finetuned_model" (see model_finetune.py)
+MODEL_PATH = os.environ.get("AUTOCOMPLETE_MODEL_PATH", "gpt2")
+# How the model runs on CPU: "eager" (full precision), "int8" (dynamic quantization) or
+# "torchscript" (traced graph, saved to/loaded from AUTOCOMPLETE_EXPORT_PATH if set);
+# compare them with backend_parity.py before switching
+MODEL_BACKEND = os.environ.get("AUTOCOMPLETE_BACKEND", "eager")
+EXPORT_PATH = os.environ.get("AUTOCOMPLETE_EXPORT_PATH")
+# Greedy requests draft up to this many tokens per forward pass from the prompt and retrieved
+# chunks (prompt-lookup speculative decoding, same output as plain greedy); 0 disables it
+SPECULATIVE_TOKENS = int(os.environ.get("AUTOCOMPLETE_SPECULATIVE_TOKENS", 0))
+# Prompt token budget: retrieved docs first (up to MAX_DOC_TOKENS), then the most recent context
+MAX_PROMPT_TOKENS = int(os.environ.get("AUTOCOMPLETE_MAX_PROMPT_TOKENS", 512))
+MAX_DOC_TOKENS = int(os.environ.get("AUTOCOMPLETE_MAX_DOC_TOKENS", 128))
+# Load shedding: how much work may run / wait before new requests get a fast 429
+RETRIEVAL_WORKERS = int(os.environ.get("AUTOCOMPLETE_RETRIEVAL_WORKERS", 4))
+RETRIEVAL_QUEUE = int(os.environ.get("AUTOCOMPLETE_RETRIEVAL_QUEUE", 32))
+GENERATION_QUEUE = int(os.environ.get("AUTOCOMPLETE_GENERATION_QUEUE", 32))
+MAX_STREAMS = int(os.environ.get("AUTOCOMPLETE_MAX_STREAMS", 4))
+# Requests not finished within this time get a 503 (a request may ask for less)
+REQUEST_TIMEOUT_MS = float(os.environ.get("AUTOCOMPLETE_REQUEST_TIMEOUT_MS", 5000))
+# "greedy" decoding is deterministic, so its completions can be cached; "sample" is not
+DECODING = os.environ.get("AUTOCOMPLETE_DECODING", "sample")
+# Where suggestions end: "word" / "phrase" / "sentence" / "newline", or "none" for max_length tokens
+STOP_AT = os.environ.get("AUTOCOMPLETE_STOP_AT", "sentence")
+# Also stop before the first token the model gives less than this probability (unset: off)
+MIN_PROB = float(os.environ["AUTOCOMPLETE_MIN_PROB"]) if os.environ.get("AUTOCOMPLETE_MIN_PROB") else None
+# Upper bound on max_length (tokens) per request, so one request cannot hold a batch for long
+MAX_NEW_TOKENS = int(os.environ.get("AUTOCOMPLETE_MAX_NEW_TOKENS", 128))
+# Upper bound on n_candidates per request
+MAX_CANDIDATES = int(os.environ.get("AUTOCOMPLETE_MAX_CANDIDATES", 5))
+# Result cache: keyed on the last CACHE_TAIL_TOKENS tokens of the context plus generation params
+CACHE_TAIL_TOKENS = int(os.environ.get("AUTOCOMPLETE_CACHE_TAIL_TOKENS", 64))
+CACHE_MAX_ENTRIES = int(os.environ.get("AUTOCOMPLETE_CACHE_MAX_ENTRIES", 10000))
+CACHE_MAX_MB = int(os.environ.get("AUTOCOMPLETE_CACHE_MAX_MB", 64))
+CACHE_TTL_S = float(os.environ.get("AUTOCOMPLETE_CACHE_TTL_S", 600))
+# Optional SQLite file shared by all workers on the host, e.g. "data/cache/results.sqlite"
+CACHE_DISK_PATH = os.environ.get("AUTOCOMPLETE_CACHE_DISK_PATH")
+# Vector index: "flat" (exact), or approximate/compressed "ivf" / "ivfpq" / "hnsw" for large corpora
+# (build settings must match `rag_utils.py build`, otherwise the index is rebuilt on start)
+INDEX_TYPE = os.environ.get("AUTOCOMPLETE_INDEX_TYPE", "flat")
+INDEX_NLIST = int(os.environ.get("AUTOCOMPLETE_INDEX_NLIST", 1024))
+INDEX_PQ_M = int(os.environ.get("AUTOCOMPLETE_INDEX_PQ_M", 64))
+INDEX_HNSW_M = int(os.environ.get("AUTOCOMPLETE_INDEX_HNSW_M", 32))
+INDEX_NPROBE = int(os.environ.get("AUTOCOMPLETE_INDEX_NPROBE", 16))
+INDEX_EF_SEARCH = int(os.environ.get("AUTOCOMPLETE_INDEX_EF_SEARCH", 64))
+# Retrieval gating: embed only the trailing window, skip short contexts, and re-use a session's
+# documents while its query embedding stays within the similarity threshold
+RETRIEVAL_WINDOW_CHARS = int(os.environ.get("AUTOCOMPLETE_RETRIEVAL_WINDOW_CHARS", 1000))
+RETRIEVAL_MIN_CHARS = int(os.environ.get("AUTOCOMPLETE_RETRIEVAL_MIN_CHARS", 20))
+RETRIEVAL_RECHECK_CHARS = int(os.environ.get("AUTOCOMPLETE_RETRIEVAL_RECHECK_CHARS", 16))
+RETRIEVAL_SIMILARITY = float(os.environ.get("AUTOCOMPLETE_RETRIEVAL_SIMILARITY", 0.9))
+# "dense" (embedding + FAISS), "lexical" (BM25 only, no embedding) or "hybrid" (BM25 candidates
+# re-ranked by embedding distance); compare them with `rag_utils.py compare-modes`
+RETRIEVAL_MODE = os.environ.get("AUTOCOMPLETE_RETRIEVAL_MODE", "dense")
+HYBRID_CANDIDATES = int(os.environ.get("AUTOCOMPLETE_HYBRID_CANDIDATES", 50))
+# Phrase-index fast path (phrase_index.py): stock phrases of the data/docs corpus are completed
+# from an n-gram table, without retrieval or GPT-2, when the table is at least PHRASE_MIN_CONFIDENCE
+# sure of the whole phrase and saw each context PHRASE_MIN_COUNT times; "0" turns it off
+PHRASE_INDEX = os.environ.get("AUTOCOMPLETE_PHRASE_INDEX", "1") == "1"
+PHRASE_MIN_CONFIDENCE = float(os.environ.get("AUTOCOMPLETE_PHRASE_MIN_CONFIDENCE", 0.6))
+PHRASE_MIN_COUNT = int(os.environ.get("AUTOCOMPLETE_PHRASE_MIN_COUNT", 5))
+# Allow starting the sampling profiler over HTTP (POST /debug/profile/start)
+PROFILING_ENABLED = os.environ.get("AUTOCOMPLETE_PROFILING", "0") == "1"
+# Length of the warm-up completion each worker runs before /ready reports ready
+WARMUP_TOKENS = int(os.environ.get("AUTOCOMPLETE_WARMUP_TOKENS", 4))
+WARMUP_TEXT = "The government announced new measures on Tuesday to"
 
 # Initialize FastAPI app
 app = FastAPI()
 
 # Global model instance (GPT-2 or a fine-tuned variant)
-autocomplete_model = AutocompleteModel("gpt2")
+autocomplete_model = AutocompleteModel(
+    MODEL_PATH,
+    prefix_cache=PrefixCache(max_bytes=PREFIX_CACHE_MB * 1024 * 1024),
+    max_prompt_tokens=MAX_PROMPT_TOKENS,
+    max_doc_tokens=MAX_DOC_TOKENS,
+    backend=MODEL_BACKEND,
+    export_path=EXPORT_PATH,
+    speculative_tokens=SPECULATIVE_TOKENS
+)
+
+# Micro-batching scheduler in front of the model
+batch_scheduler = BatchScheduler(
+    autocomplete_model,
+    max_batch_size=MAX_BATCH_SIZE,
+    batch_window_ms=BATCH_WINDOW_MS,
+    max_queue_size=GENERATION_QUEUE,
+    prefer_prefix_cache=PREFER_PREFIX_CACHE
+)
+
+# Dedicated, size-limited pools so blocking FAISS/torch work never runs on the event loop
+retrieval_pool = BoundedExecutor(RETRIEVAL_WORKERS, RETRIEVAL_QUEUE, name="retrieval")
+stream_limiter = SlotLimiter(MAX_STREAMS, name="streams")
+# Per editor session, a new request cancels the previous one's remaining retrieval/generation
+in_flight = InFlightRequests()
+
+# Cache in front of retrieval and (deterministic) generation
+result_cache = ResultCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=CACHE_MAX_MB * 1024 * 1024,
+    ttl_s=CACHE_TTL_S,
+    disk_path=CACHE_DISK_PATH
+)
+# Completions are keyed on the model too, as the disk cache outlives a switch of model or backend
+MODEL_CACHE_ID = model_cache_id(MODEL_PATH, MODEL_BACKEND, MAX_PROMPT_TOKENS, MAX_DOC_TOKENS)
+
+# Global RAG helper to build & query the FAISS vector store.
+# The index is saved to index_dir once and loaded from there on later starts,
+# doc changes are applied incrementally (see POST /index/refresh).
+rag_helper = RAGHelper(
+    docs_dir="data/docs",  # path of docs
+    index_dir="data/index",
+    index_spec=IndexSpec(
+        index_type=INDEX_TYPE,
+        nlist=INDEX_NLIST,
+        pq_m=INDEX_PQ_M,
+        hnsw_m=INDEX_HNSW_M,
+        nprobe=INDEX_NPROBE,
+        ef_search=INDEX_EF_SEARCH
+    ),
+    retrieval_mode=RETRIEVAL_MODE,
+    hybrid_candidates=HYBRID_CANDIDATES
+)
+
+# Decides per keystroke whether embedding + search can change the retrieved docs
+retrieval_policy = RetrievalPolicy(
+    rag_helper,
+    window_chars=RETRIEVAL_WINDOW_CHARS,
+    min_context_chars=RETRIEVAL_MIN_CHARS,
+    recheck_chars=RETRIEVAL_RECHECK_CHARS,
+    similarity_threshold=RETRIEVAL_SIMILARITY
+)
+
+# n-gram phrase table over the same docs, rebuilt along with the index when they change
+phrase_index = (
+    PhraseIndex.load_or_build("data/docs", "data/phrase_index", autocomplete_model.tokenizer) if PHRASE_INDEX else None
+)
+
+# Set once warm_up has run in this process; /ready answers 503 until then
+ready = threading.Event()
+
+def warm_up():
+    """
+    One retrieval and one short greedy completion, so that first-call costs (thread pools,
+    allocator growth, graph optimization) are not paid by the first real request.
+    """
+    with span("warm_up"):
+        docs = retrieval_policy.search(WARMUP_TEXT, None, top_k=3)
+        autocomplete_model.generate_text(WARMUP_TEXT, docs, max_length=WARMUP_TOKENS, do_sample=False)
+
+# Exposed on /metrics next to the stage timings and token counters from metrics.py
+REQUESTS = REGISTRY.counter("autocomplete_http_requests_total", "HTTP requests", labels=("path", "status"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "autocomplete_http_request_seconds", "Time to the response (headers, for streams)", labels=("path",)
+)
+REGISTRY.gauge("autocomplete_generation_queue_depth", "Requests waiting for the batch scheduler",
+               batch_scheduler.queue_depth)
+REGISTRY.gauge("autocomplete_retrieval_outstanding", "Retrieval tasks running or queued",
+               lambda: retrieval_pool.outstanding)
+REGISTRY.gauge("autocomplete_active_streams", "Streaming completions in progress", lambda: stream_limiter.active)
+REGISTRY.gauge("autocomplete_prefix_cache_bytes", "KV cache bytes held for sessions",
+               lambda: autocomplete_model.prefix_cache.total_bytes)
+REGISTRY.gauge("autocomplete_result_cache_entries", "Entries in the in-memory result cache",
+               lambda: result_cache.stats()["entries"])
+REGISTRY.gauge("autocomplete_process_resident_bytes", "Resident memory of this worker (RSS)",
+               lambda: process_memory()["rss"])
+REGISTRY.gauge("autocomplete_process_proportional_bytes",
+               "Resident memory with pages shared between workers divided among them (PSS)",
+               lambda: process_memory()["pss"])
+REGISTRY.gauge("autocomplete_process_private_bytes", "Resident memory not shared with any other process",
+               lambda: process_memory()["private"])
+
+profiler = SamplingProfiler()
+
+@app.on_event("startup")
+def start_warm_up():
+    """Warm up in the background, so /health answers at once and /ready once warm_up is done."""
+    def run():
+        try:
+            warm_up()
+        except Exception:
+            traceback.print_exc()
+            return
+        ready.set()
+        print(f"Worker {os.getpid()} ready")
 
-# Global RAG helper to build & query the FAISS vector store
-rag_helper = RAGHelper(docs_dir="data/docs")#path of docs
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Route templates rather than raw paths, so labels stay few
+    route = request.scope.get("route")
+    path = getattr(route, "path", "unmatched")
+    REQUESTS.inc(path=path, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - started, path=path)
+    return response
 
 class AutocompleteRequest(BaseModel):
     text_before_cursor: str
-    max_length: int = 50
+    max_length: int = Field(50, ge=1, le=MAX_NEW_TOKENS)
+    # Editor session id; successive requests with the same id re-use the prompt KV cache
+    session_id: Optional[str] = None
+    # Per-request deadline; capped at REQUEST_TIMEOUT_MS
+    timeout_ms: Optional[float] = None
+    # Greedy (deterministic, cacheable) decoding; defaults to AUTOCOMPLETE_DECODING
+    greedy: Optional[bool] = None
+    # Suggestion granularity ("word", "phrase", "sentence", "newline" or "none"); defaults to AUTOCOMPLETE_STOP_AT
+    stop_at: Optional[str] = None
+    # Confidence cutoff for the next token; defaults to AUTOCOMPLETE_MIN_PROB
+    min_prob: Optional[float] = None
+    # Alternative suggestions to return, ranked, from one shared prompt prefill
+    n_candidates: int = Field(1, ge=1, le=MAX_CANDIDATES)
+
+    @property
+    def do_sample(self) -> bool:
+        greedy = self.greedy if self.greedy is not None else DECODING == "greedy"
+        return not greedy
+
+    @validator("stop_at")
+    def known_granularity(cls, value):
+        if value is not None and value != "none" and value not in GRANULARITIES:
+            raise ValueError(f"stop_at must be one of {GRANULARITIES} or 'none'")
+        return value
+
+    @property
+    def stop_granularity(self) -> Optional[str]:
+        stop_at = self.stop_at if self.stop_at is not None else STOP_AT
+        return None if stop_at == "none" else stop_at
+
+    @property
+    def confidence_cutoff(self) -> Optional[float]:
+        return self.min_prob if self.min_prob is not None else MIN_PROB
+
+def request_deadline(req: AutocompleteRequest) -> float:
+    timeout_ms = REQUEST_TIMEOUT_MS
+    if req.timeout_ms is not None:
+        timeout_ms = min(timeout_ms, req.timeout_ms)
+    return deadline_after(timeout_ms)
+
+def retrieve(text: str, top_k: int = 3, session_id: Optional[str] = None):
+    """
+    Gated, cached RAG search. Returns (cache tail, chunks); chunks are the token ids stored in
+    the index, and the tail is re-used to key the completion cache.
+    Requests with a session id go through the session's retrieval state instead of the cache.
+    """
+    tail = context_tail(text, autocomplete_model.tokenizer, CACHE_TAIL_TOKENS)
+    if session_id is not None:
+        return tail, retrieval_policy.retrieve(text, session_id=session_id, top_k=top_k)
+    key = make_key("search", rag_helper.version, tail, top_k)
+    texts = record_cache_lookup("search", result_cache.get(key))
+    if texts is None:
+        texts = retrieval_policy.retrieve(text, top_k=top_k)
+        result_cache.put(key, texts)
+    return tail, texts
+
+def phrase_completion(req: AutocompleteRequest) -> Optional[dict]:
+    """
+    The phrase index's answer to `req`, or None to ask the model: when the index is off or not
+    confident, and for requests it cannot serve (several candidates, or no stop granularity).
+    """
+    if phrase_index is None or req.n_candidates > 1 or req.stop_granularity is None:
+        return None
+    stopper = autocomplete_model.new_stopper(req.stop_granularity, req.confidence_cutoff, req.max_length)
+    with span("phrase_lookup"):
+        text = phrase_index.complete(req.text_before_cursor, stopper, PHRASE_MIN_CONFIDENCE, PHRASE_MIN_COUNT)
+    if text is None:
+        return None
+    return {"completion": text, "stop_reason": stopper.reason, "source": "phrase_index"}
+
+def record_completion(source: str, started: float):
+    """Latency of one completion by what answered it (phrase_index, cache or model), for comparing the paths."""
+    seconds = time.perf_counter() - started
+    COMPLETION_SECONDS.observe(seconds, source=source)
+    if phrase_index is not None:
+        phrase_index.stats.record_latency(source, seconds * 1000.0)
+
+def overloaded_response(e: Exception) -> JSONResponse:
+    return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "1"})
+
+def deadline_response() -> JSONResponse:
+    return JSONResponse(status_code=503, content={"error": "deadline exceeded"})
+
+def superseded_response(e: Superseded) -> JSONResponse:
+    # The client has already sent the request that replaced this one and ignores the answer
+    return JSONResponse(status_code=409, content={"error": str(e), "superseded": True})
+
+def record_superseded(stage: str, tokens_skipped: int = 0):
+    """Count work skipped because a newer request of the same session arrived."""
+    in_flight.record_cancelled(stage, tokens_skipped)
+    SUPERSEDED_REQUESTS.inc(stage=stage)
+    if tokens_skipped:
+        SKIPPED_DECODE_TOKENS.inc(tokens_skipped)
 
 @app.post("/autocomplete")
-def autocomplete(req: AutocompleteRequest):
+async def autocomplete(req: AutocompleteRequest):
     """Endpoint to perform text autocompletion with optional RAG retrieval."""
+    started = time.perf_counter()
+    deadline = request_deadline(req)
+    # Supersedes the session's previous request, and is set in turn by its next one or the
+    # deadline, which stops this request's retrieval/generation work that is still pending
+    cancel = in_flight.start(req.session_id)
+    try:
+        # 0) Stock phrases are answered from the phrase index, without retrieval or GPT-2
+        response = phrase_completion(req)
+        if response is not None:
+            record_completion("phrase_index", started)
+            return response
+
+        # 1) Retrieve top-k relevant docs from FAISS (or the result cache)
+        with span("retrieve"):
+            tail, retrieved_texts = await retrieval_pool.run(
+                retrieve, req.text_before_cursor, 3, req.session_id, deadline=deadline, cancel=cancel
+            )
+        if cancel.superseded:
+            raise Superseded("generation")
+
+        # Sampled completions differ on every call, so only greedy ones are cached
+        # (several candidates are always partly sampled)
+        cache_key = None
+        if not req.do_sample and req.n_candidates == 1:
+            cache_key = make_key(
+                "generate", MODEL_CACHE_ID, tail, retrieved_texts, req.max_length, req.stop_granularity, req.confidence_cutoff
+            )
+            cached = record_cache_lookup("completion", result_cache.get(cache_key))
+            if cached is not None:
+                # Kept apart from "model", whose latency would otherwise look like a cache lookup's
+                record_completion("cache", started)
+                return {**cached, "source": "cache"}
+
+        # 2) Call the language model's generate method (batched with concurrent requests)
+        future = batch_scheduler.submit(
+            prompt=req.text_before_cursor,
+            retrieved_docs=retrieved_texts,
+            max_length=req.max_length,
+            temperature=0.7,
+            top_p=0.9,
+            session_id=req.session_id,
+            deadline=deadline,
+            do_sample=req.do_sample,
+            stop_at=req.stop_granularity,
+            min_prob=req.confidence_cutoff,
+            n_candidates=req.n_candidates,
+            cancel=cancel
+        )
+        with span("generate"):
+            completions = await wait_with_deadline(asyncio.wrap_future(future), deadline, cancel)
+        if completions[0].stop_reason == "cancelled":
+            # Stopped mid-decode; a cut-off suggestion must not be returned or cached
+            record_superseded("decode", max(0, req.max_length - max(c.num_tokens for c in completions)))
+            return superseded_response(Superseded("decode"))
+        # stop_reason: "eos", "length", "low_confidence" or the granularity boundary that was reached
+        response = {"completion": completions[0].text, "stop_reason": completions[0].stop_reason, "source": "model"}
+        if req.n_candidates > 1:
+            # De-duplicated, best first; score is the mean log-probability per token
+            response["candidates"] = [
+                {"completion": c.text, "stop_reason": c.stop_reason, "score": c.score} for c in completions
+            ]
+        if cache_key is not None:
+            result_cache.put(cache_key, response)
+
+        record_completion("model", started)
+        return response
+    except Overloaded as e:
+        return overloaded_response(e)
+    except DeadlineExceeded:
+        return deadline_response()
+    except Superseded as e:
+        record_superseded(e.stage)
+        return superseded_response(e)
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    finally:
+        in_flight.finish(req.session_id, cancel)
+
+async def stream_completion_events(
+    req: AutocompleteRequest,
+    stop_event: CancelEvent,
+    slot,
+    request: Optional[Request] = None
+) -> AsyncIterator[dict]:
+    """
+    Yield {"token": ...} events as the completion is decoded, then one {"done": ...} event
+    with time-to-first-token and the stop reason. Decoding stops as soon as stop_event is set, the HTTP client
+    disconnects, a newer request of the same session starts, or this generator is closed/cancelled.
+    `slot` (from stream_limiter) is released when the stream ends.
+    """
+    started = time.perf_counter()
+    first_token_ms = None
+    deadline = request_deadline(req)
+    in_flight.start(req.session_id, stop_event)
     try:
-        # 1) Retrieve top-k relevant docs from FAISS
-        retrieved_docs = rag_helper.search(req.text_before_cursor, top_k=3)
-        retrieved_texts = [doc.page_content for doc in retrieved_docs]  # doc.page_content is the actual chunk text
+        fast = phrase_completion(req)
+        if fast is not None:
+            yield {"token": fast["completion"]}
+            elapsed_ms = (time.perf_counter() - started) * 1000.0
+            yield {
+                "done": True,
+                "cancelled": False,
+                "stop_reason": fast["stop_reason"],
+                "source": "phrase_index",
+                "ttft_ms": elapsed_ms,
+                "total_ms": elapsed_ms,
+            }
+            return
 
-        # 2) Call the language model's generate method
-        generated_text = autocomplete_model.generate_text(
+        with span("retrieve"):
+            _, retrieved_texts = await retrieval_pool.run(
+                retrieve, req.text_before_cursor, 3, req.session_id, deadline=deadline, cancel=stop_event
+            )
+        if stop_event.superseded:
+            raise Superseded("generation")
+
+        stopper = autocomplete_model.new_stopper(req.stop_granularity, req.confidence_cutoff, req.max_length)
+        tokens = autocomplete_model.stream_text(
             prompt=req.text_before_cursor,
             retrieved_docs=retrieved_texts,
             max_length=req.max_length,
             temperature=0.7,
-            top_p=0.9
+            top_p=0.9,
+            session_id=req.session_id,
+            stop_event=stop_event,
+            do_sample=req.do_sample,
+            stopper=stopper
         )
+        async for text in iterate_in_threadpool(tokens):
+            if request is not None and await request.is_disconnected():
+                stop_event.set()
+                break
+            if time.monotonic() > deadline:
+                stop_event.set()
+                yield {"error": "deadline exceeded", "done": True}
+                return
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - started) * 1000.0
+                STAGE_SECONDS.observe(first_token_ms / 1000.0, stage="stream_first_token")
+            yield {"token": text}
 
-        return {"completion": generated_text}
+        if stop_event.superseded:
+            record_superseded("decode", max(0, req.max_length - stopper.steps))
+        yield {
+            "done": True,
+            "cancelled": stop_event.is_set(),
+            "superseded": stop_event.superseded,
+            "stop_reason": stopper.reason,
+            "source": "model",
+            "ttft_ms": first_token_ms,
+            "total_ms": (time.perf_counter() - started) * 1000.0,
+        }
+    except (Overloaded, DeadlineExceeded) as e:
+        yield {"error": str(e) or "deadline exceeded", "done": True}
+    except Superseded as e:
+        record_superseded(e.stage)
+        yield {"error": str(e), "superseded": True, "done": True}
     except Exception as e:
-        return {"error": str(e)}
+        traceback.print_exc()
+        yield {"error": str(e), "done": True}
+    finally:
+        # Whatever ended the stream, make sure the decode thread stops burning CPU
+        stop_event.set()
+        slot.release()
+        in_flight.finish(req.session_id, stop_event)
+
+@app.post("/autocomplete/stream")
+async def autocomplete_stream(req: AutocompleteRequest, request: Request):
+    """Server-Sent Events version of /autocomplete: one `data:` event per decoded piece of text."""
+    try:
+        slot = stream_limiter.acquire()
+    except Overloaded as e:
+        return overloaded_response(e)
+    stop_event = CancelEvent()
+
+    async def sse():
+        async for event in stream_completion_events(req, stop_event, slot, request):
+            name = "error" if "error" in event else "done" if event.get("done") else "token"
+            yield f"event: {name}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    def cleanup():
+        # Runs even if the client left before the stream started
+        stop_event.set()
+        slot.release()
+
+    return StreamingResponse(sse(), media_type="text/event-stream", background=BackgroundTask(cleanup))
+
+@app.websocket("/autocomplete/ws")
+async def autocomplete_ws(websocket: WebSocket):
+    """
+    WebSocket streaming. The client sends an AutocompleteRequest as JSON and receives
+    {"token": ...} messages followed by {"done": ...}. Any message sent while a completion
+    is streaming stops it; if that message is itself a request, it is served next.
+    """
+    await websocket.accept()
+    # Receiving runs as a task alongside the stream, so a "stop" can arrive mid-completion
+    next_message = None
+    try:
+        while True:
+            if next_message is None:
+                message = await websocket.receive_json()
+            else:
+                message = await next_message
+            next_message = None
+            if not isinstance(message, dict) or "text_before_cursor" not in message:
+                continue  # a stray "stop" with nothing running
+            # Validate before taking a slot, so a bad message neither leaks one nor closes the socket
+            try:
+                req = AutocompleteRequest(**message)
+            except (ValidationError, TypeError) as e:
+                await websocket.send_json({"error": str(e), "done": True})
+                continue
+
+            try:
+                slot = stream_limiter.acquire()
+            except Overloaded as e:
+                await websocket.send_json({"error": str(e), "done": True})
+                continue
+
+            events = None
+            try:
+                stop_event = CancelEvent()
+                next_message = asyncio.create_task(websocket.receive_json())
+                events = stream_completion_events(req, stop_event, slot)
+                async for event in events:
+                    if next_message.done():
+                        stop_event.set()
+                        break
+                    await websocket.send_json(event)
+            finally:
+                if events is not None:
+                    await events.aclose()
+                slot.release()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if next_message is not None:
+            next_message.cancel()
+
+@app.post("/index/refresh")
+def refresh_index():
+    """Embed only new/changed docs under data/docs and drop deleted ones (and rebuild the phrase index), without a restart."""
+    global phrase_index
+    stats = rag_helper.update_index()
+    if phrase_index is not None:
+        refreshed = PhraseIndex.load_or_build("data/docs", "data/phrase_index", autocomplete_model.tokenizer)
+        refreshed.stats = phrase_index.stats
+        phrase_index = refreshed
+        stats["phrase_index_entries"] = len(phrase_index)
+    return {"status": "ok", **stats}
+
+@app.get("/health")
+def health():
+    """Liveness: the worker is up and answering HTTP (it may still be warming up)."""
+    return {"status": "ok", "pid": os.getpid()}
+
+@app.get("/ready")
+def readiness():
+    """Readiness: 200 once this worker's warm-up completion has run, 503 before."""
+    if not ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "warming_up", "pid": os.getpid()})
+    return {"status": "ready", "pid": os.getpid(), "memory": process_memory()}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus scrape endpoint: stage timings, token counters, cache hits and queue depths."""
+    return Response(REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+@app.post("/debug/profile/start")
+def start_profile(interval_ms: float = 5.0, max_seconds: float = 60.0):
+    """Start sampling every thread's stack (needs AUTOCOMPLETE_PROFILING=1)."""
+    if not PROFILING_ENABLED:
+        return JSONResponse(status_code=403, content={"error": "profiling is disabled (AUTOCOMPLETE_PROFILING=1)"})
+    if not profiler.start(interval_ms=interval_ms, max_seconds=max_seconds):
+        return JSONResponse(status_code=409, content={"error": "a profile is already running"})
+    return {"status": "started", **profiler.stats()}
+
+@app.post("/debug/profile/stop")
+def stop_profile():
+    """Stop the profiler and return collapsed stacks ("frame;frame count"), for flamegraph.pl or speedscope."""
+    if not PROFILING_ENABLED:
+        return JSONResponse(status_code=403, content={"error": "profiling is disabled (AUTOCOMPLETE_PROFILING=1)"})
+    return PlainTextResponse(profiler.stop())
+
+@app.get("/scheduler/stats")
+def scheduler_stats():
+    """Batch sizes and queue-wait times, for tuning BATCH_WINDOW_MS against latency."""
+    return {
+        **batch_scheduler.stats(),
+        "prefix_cache": autocomplete_model.prefix_cache.stats(),
+        "retrieval_pool": retrieval_pool.stats(),
+        "streams": stream_limiter.stats(),
+        "in_flight": in_flight.stats(),
+        "result_cache": result_cache.stats(),
+        "retrieval": retrieval_policy.stats(),
+        "speculative": autocomplete_model.speculative_stats.stats(),
+        "phrase_index": {"entries": len(phrase_index), **phrase_index.stats.stats()} if phrase_index else None,
+    }
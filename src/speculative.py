@@ -0,0 +1,181 @@
+# speculative.py
+# Prompt-lookup speculative decoding. Draft tokens come from matching the last few generated
+# tokens against the prompt and the retrieved chunks, and GPT-2 checks the whole draft in one
+# forward pass. Completions often copy phrases from the chunks, so several tokens are accepted
+# per pass, and the output is exactly what greedy decoding would produce.
+
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+class PromptLookupDrafter:
+    """
+    Proposes draft tokens from earlier occurrences of the sequence's last n-gram, looking in the
+    sequence itself first (most recent occurrence) and then in the extra `sources` (e.g. the full
+    retrieved chunks, of which the prompt may only hold a truncated part).
+    """
+    def __init__(
+        self,
+        tokens: List[int],
+        sources: Sequence[List[int]] = (),
+        num_draft: int = 8,
+        ngram_min: int = 1,
+        ngram_max: int = 3
+    ):
+        self.num_draft = num_draft
+        self.ngram_min = ngram_min
+        self.ngram_max = ngram_max
+
+        # n-gram -> (source index, position right after it); the first occurrence wins
+        self.sources = list(sources)
+        self.source_ngrams: Dict[Tuple[int, ...], Tuple[int, int]] = {}
+        for index, source in enumerate(self.sources):
+            for n in range(ngram_min, ngram_max + 1):
+                for end in range(n, len(source)):
+                    self.source_ngrams.setdefault(tuple(source[end - n:end]), (index, end))
+
+        # n-gram -> position right after its latest occurrence in the sequence. The n-grams
+        # ending at the last token are registered one step late, so a lookup never finds
+        # the suffix it is looking for.
+        self.tokens: List[int] = []
+        self.seq_ngrams: Dict[Tuple[int, ...], int] = {}
+        self.extend(tokens)
+
+    def extend(self, new_tokens: List[int]):
+        for token in new_tokens:
+            end = len(self.tokens)
+            for n in range(self.ngram_min, min(self.ngram_max, end) + 1):
+                self.seq_ngrams[tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(token)
+
+    def draft(self, limit: int) -> List[int]:
+        """Up to `limit` (and num_draft) tokens that might follow the current sequence."""
+        limit = min(limit, self.num_draft)
+        if limit <= 0:
+            return []
+        for n in range(min(self.ngram_max, len(self.tokens)), self.ngram_min - 1, -1):
+            key = tuple(self.tokens[-n:])
+            end = self.seq_ngrams.get(key)
+            if end is not None:
+                return self.tokens[end:end + limit]
+            found = self.source_ngrams.get(key)
+            if found is not None:
+                index, end = found
+                draft = self.sources[index][end:end + limit]
+                if draft:
+                    return draft
+        return []
+
+
+class SpeculativeStats:
+    """Running totals across requests: how many drafted tokens were accepted, and tokens per pass."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.forward_passes = 0
+        self.generated_tokens = 0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+
+    def record(self, forward_passes: int, generated: int, drafted: int, accepted: int):
+        with self._lock:
+            self.requests += 1
+            self.forward_passes += forward_passes
+            self.generated_tokens += generated
+            self.drafted_tokens += drafted
+            self.accepted_tokens += accepted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "forward_passes": self.forward_passes,
+                "generated_tokens": self.generated_tokens,
+                "drafted_tokens": self.drafted_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else 0.0,
+                "tokens_per_forward": (
+                    self.generated_tokens / self.forward_passes if self.forward_passes else 0.0
+                ),
+            }
+
+
+def prompt_lookup_generate(
+    backend,
+    prompt_ids: List[int],
+    past_key_values=None,
+    max_new_tokens: int = 50,
+    eos_token_id: Optional[int] = None,
+    sources: Sequence[List[int]] = (),
+    num_draft: int = 8,
+    ngram_max: int = 3,
+    stats: Optional[SpeculativeStats] = None,
+    stopper=None
+) -> List[int]:
+    """
+    Greedy decoding of one prompt with prompt-lookup drafts; returns the new token ids.
+    `past_key_values` (legacy layout) may cover a prefix of `prompt_ids`, as the prefix cache
+    provides it. Each verification pass feeds the last accepted token plus the draft, keeps the
+    draft up to the first token where GPT-2's own argmax disagrees, and takes that argmax as the
+    next token, so the result matches plain greedy decoding token for token.
+    If a `stopper` (stopping.SuggestionStopper) is given, every token is fed to it and decoding
+    ends as soon as it says the suggestion is done.
+    """
+    needs_probs = stopper is not None and stopper.needs_probs
+
+    def accept(token_id: int, token_logits: torch.Tensor) -> bool:
+        """Append one token; True when decoding should end."""
+        generated.append(token_id)
+        drafter.extend([token_id])
+        if stopper is not None:
+            prob = float(torch.softmax(token_logits.float(), dim=-1)[token_id]) if needs_probs else None
+            if stopper.add(token_id, prob):
+                return True
+        return token_id == eos_token_id or len(generated) >= max_new_tokens
+
+    past = backend.from_legacy(past_key_values)
+    cached = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+
+    # 1) Prefill what the cache does not cover
+    logits, past = backend.forward(torch.tensor([prompt_ids[cached:]], dtype=torch.long), past)
+    next_token = int(torch.argmax(logits[0, -1]))
+    next_logits = logits[0, -1]
+    forward_passes = drafted = accepted = 0
+
+    drafter = PromptLookupDrafter(prompt_ids, sources, num_draft=num_draft, ngram_max=ngram_max)
+    generated: List[int] = []
+    while True:
+        if accept(next_token, next_logits):
+            break
+
+        # 2) Draft, then score the accepted token and the draft together
+        draft = drafter.draft(max_new_tokens - len(generated))
+        cache_len = len(prompt_ids) + len(generated) - 1
+        logits, past = backend.forward(torch.tensor([[next_token] + draft], dtype=torch.long), past)
+        forward_passes += 1
+        predicted = torch.argmax(logits[0], dim=-1).tolist()
+
+        # 3) Accept the longest prefix of the draft that greedy decoding would have produced
+        n = 0
+        done = False
+        while n < len(draft) and predicted[n] == draft[n]:
+            n += 1
+            if accept(draft[n - 1], logits[0, n - 1]):
+                done = True
+                break
+        drafted += len(draft)
+        accepted += n
+        if done:
+            break
+
+        # Rejected draft positions must not stay in the cache
+        if n < len(draft):
+            past = backend.crop(past, cache_len + 1 + n)
+        next_token = predicted[n]
+        next_logits = logits[0, n]
+
+    if stats is not None:
+        stats.record(forward_passes + 1, len(generated), drafted, accepted)
+    return generated[:max_new_tokens]
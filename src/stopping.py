@@ -0,0 +1,193 @@
+# stopping.py
+# Stop a completion at the granularity the editor shows (a word, a phrase, a sentence or a line)
+# or as soon as the model becomes unsure, instead of always decoding max_length tokens.
+
+import math
+import re
+import threading
+from typing import Callable, List, Optional
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+GRANULARITIES = ("word", "phrase", "sentence", "newline")
+
+# A boundary only counts once the character after it has been decoded, so "3.5" or "bbc.co.uk"
+# are not mistaken for the end of a phrase or sentence
+_BOUNDARIES = {
+    # end of the first word: the whitespace after it
+    "word": re.compile(r"\w\S*?(\s)"),
+    # after , ; : . ! ? that is followed by whitespace, or at a line break
+    "phrase": re.compile(r"\S[,;:.!?]()\s|\S[^\S\n]*(\n)"),
+    # after . ! ? (and closing quotes/brackets) followed by whitespace, or at a line break
+    "sentence": re.compile(r"\S[.!?][\"')\]]*()\s|\S[^\S\n]*(\n)"),
+    "newline": re.compile(r"\S[^\n]*(\n)"),
+}
+
+
+def find_boundary(text: str, granularity: str) -> Optional[int]:
+    """Length of the suggestion `text` should be cut to at `granularity`, or None if it has not ended yet."""
+    match = _BOUNDARIES[granularity].search(text)
+    if match is None:
+        return None
+    # The boundary is wherever the (one) group that took part in the match starts
+    return next(match.start(g) for g in range(1, match.re.groups + 1) if match.start(g) >= 0)
+
+
+class SuggestionStopper:
+    """
+    Follows one completion token by token and decides when it is done:
+      "eos"            the model ended the text,
+      <granularity>    the suggestion reached a word/phrase/sentence/newline boundary,
+      "low_confidence" the next token's probability fell below `min_prob`,
+      "length"         `max_tokens` tokens were generated,
+      "cancelled"      `cancel` was set (e.g. a newer request of the same session arrived),
+      or whatever `finish` is given when decoding ended for another reason.
+    `text` is always cut back to where the suggestion ends. When tokens come with their
+    probabilities, `score` is the mean log-probability per token, for ranking candidates.
+    """
+    def __init__(
+        self,
+        tokenizer,
+        stop_at: Optional[str] = None,
+        min_prob: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+        cancel: Optional[threading.Event] = None
+    ):
+        if stop_at is not None and stop_at not in GRANULARITIES:
+            raise ValueError(f"Unknown stop granularity {stop_at!r}, expected one of {GRANULARITIES}")
+        self.tokenizer = tokenizer
+        self.stop_at = stop_at
+        self.min_prob = min_prob
+        self.max_tokens = max_tokens
+        self.eos_token_id = eos_token_id if eos_token_id is not None else tokenizer.eos_token_id
+        self.cancel = cancel
+
+        self.token_ids: List[int] = []
+        # Tokens fed so far, including the one that ended the suggestion (= decode steps it cost)
+        self.steps = 0
+        self._decoded = ""
+        self._previous = ""
+        self.end: Optional[int] = None
+        self.reason: Optional[str] = None
+        self._logprob = 0.0
+        self._scored = 0
+
+    @property
+    def done(self) -> bool:
+        return self.reason is not None
+
+    @property
+    def needs_probs(self) -> bool:
+        return self.min_prob is not None and self.min_prob > 0
+
+    def add(self, token_id: int, prob: Optional[float] = None) -> bool:
+        """Feed the next generated token (and its probability); returns True once the suggestion is done."""
+        if self.done:
+            return True
+        self.steps += 1
+        # Checked once per decoded token, so every decode loop that feeds a stopper can be cancelled
+        if self.cancel is not None and self.cancel.is_set():
+            return self._stop("cancelled", len(self._decoded))
+        unsure = self.needs_probs and prob is not None and prob < self.min_prob
+        if prob is not None and not unsure:
+            self._logprob += math.log(max(prob, 1e-12))
+            self._scored += 1
+        if token_id == self.eos_token_id:
+            return self._stop("eos", len(self._decoded))
+        if unsure:
+            return self._stop("low_confidence", len(self._decoded))
+
+        self.token_ids.append(token_id)
+        self._previous = self._decoded
+        # Decoding the whole suggestion keeps multi-byte characters split across tokens intact
+        self._decoded = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        if self.stop_at is not None:
+            end = find_boundary(self._decoded, self.stop_at)
+            if end is not None:
+                return self._stop(self.stop_at, end)
+        if self.max_tokens is not None and len(self.token_ids) >= self.max_tokens:
+            return self._stop("length", len(self._decoded))
+        return False
+
+    def ends_at_boundary(self) -> bool:
+        """
+        Whether the suggestion so far ends exactly at its granularity boundary, given that
+        whitespace comes next (as after "Statistics." or a whole word); for callers that
+        cannot decode the next token to find out.
+        """
+        if self.stop_at is None or not self._decoded:
+            return False
+        return find_boundary(self._decoded + " ", self.stop_at) == len(self._decoded)
+
+    def _stop(self, reason: str, end: int) -> bool:
+        self.reason = reason
+        self.end = end
+        return True
+
+    def finish(self, reason: str = "length") -> str:
+        """Mark a suggestion that ran out of tokens (or was cancelled) and return its final text."""
+        if not self.done:
+            self._stop(reason, len(self._decoded))
+        return self.text
+
+    @property
+    def score(self) -> Optional[float]:
+        return self._logprob / self._scored if self._scored else None
+
+    @property
+    def text(self) -> str:
+        return self._decoded if self.end is None else self._decoded[:self.end]
+
+    def safe_text(self) -> str:
+        """
+        The part of the suggestion that can no longer change: everything up to the latest token,
+        whose text may still turn out to lie past a boundary, minus a trailing character whose
+        bytes are not all decoded yet.
+        """
+        return self.text if self.done else self._previous.rstrip("\ufffd")
+
+
+class TokenProbabilities(LogitsProcessor):
+    """
+    Remembers the model's next-token distribution at every step (before temperature / top-p
+    warping), so the probability of the token that was then chosen can be looked up.
+    """
+    def __init__(self):
+        self.probs: Optional[torch.Tensor] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.probs = torch.softmax(scores.float(), dim=-1)
+        return scores
+
+    def prob(self, row: int, token_id: int) -> Optional[float]:
+        return None if self.probs is None else float(self.probs[row, token_id])
+
+
+class SuggestionStoppingCriteria(StoppingCriteria):
+    """
+    Feeds every newly generated token of every row to that row's SuggestionStopper, and stops
+    `generate` once all rows are done. Rows that finished early keep decoding with the rest of
+    the batch; their stopper has already fixed where their text ends.
+    """
+    def __init__(
+        self,
+        stoppers: List[SuggestionStopper],
+        probabilities: Optional[TokenProbabilities] = None,
+        on_step: Optional[Callable[[], None]] = None
+    ):
+        self.stoppers = stoppers
+        self.probabilities = probabilities
+        self.on_step = on_step
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        last_tokens = input_ids[:, -1].tolist()
+        for row, (stopper, token_id) in enumerate(zip(self.stoppers, last_tokens)):
+            if stopper.done:
+                continue
+            prob = None if self.probabilities is None else self.probabilities.prob(row, token_id)
+            stopper.add(token_id, prob)
+        if self.on_step is not None:
+            self.on_step()
+        return all(stopper.done for stopper in self.stoppers)